@@ -1,41 +1,94 @@
-import subprocess
-import string
 import os
+
+# Live event streams hold their connections open, so they are only served with
+# gevent, where each is a greenlet rather than a thread. Gevent must patch the
+# standard library before anything imports it, which is why it is asked for
+# from the environment, with COLLEGEJUMP_GEVENT=1, rather than the command line.
+GEVENT = os.environ.get('COLLEGEJUMP_GEVENT', '').strip().lower() in ('1', 'true', 'yes')
+if GEVENT:
+    from gevent import monkey
+    monkey.patch_all()
+
+# pylint: disable=wrong-import-position
 import binascii
+import tempfile
 from functools import wraps
-import markdown
 
-from flask import Flask, request, abort, Markup
-from flask_bcrypt import Bcrypt
+from flask import Flask, abort, Markup
 from flask_login import LoginManager, current_user
 from flask_sqlalchemy import SQLAlchemy
-from flask_bootstrap import Bootstrap
-from flask_wtf.csrf import CSRFProtect
 
-# Flask convention is to use `app`
-app = Flask(__name__) # pylint: disable=invalid-name
-Bootstrap(app)
-app.bcrypt = Bcrypt()
+# Flask convention is to use `app`. Static files are served by the `send_static`
+# view rather than Flask's own.
+app = Flask(__name__, static_folder=None, static_url_path='/static') # pylint: disable=invalid-name
 app.db = SQLAlchemy()
 
 app.login_manager = LoginManager()
 app.login_manager.login_view = 'login_page'
 
-def init_app():
-    app.bcrypt.init_app(app)
+def init_app(web=True):
+    """Initialize the application once it is configured. Scripts which only
+    use the models and database may pass `web=False` to skip setting up
+    views, templates and CSRF protection, which they don't need.
+    """
     app.db.init_app(app)
     app.login_manager.init_app(app)
+
+    # Changes made by scripts are announced to users, too.
+    from collegejump import events, notifications # pylint: disable=unused-import
+    if not web:
+        return
+
+    from flask_bcrypt import Bcrypt
+    from flask_bootstrap import Bootstrap
+    from flask_wtf.csrf import CSRFProtect
+    from collegejump import cache
+
+    # Scripts set up bcrypt when they first use a password, if they do.
+    app.bcrypt = Bcrypt(app)
+    Bootstrap(app)
     CSRFProtect(app)
 
-try:
-    from collegejump._version import __version__
-except ImportError:
-    app.logger.warning("WARN: no _version.py; is the package installed? using SCM instead")
-    import collegejump.scmtools
-    __version__ = collegejump.scmtools.get_scm_version()
+    # Requests know how large a body their view accepts.
+    from collegejump import limits
+    app.request_class = limits.LimitedRequest
+
+    # Make the version easily accessible
+    app.config.setdefault('VERSION', __getattr__('__version__'))
+
+    # Allow templates to cache fragments using `{% cache key %}...{% endcache %}`.
+    app.jinja_env.add_extension('collegejump.cache.FragmentCacheExtension')
+
+    # Share compiled templates between processes, so new ones start quickly.
+    if app.config['TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = cache.TemplateBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+
+    # Answer health checks before requests reach the application.
+    from collegejump import health
+    app.wsgi_app = health.HealthCheckMiddleware(app, app.wsgi_app)
 
-# Make the version easily accessible
-app.config['VERSION'] = __version__
+    # Importing the views and the API registers them with the application.
+    # pylint: disable=unused-import
+    from collegejump import api, archive_views, grading_views, search_views, upload_views, \
+        views
+
+def __getattr__(name):
+    # The version is looked up on first use, since without the _version.py
+    # written when the package is built, finding it means running git.
+    if name != '__version__':
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    try:
+        from collegejump._version import __version__ as version
+    except ImportError:
+        app.logger.warning("WARN: no _version.py; is the package installed? using SCM instead")
+        from collegejump import scmtools
+        version = scmtools.get_scm_version()
+
+    globals()['__version__'] = version
+    return version
 
 # Make a random SECRET_KEY. See #26.
 app.config['SECRET_KEY'] = binascii.hexlify(os.urandom(32)).decode('utf-8')
@@ -43,6 +96,89 @@ app.config['SECRET_KEY'] = binascii.hexlify(os.urandom(32)).decode('utf-8')
 # Set SQLAlchemy options that'll never change
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Logged-in users' principals (admin flag, mentees, enrollments) are cached
+# per-process for this many seconds, to save loading them on every request.
+# Changes made by this process take effect immediately; other processes see
+# them once the cached copy expires.
+app.config['USER_CACHE_TTL'] = 30
+
+# Pages seen by anonymous visitors, and fragments such as announcement panels,
+# are cached until their content changes. Up to PAGE_CACHE_SIZE pages are kept
+# in each process for at most PAGE_CACHE_TTL seconds. Setting PAGE_CACHE_DIR
+# shares cached pages, and their invalidation, between processes, keeping up
+# to PAGE_CACHE_FILES of them there.
+app.config['PAGE_CACHE_SIZE'] = 256
+app.config['PAGE_CACHE_TTL'] = 300
+app.config['PAGE_CACHE_DIR'] = None
+app.config['PAGE_CACHE_FILES'] = 1024
+
+# Compress dynamic responses at least this many bytes long, if the client
+# accepts it.
+app.config['COMPRESS_MIN_SIZE'] = 500
+
+# Resized images are built into this directory.
+app.config['IMAGE_CACHE_DIR'] = os.path.join(tempfile.gettempdir(), 'collegejump-images')
+
+# Compiled templates are cached in this directory, shared by all processes. Set
+# it to None to compile templates in every process instead.
+app.config['TEMPLATE_CACHE_DIR'] = os.path.join(tempfile.gettempdir(),
+                                                'collegejump-templates')
+
+# Search uses SQLite's FTS5 full-text index when it is available. Otherwise, or
+# if this is False, each process keeps its own index in memory instead.
+app.config['SEARCH_USE_FTS'] = True
+
+# Archived semesters are stored in this directory, as compressed SQLite
+# databases. If None, an `archives` directory beside the database file is used.
+# They are decompressed into ARCHIVE_CACHE_DIR to be read.
+app.config['ARCHIVE_DIR'] = None
+app.config['ARCHIVE_CACHE_DIR'] = os.path.join(tempfile.gettempdir(), 'collegejump-archives')
+
+# Large files are uploaded in chunks of at most UPLOAD_CHUNK_SIZE bytes, which
+# are kept in UPLOAD_DIR until the upload is complete and claimed, or for
+# UPLOAD_EXPIRY seconds after the last chunk if it never is. Attachments to
+# submissions may be up to MAX_ATTACHMENT_SIZE bytes, and a week's documents
+# up to MAX_DOCUMENT_SIZE.
+app.config['UPLOAD_DIR'] = os.path.join(tempfile.gettempdir(), 'collegejump-uploads')
+app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024
+app.config['UPLOAD_EXPIRY'] = 24 * 60 * 60
+app.config['MAX_ATTACHMENT_SIZE'] = 20 * 1024 * 1024
+app.config['MAX_DOCUMENT_SIZE'] = 50 * 1024 * 1024
+
+# Request bodies may be up to MAX_CONTENT_LENGTH bytes, except for views which
+# take files, which allow the largest file plus MAX_FORM_MEMORY_SIZE for the
+# rest of the form. Database imports may be up to MAX_DATABASE_SIZE. Files in
+# forms are kept in memory up to FORM_SPOOL_SIZE, and on disk beyond that.
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+app.config['MAX_FORM_MEMORY_SIZE'] = 1024 * 1024
+app.config['MAX_DATABASE_SIZE'] = 500 * 1024 * 1024
+app.config['FORM_SPOOL_SIZE'] = 512 * 1024
+
+# Users are told of new feedback, submissions and announcements over
+# `/events` if EVENT_STREAMS is set, which it is when serving with gevent.
+# Streams send a comment every EVENTS_KEEPALIVE seconds while idle.
+# Events from other processes are relayed every EVENTS_POLL_INTERVAL seconds,
+# and kept for EVENTS_RETENTION seconds for clients which reconnect.
+app.config['EVENT_STREAMS'] = GEVENT
+app.config['EVENTS_KEEPALIVE'] = 15
+app.config['EVENTS_POLL_INTERVAL'] = 1
+app.config['EVENTS_RETENTION'] = 60 * 60
+
+# Users are emailed digests of the same events. They are always queued, and
+# sent by every process where MAIL_SERVER is set; workers claim what they send,
+# so each digest is sent once. A digest is sent once the oldest event in it has
+# waited NOTIFICATION_DELAY seconds, checking every NOTIFICATION_INTERVAL
+# seconds, and NOTIFICATION_BATCH_SIZE recipients are claimed at a time.
+app.config['MAIL_SERVER'] = None
+app.config['MAIL_PORT'] = 25
+app.config['MAIL_USE_TLS'] = False
+app.config['MAIL_USERNAME'] = None
+app.config['MAIL_PASSWORD'] = None
+app.config['MAIL_SENDER'] = 'College JUMP <noreply@localhost>'
+app.config['NOTIFICATION_DELAY'] = 15 * 60
+app.config['NOTIFICATION_INTERVAL'] = 60
+app.config['NOTIFICATION_BATCH_SIZE'] = 50
+
 # Set the repository links here, so they're less hard-coded elsewhere
 app.config['REPOSITORY_HOME'] = 'https://github.com/UMBC-CMSC447-Spring2017-Team5/college-JUMP'
 app.config['REPOSITORY_ISSUES'] = app.config['REPOSITORY_HOME'] + '/issues'
@@ -51,12 +187,24 @@ app.config['REPOSITORY_ISSUES'] = app.config['REPOSITORY_HOME'] + '/issues'
 # demo website that we cannot resolve in the time allowed.
 app.config['WTF_CSRF_ENABLED'] = False
 
-# Register a function to run before other requests.
-@app.before_first_request
-def prepare_after_init():
-    from collegejump import models
+def init_db():
+    """Create any missing tables and bring the database up to date with the
+    models. This only needs to run once per deployment, before any process
+    starts serving, such as with `python -m collegejump --init-only`. Must be
+    called within an application context.
+    """
+    from collegejump import database
 
     app.db.create_all()
+    database.upgrade_db()
+
+def init_process():
+    """Prepare a process to serve requests, once the database is initialized.
+    Must be called within an application context.
+    """
+    from collegejump import models, search
+
+    search.setup()
 
     # If there are no admins in the database, create and store SETUP_KEY for
     # creating the first admin.
@@ -65,10 +213,16 @@ def prepare_after_init():
         app.logger.info("No admins in database, created setup key: %s",
                         app.config['SETUP_KEY'])
 
-# Register a handy template filter
+# Register a handy template filter. Models store the rendered HTML of their
+# Markdown columns alongside the source, so templates pass it in as
+# `prerendered`; anything else is rendered here, through a small cache.
 @app.template_filter('markdown')
-def markdown_filter(data):
-    return Markup(markdown.markdown(data))
+def markdown_filter(data, prerendered=None):
+    from collegejump import markup
+
+    if prerendered is not None:
+        return Markup(prerendered)
+    return Markup(markup.render_cached(data))
 
 # Register an admin_required handler, for ensuring that users are logged-in
 # admins when they access certain pages.
@@ -81,7 +235,3 @@ def admin_required(func):
             return abort(401)
         return func(*args, **kwargs)
     return decorated_view
-
-# We import the views here so that the application still mostly works even if
-# the main() function isn't ever run.
-import collegejump.views # pylint: disable=wrong-import-position
@@ -12,7 +12,7 @@ GCAL_LINK = 'https://calendar.google.com/calendar/embed?src=umbc.edu_p0a471t6hmi
 
 def main(args):
     # We cannot import app outside of this function, to avoid circular imports.
-    from collegejump import app, init_app, __version__
+    from collegejump import app, assets, init_app, init_db, init_process, __version__, GEVENT
 
     if args.version:
         app.logger.info(__version__)
@@ -37,8 +37,28 @@ def main(args):
     if args.gcal:
         app.config['COLLEGEJUMP_GCAL_LINK'] = args.gcal
 
+    if args.template_cache_dir:
+        app.config['TEMPLATE_CACHE_DIR'] = args.template_cache_dir
+
+    if args.mail_server:
+        app.config['MAIL_SERVER'] = args.mail_server
+        app.config['MAIL_PORT'] = args.mail_port
+        app.config['MAIL_USE_TLS'] = args.mail_tls
+        app.config['MAIL_USERNAME'] = os.environ.get('COLLEGEJUMP_MAIL_USERNAME')
+        app.config['MAIL_PASSWORD'] = os.environ.get('COLLEGEJUMP_MAIL_PASSWORD')
+        if args.mail_sender:
+            app.config['MAIL_SENDER'] = args.mail_sender
+
+    if args.page_cache_dir:
+        os.makedirs(args.page_cache_dir, exist_ok=True)
+        app.config['PAGE_CACHE_DIR'] = args.page_cache_dir
+
+    # We initailize the applications once configuration options are set.
+    init_app()
+
     # If the application is prefixed, such as behind a web proxy, then we need
-    # middleware to rewrite urls. Otherwise, do no such rewriting.
+    # middleware to rewrite urls. Otherwise, do no such rewriting. This wraps
+    # the health checks too, so the proxy reaches them under the prefix.
     if args.prefix:
         app.config["APPLICATION_ROOT"] = args.prefix
         app.wsgi_app = werkzeug.wsgi.DispatcherMiddleware(
@@ -47,13 +67,41 @@ def main(args):
     else:
         app.config["APPLICATION_ROOT"] = '/'
 
-    # We initailize the applications once configuration options are set.
-    init_app()
-
     # Gain app context for all other operations.
     with app.app_context():
+        # Bring the database up to date, unless that is done separately, once
+        # per deployment.
+        if not args.no_init:
+            init_db()
+        if args.recompress:
+            from collegejump import database
+            app.logger.info("Recompressed %d stored values", database.recompress())
+            return 0
+        if args.init_only:
+            return 0
+        init_process()
+
+        assets.compile_templates()
+        if args.compile_templates:
+            return 0
+
         app.logger.info("Starting College JUMP Website version '%s'", __version__)
-        app.run(host=args.host, port=args.port, debug=args.debug)
+        assets.build_images()
+        if args.warm_up:
+            assets.warm_up()
+        # Pass on events recorded by other processes to this one's streams.
+        if app.config['EVENT_STREAMS']:
+            from collegejump import events
+            events.start_relay()
+        # Email is only ever sent from the background.
+        if app.config['MAIL_SERVER']:
+            from collegejump import notifications
+            notifications.start_worker()
+        if GEVENT:
+            from gevent.pywsgi import WSGIServer
+            WSGIServer((args.host, args.port), app).serve_forever()
+        else:
+            app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
 
 # Decode command line arguments using argparse
 
@@ -65,6 +113,32 @@ def parse(argv):
     parser.add_argument('--prefix', default=None)
     parser.add_argument('--db', default='local.db')
     parser.add_argument('--gcal', default=GCAL_LINK)
+    parser.add_argument('--page-cache-dir', default=None,
+                        help="directory for sharing cached pages between processes")
+
+    parser.add_argument('--template-cache-dir', default=None,
+                        help="directory for sharing compiled templates between processes")
+    parser.add_argument('--compile-templates', action='store_true', default=False,
+                        help="compile templates into the template cache, then exit")
+    parser.add_argument('--warm-up', action='store_true', default=False,
+                        help="render common pages once before serving requests")
+
+    parser.add_argument('--init-only', action='store_true', default=False,
+                        help="create or upgrade the database, then exit")
+    parser.add_argument('--no-init', action='store_true', default=False,
+                        help="don't create or upgrade the database, as --init-only already has")
+
+    parser.add_argument('--recompress', action='store_true', default=False,
+                        help="compress data stored before it was compressed, then exit")
+
+    parser.add_argument('--mail-server', default=None,
+                        help="SMTP server for notification digests; the login, if any, "
+                             "is read from COLLEGEJUMP_MAIL_USERNAME and _PASSWORD")
+    parser.add_argument('--mail-port', default=25, type=int)
+    parser.add_argument('--mail-tls', action='store_true', default=False,
+                        help="use STARTTLS with the SMTP server")
+    parser.add_argument('--mail-sender', default=None,
+                        help="From address of notification digests")
 
     parser.add_argument('--debug', action='store_true', default=False)
     parser.add_argument('--version', action='store_true')
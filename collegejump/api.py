@@ -0,0 +1,261 @@
+# A read-only JSON API, for clients which want the syllabus and submissions
+# without whole pages. Users log in as they do for the site, and may see
+# exactly what the pages would show them.
+#
+# Every resource can be narrowed to some of its fields with `?fields=a,b`, and
+# lists are split into pages with `?page=` and `?per_page=`. Responses carry
+# ETags, so clients can ask whether anything changed without fetching it again.
+import collections
+import functools
+import flask
+from flask_login import current_user
+from sqlalchemy.orm import joinedload, subqueryload
+
+from collegejump import app, models
+from collegejump.cache import conditional
+
+PREFIX = '/api/v1'
+
+# Items listed per page, unless the request asks for another number, up to the
+# maximum.
+PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+def error(message, status):
+    """Return a JSON error response."""
+    response = flask.jsonify(error=message, status=status)
+    response.status_code = status
+    return response
+
+def _fail(message, status):
+    # Stop handling the request, answering with a JSON error.
+    flask.abort(error(message, status))
+
+def _login_required(func):
+    # Clients are told they must log in rather than redirected to the form.
+    @functools.wraps(func)
+    def decorated_view(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return error("Log in to use the API", 401)
+        return func(*args, **kwargs)
+    return decorated_view
+
+def _time(value):
+    return value.isoformat() if value is not None else None
+
+def _url(endpoint, **values):
+    return flask.url_for(endpoint, _external=True, **values)
+
+# The fields of each resource, in order, as name -> function of the model.
+SEMESTER_FIELDS = collections.OrderedDict([
+    ('id', lambda s: s.id),
+    ('name', lambda s: s.name),
+    ('order', lambda s: s.order),
+    ('archived', lambda s: s.archive_path is not None),
+    ('updated_at', lambda s: _time(s.updated_at)),
+    ('weeks_url', lambda s: _url('api_weeks', semester_id=s.id)),
+])
+
+WEEK_FIELDS = collections.OrderedDict([
+    ('id', lambda w: w.id),
+    ('semester_id', lambda w: w.semester_id),
+    ('week_num', lambda w: w.week_num),
+    ('header', lambda w: w.header),
+    ('intro', lambda w: w.intro),
+    ('intro_html', lambda w: w.intro_html),
+    ('assignment_ids', lambda w: [a.id for a in w.assignments]),
+    ('documents', lambda w: [{'id': d.id, 'name': d.name,
+                              'url': _url('document_page', document_id=d.id)}
+                             for d in w.documents]),
+    ('updated_at', lambda w: _time(w.updated_at)),
+])
+
+ASSIGNMENT_FIELDS = collections.OrderedDict([
+    ('id', lambda a: a.id),
+    ('name', lambda a: a.name),
+    ('instructions', lambda a: a.instructions),
+    ('instructions_html', lambda a: a.instructions_html),
+    ('submissions_url', lambda a: _url('api_assignment_submissions', assignment_id=a.id)),
+])
+
+FEEDBACK_FIELDS = collections.OrderedDict([
+    ('id', lambda f: f.id),
+    ('author', lambda f: f.author.name if f.author else None),
+    ('text', lambda f: f.text),
+    ('timestamp', lambda f: _time(f.timestamp)),
+])
+
+SUBMISSION_FIELDS = collections.OrderedDict([
+    ('id', lambda s: s.id),
+    ('assignment_id', lambda s: s.assignment_id),
+    ('author_id', lambda s: s.author_id),
+    ('author', lambda s: s.author.name if s.author else None),
+    ('text', lambda s: s.text),
+    ('filename', lambda s: s.filename),
+    ('attachment_url', lambda s: _url('submission_attachment_page', submission_id=s.id)
+                                 if s.filename else None),
+    ('timestamp', lambda s: _time(s.timestamp)),
+    ('feedback', lambda s: [_serialize(f, FEEDBACK_FIELDS, FEEDBACK_FIELDS)
+                            for f in s.all_feedback]),
+    ('updated_at', lambda s: _time(s.updated_at)),
+])
+
+def _selected(fields):
+    # Read the fields the client asked for, or all of them.
+    requested = flask.request.args.get('fields')
+    if not requested:
+        return list(fields)
+    selected = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in selected if name not in fields]
+    if unknown:
+        _fail("Unknown fields: {}".format(', '.join(unknown)), 400)
+    return selected
+
+def _serialize(obj, fields, selected):
+    return collections.OrderedDict((name, fields[name](obj)) for name in selected)
+
+def _page_args():
+    # Read the page requested, and its size within reason.
+    page = max(flask.request.args.get('page', 1, type=int), 1)
+    per_page = flask.request.args.get('per_page', PER_PAGE, type=int)
+    return page, max(1, min(per_page, MAX_PER_PAGE))
+
+def _respond(render, *parts):
+    # Answer with the JSON from `render()`, unless the client has it already.
+    # The URL is part of the version, since it selects fields and pages.
+    return conditional(lambda: flask.jsonify(render()), flask.request.full_path, *parts)
+
+def _one(obj, fields, *parts):
+    selected = _selected(fields)
+    return _respond(lambda: {'data': _serialize(obj, fields, selected)}, *parts)
+
+def _list(query, fields, *parts):
+    # List a page of the query's rows, fetching one extra to learn whether
+    # there are more.
+    selected = _selected(fields)
+    page, per_page = _page_args()
+
+    def render():
+        rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+        more = len(rows) > per_page
+        args = dict(flask.request.view_args, **flask.request.args.to_dict())
+        args.update(page=page + 1, per_page=per_page)
+        return {'data': [_serialize(row, fields, selected) for row in rows[:per_page]],
+                'page': page,
+                'per_page': per_page,
+                'next': _url(flask.request.endpoint, **args) if more else None}
+
+    return _respond(render, *parts)
+
+def _get(model, row_id):
+    row = model.query.get(row_id)
+    if row is None:
+        _fail("No such {}".format(model.__name__.lower()), 404)
+    return row
+
+def _require_interest(semester_id):
+    # Users see the semesters which the syllabus pages would show them.
+    if not current_user.is_interested_in(semester_id):
+        _fail("Not allowed to see this semester", 403)
+
+def _may_see(submission):
+    # Users see their own submissions, and those they may give feedback on.
+    return submission.author_id == current_user.id or current_user.admin \
+            or submission.author_id in current_user.mentee_ids
+
+@app.route(PREFIX + '/semesters')
+@_login_required
+def api_semesters():
+    semesters = current_user.interested_semesters()
+    return _list(semesters, SEMESTER_FIELDS,
+                 models.version_of(semesters.order_by(None), models.Semester))
+
+@app.route(PREFIX + '/semesters/<int:semester_id>')
+@_login_required
+def api_semester(semester_id):
+    semester = _get(models.Semester, semester_id)
+    _require_interest(semester.id)
+    return _one(semester, SEMESTER_FIELDS, semester.id, semester.updated_at)
+
+@app.route(PREFIX + '/semesters/<int:semester_id>/weeks')
+@_login_required
+def api_weeks(semester_id):
+    semester = _get(models.Semester, semester_id)
+    _require_interest(semester.id)
+    weeks = models.Week.query.filter_by(semester_id=semester.id)
+    return _list(weeks.options(subqueryload(models.Week.assignments),
+                               subqueryload(models.Week.documents))
+                 .order_by(models.Week.week_num),
+                 WEEK_FIELDS,
+                 semester.id, semester.updated_at, models.version_of(weeks, models.Week))
+
+@app.route(PREFIX + '/weeks/<int:week_id>')
+@_login_required
+def api_week(week_id):
+    week = _get(models.Week, week_id)
+    _require_interest(week.semester_id)
+    return _one(week, WEEK_FIELDS, week.id, week.updated_at)
+
+@app.route(PREFIX + '/assignments/<int:assignment_id>')
+@_login_required
+def api_assignment(assignment_id):
+    assignment = _get(models.Assignment, assignment_id)
+    # Assignments are seen through the weeks holding them, and change with
+    # them.
+    weeks = models.Week.query.filter(models.Week.assignments.any(id=assignment.id))
+    if not any(current_user.is_interested_in(semester_id) for (semester_id,)
+               in weeks.with_entities(models.Week.semester_id).distinct()):
+        _fail("Not allowed to see this assignment", 403)
+    return _one(assignment, ASSIGNMENT_FIELDS,
+                assignment.id, models.version_of(weeks, models.Week))
+
+def _submissions(query):
+    # Load what the selected fields show along with the submissions.
+    selected = _selected(SUBMISSION_FIELDS)
+    if 'author' in selected:
+        query = query.options(joinedload(models.Submission.author))
+    if 'feedback' in selected:
+        query = query.options(subqueryload(models.Submission.all_feedback)
+                              .joinedload(models.Feedback.author))
+    return query
+
+def _submissions_version(query):
+    feedback = models.Feedback.query.filter(
+        models.Feedback.submission_id.in_(query.with_entities(models.Submission.id)))
+    return (models.version_of(query, models.Submission),
+            models.version_of(feedback, models.Feedback))
+
+@app.route(PREFIX + '/submissions')
+@_login_required
+def api_submissions():
+    """List the user's own submissions, newest first, optionally only those to
+    `?assignment_id=`."""
+    submissions = models.Submission.query.filter_by(author_id=current_user.id)
+    assignment_id = flask.request.args.get('assignment_id', type=int)
+    if assignment_id is not None:
+        submissions = submissions.filter_by(assignment_id=assignment_id)
+    return _list(_submissions(submissions).order_by(models.Submission.timestamp.desc(),
+                                                    models.Submission.id.desc()),
+                 SUBMISSION_FIELDS, *_submissions_version(submissions))
+
+@app.route(PREFIX + '/submissions/<int:submission_id>')
+@_login_required
+def api_submission(submission_id):
+    submission = _get(models.Submission, submission_id)
+    if not _may_see(submission):
+        _fail("Not allowed to see this submission", 403)
+    shown = models.Submission.query.filter_by(id=submission.id)
+    return _one(submission, SUBMISSION_FIELDS, *_submissions_version(shown))
+
+@app.route(PREFIX + '/assignments/<int:assignment_id>/submissions')
+@_login_required
+def api_assignment_submissions(assignment_id):
+    """List the submissions to an assignment which the user may give feedback
+    on, newest first."""
+    assignment = _get(models.Assignment, assignment_id)
+    if not current_user.admin and not current_user.mentee_ids:
+        _fail("Only mentors and admins may see others' submissions", 403)
+    submissions = current_user.submissions_for_feedback(assignment)
+    gradeable = current_user.gradeable_submissions() \
+                            .filter(models.Submission.assignment_id == assignment.id)
+    return _list(submissions, SUBMISSION_FIELDS, *_submissions_version(gradeable))
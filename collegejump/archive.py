@@ -0,0 +1,417 @@
+# Archiving moves a finished semester's content (its weeks, assignments,
+# documents, submissions and feedback) out of the database into a compressed
+# SQLite file of its own, keeping the database small. Archived semesters can
+# still be viewed, read-only, and can be restored to the database in full.
+import datetime
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from urllib.request import pathname2url
+
+import sqlalchemy
+
+from collegejump import app, models, search
+
+# The tables holding a semester's content, parents first, each with the tables
+# its foreign key columns refer to. The semester itself, enrollments and users
+# stay in the database.
+TABLES = (
+    ('document', {}),
+    ('assignment', {}),
+    ('week', {}),
+    ('week_documents', {'week_id': 'week', 'document_id': 'document'}),
+    ('week_assignments', {'week_id': 'week', 'assignment_id': 'assignment'}),
+    ('submission', {'assignment_id': 'assignment'}),
+    ('feedback', {'submission_id': 'submission'}),
+)
+
+# Tables are emptied in this order, so that the rows of each are still found
+# through those it's linked by.
+_DELETE_ORDER = ('feedback', 'submission', 'assignment', 'document',
+                 'week_assignments', 'week_documents', 'week')
+
+# Searchable tables, by the kind the search index knows them as.
+_SEARCHED = {'week': 'week', 'assignment': 'assignment',
+             'submission': 'submission', 'feedback': 'feedback'}
+
+# Rows are copied this many at a time, and ids checked this many at a time,
+# which is within SQLite's limit on query parameters.
+BATCH_SIZE = 500
+
+# Describes the archive: the semester it came from, when it was archived, and
+# which rows were shared with other semesters, and so never left the database.
+_info = sqlalchemy.Table('archive_info', sqlalchemy.MetaData(),
+                         sqlalchemy.Column('key', sqlalchemy.String(64), primary_key=True),
+                         sqlalchemy.Column('value', sqlalchemy.Text))
+
+def _table(name):
+    return app.db.metadata.tables[name]
+
+def archive_dir():
+    """Return the directory archives are stored in."""
+    directory = app.config['ARCHIVE_DIR']
+    if directory is None:
+        database = app.db.engine.url.database
+        if not database or database == ':memory:':
+            raise ValueError("ARCHIVE_DIR must be set for a database not stored in a file")
+        directory = os.path.join(os.path.dirname(os.path.abspath(database)), 'archives')
+    return directory
+
+def _selections(semester_id): # pylint: disable=too-many-locals
+    # Return conditions selecting the rows of each table under a semester, and
+    # conditions selecting those of them which are shared with other
+    # semesters, such as documents of a cloned semester, which must stay.
+    week = _table('week')
+    week_assignments = _table('week_assignments')
+    week_documents = _table('week_documents')
+    assignment = _table('assignment')
+    document = _table('document')
+    submission = _table('submission')
+    feedback = _table('feedback')
+
+    def select(column, condition):
+        return sqlalchemy.select([column]).where(condition)
+
+    week_ids = select(week.c.id, week.c.semester_id == semester_id)
+    assignment_ids = select(week_assignments.c.assignment_id,
+                            week_assignments.c.week_id.in_(week_ids))
+    document_ids = select(week_documents.c.document_id,
+                          week_documents.c.week_id.in_(week_ids))
+    submission_ids = select(submission.c.id, submission.c.assignment_id.in_(assignment_ids))
+
+    shared_assignment_ids = select(week_assignments.c.assignment_id,
+                                   ~week_assignments.c.week_id.in_(week_ids))
+    shared_document_ids = select(week_documents.c.document_id,
+                                 ~week_documents.c.week_id.in_(week_ids))
+    shared_submission_ids = select(submission.c.id,
+                                   submission.c.assignment_id.in_(shared_assignment_ids))
+
+    contents = {
+        'week': week.c.semester_id == semester_id,
+        'week_assignments': week_assignments.c.week_id.in_(week_ids),
+        'week_documents': week_documents.c.week_id.in_(week_ids),
+        'assignment': assignment.c.id.in_(assignment_ids),
+        'document': document.c.id.in_(document_ids),
+        'submission': submission.c.id.in_(submission_ids),
+        'feedback': feedback.c.submission_id.in_(submission_ids),
+    }
+    shared = {
+        'assignment': assignment.c.id.in_(shared_assignment_ids),
+        'document': document.c.id.in_(shared_document_ids),
+        'submission': submission.c.id.in_(shared_submission_ids),
+        'feedback': feedback.c.submission_id.in_(shared_submission_ids),
+    }
+    return contents, shared
+
+def _ids(connection, table, condition):
+    return [i for (i,) in connection.execute(sqlalchemy.select([table.c.id]).where(condition))]
+
+def _batches(rows):
+    # Generate lists of rows from a result, a batch at a time.
+    while True:
+        batch = rows.fetchmany(BATCH_SIZE)
+        if not batch:
+            return
+        yield [dict(row) for row in batch]
+
+def archive_semester(semester):
+    """Move everything under `semester` into a new archive file, and mark the
+    semester archived. Rows shared with other semesters are copied into the
+    archive, but also stay in the database. Commits the session.
+    """
+    if semester.archive_path:
+        raise ValueError("{!r} is already archived".format(semester))
+
+    directory = archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    now = datetime.datetime.now()
+    name = 'semester-{}-{:%Y%m%d%H%M%S}.sqlite.gz'.format(semester.id, now)
+    path = os.path.join(directory, name)
+
+    session = app.db.session
+    contents, shared = _selections(semester.id)
+    _write_archive(semester, path, now, contents, shared)
+
+    # Only now that the archive is safely written, take the rows out of the
+    # database, and out of the search index.
+    def moved(table_name):
+        if table_name in shared:
+            return contents[table_name] & ~shared[table_name]
+        return contents[table_name]
+
+    try:
+        removed = {t: _ids(session, _table(t), moved(t)) for t in _SEARCHED}
+        for table_name in _DELETE_ORDER:
+            session.execute(_table(table_name).delete().where(moved(table_name)))
+        for table_name, kind in _SEARCHED.items():
+            search.unindex(kind, removed[table_name])
+
+        semester.archive_path = name
+        session.commit()
+    except:
+        session.rollback()
+        os.remove(path)
+        raise
+    app.logger.info("Archived %r to %s", semester, path)
+
+def _write_archive(semester, path, now, contents, shared):
+    # Write the archive as a database of its own, then compress it to `path`.
+    session = app.db.session
+    descriptor, database_path = tempfile.mkstemp(suffix='.sqlite',
+                                                 dir=os.path.dirname(path))
+    os.close(descriptor)
+    try:
+        engine = sqlalchemy.create_engine('sqlite:///' + database_path)
+        app.db.metadata.create_all(engine, tables=[_table(t) for t, _ in TABLES])
+        _info.metadata.create_all(engine)
+
+        kept = {}
+        with engine.begin() as archive:
+            for table_name, _ in TABLES:
+                table = _table(table_name)
+                for batch in _batches(session.execute(
+                        table.select().where(contents[table_name]))):
+                    archive.execute(table.insert(), batch)
+                if table_name in shared:
+                    kept[table_name] = _ids(session, table,
+                                            contents[table_name] & shared[table_name])
+
+            archive.execute(sqlalchemy.insert(_info), [
+                {'key': 'semester', 'value': json.dumps({'id': semester.id,
+                                                         'name': semester.name,
+                                                         'order': semester.order})},
+                {'key': 'archived_at', 'value': json.dumps(now.isoformat())},
+                {'key': 'shared', 'value': json.dumps(kept)},
+            ])
+        engine.dispose()
+        _compress(database_path, path)
+    finally:
+        os.remove(database_path)
+
+def restore_semester(semester):
+    """Move everything in the archive of `semester` back into the database,
+    and delete the archive. Rows whose ids have been reused in the meantime
+    are given new ones, and rows which were shared with other semesters but
+    have since been deleted are restored from the archive's copies. Commits
+    the session.
+    """
+    if not semester.archive_path:
+        raise ValueError("{!r} is not archived".format(semester))
+    if models.Week.query.filter_by(semester_id=semester.id).count():
+        raise ValueError("Weeks have been added to {!r} since it was archived"
+                         .format(semester))
+
+    archive = open_archive(semester)
+    session = app.db.session
+
+    try:
+        shared = _still_shared(archive.info('shared'))
+        offsets = {}
+        with archive.engine.connect() as source:
+            for table_name, parents in TABLES:
+                _restore_table(source, table_name, parents, shared, offsets)
+
+        search.index_semester(semester.id)
+        semester.archive_path = None
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+    _delete(archive)
+    app.logger.info("Restored %r from its archive", semester)
+
+def _still_shared(recorded):
+    # Return, by table, the ids of the rows recorded as shared with other
+    # semesters when the archive was made which are still in the database.
+    # Those deleted since, such as along with the other semester, aren't
+    # linked to, but restored like the rest.
+    shared = {}
+    for table_name, ids in recorded.items():
+        table = _table(table_name)
+        shared[table_name] = set()
+        for start in range(0, len(ids), BATCH_SIZE):
+            shared[table_name].update(_ids(app.db.session, table,
+                                           table.c.id.in_(ids[start:start + BATCH_SIZE])))
+    return shared
+
+def _restore_table(source, table_name, parents, shared, offsets):
+    # Copy a table's rows from an archive back into the database, moving their
+    # ids, and their links to other restored rows, by the offsets found for
+    # each table, and recording this table's in `offsets`.
+    table = _table(table_name)
+    kept = shared.get(table_name, set())
+    if 'id' in table.c:
+        offsets[table_name] = _restored_offset(
+            table, [i for (i,) in source.execute(sqlalchemy.select([table.c.id]))
+                    if i not in kept])
+
+    for batch in _batches(source.execute(table.select())):
+        restored = []
+        for row in batch:
+            # Rows shared with other semesters never left.
+            if 'id' in row:
+                if row['id'] in kept:
+                    continue
+                row['id'] += offsets[table_name]
+            for column, parent in parents.items():
+                if row[column] is not None and row[column] not in shared.get(parent, ()):
+                    row[column] += offsets[parent]
+            restored.append(row)
+        if restored:
+            app.db.session.execute(table.insert(), restored)
+
+def _restored_offset(table, ids):
+    # Return what to add to the ids of restored rows so that none collide with
+    # rows in the database. They keep their ids, unless some have been reused.
+    if not ids:
+        return 0
+    for start in range(0, len(ids), BATCH_SIZE):
+        if app.db.session.execute(sqlalchemy.select([table.c.id]).where(
+                table.c.id.in_(ids[start:start + BATCH_SIZE])).limit(1)).first():
+            break
+    else:
+        return 0
+    last = app.db.session.execute(sqlalchemy.select([sqlalchemy.func.max(table.c.id)])).scalar()
+    return last - min(ids) + 1
+
+def delete_archive(semester):
+    """Delete the archive of a semester, such as when the semester itself is
+    deleted."""
+    if semester.archive_path:
+        _delete(open_archive(semester))
+
+
+class Archive(object):
+    """A read-only view of an archived semester's content. Rows are returned
+    as they are stored, rather than as models."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        uri = 'file:{}?mode=ro'.format(pathname2url(path))
+        self.engine = sqlalchemy.create_engine(
+            'sqlite://', creator=lambda: sqlite3.connect(uri, uri=True),
+            poolclass=sqlalchemy.pool.NullPool)
+
+    def _all(self, query):
+        with self.engine.connect() as connection:
+            return connection.execute(query).fetchall()
+
+    def info(self, key):
+        """Return a value describing the archive, as stored when it was made."""
+        rows = self._all(sqlalchemy.select([_info.c.value]).where(_info.c.key == key))
+        return json.loads(rows[0][0])
+
+    def weeks(self):
+        """Return every week, in order."""
+        week = _table('week')
+        return self._all(week.select().order_by(week.c.week_num))
+
+    def week(self, week_num):
+        """Return a week by its number, or None."""
+        week = _table('week')
+        rows = self._all(week.select().where(week.c.week_num == week_num))
+        return rows[0] if rows else None
+
+    def assignment(self, week_id):
+        """Return the assignment shown with a week, or None."""
+        assignment = _table('assignment')
+        week_assignments = _table('week_assignments')
+        rows = self._all(assignment.select()
+                         .where(assignment.c.id.in_(
+                             sqlalchemy.select([week_assignments.c.assignment_id])
+                             .where(week_assignments.c.week_id == week_id)))
+                         .order_by(assignment.c.id).limit(1))
+        return rows[0] if rows else None
+
+    def documents(self, week_id):
+        """Return the ids and names of the documents of a week."""
+        document = _table('document')
+        week_documents = _table('week_documents')
+        return self._all(sqlalchemy.select([document.c.id, document.c.name])
+                         .where(document.c.id.in_(
+                             sqlalchemy.select([week_documents.c.document_id])
+                             .where(week_documents.c.week_id == week_id)))
+                         .order_by(document.c.id))
+
+    def document(self, document_id):
+        """Return a document, with its data, or None."""
+        document = _table('document')
+        rows = self._all(document.select().where(document.c.id == document_id))
+        return rows[0] if rows else None
+
+    def submission(self, submission_id):
+        """Return a submission, with its attachment, or None."""
+        submission = _table('submission')
+        rows = self._all(submission.select().where(submission.c.id == submission_id))
+        return rows[0] if rows else None
+
+    def submissions(self, assignment_id, author_ids=None):
+        """Return the submissions to an assignment, by the given authors if any
+        are given, newest first, each as a (submission, feedback) pair."""
+        submission = _table('submission')
+        feedback = _table('feedback')
+        # Attachments are only loaded when they are downloaded.
+        query = sqlalchemy.select([c for c in submission.c if c.name != 'filedata']) \
+                          .where(submission.c.assignment_id == assignment_id) \
+                          .order_by(submission.c.timestamp.desc(), submission.c.id.desc())
+        if author_ids is not None:
+            query = query.where(submission.c.author_id.in_(list(author_ids)))
+        submissions = self._all(query)
+
+        all_feedback = {}
+        for row in self._all(feedback.select()
+                             .where(feedback.c.submission_id.in_(
+                                 query.with_only_columns([submission.c.id])))
+                             .order_by(feedback.c.timestamp, feedback.c.id)):
+            all_feedback.setdefault(row.submission_id, []).append(row)
+        return [(s, all_feedback.get(s.id, [])) for s in submissions]
+
+# Archives opened in this process, by file name.
+_archives = {}
+_archives_lock = threading.Lock()
+
+def open_archive(semester):
+    """Return an Archive of an archived semester, decompressing it into
+    ARCHIVE_CACHE_DIR the first time it is opened."""
+    name = semester.archive_path
+    with _archives_lock:
+        archive = _archives.get(name)
+        if archive is None:
+            path = os.path.join(app.config['ARCHIVE_CACHE_DIR'], name[:-len('.gz')])
+            if not os.path.isfile(path):
+                os.makedirs(app.config['ARCHIVE_CACHE_DIR'], exist_ok=True)
+                _decompress(os.path.join(archive_dir(), name), path)
+            archive = _archives[name] = Archive(name, path)
+    return archive
+
+def _delete(archive):
+    # Delete an archive, and its decompressed copy.
+    with _archives_lock:
+        _archives.pop(archive.name, None)
+    archive.engine.dispose()
+    for path in (os.path.join(archive_dir(), archive.name), archive.path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass # already gone
+
+def _compress(source, destination):
+    # Compress a file with gzip, replacing the destination only once complete.
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(destination))
+    with open(source, 'rb') as source_file, os.fdopen(descriptor, 'wb') as destination_file, \
+            gzip.GzipFile(fileobj=destination_file, mode='wb') as compressed:
+        shutil.copyfileobj(source_file, compressed)
+    os.replace(temporary_path, destination)
+
+def _decompress(source, destination):
+    # Decompress a gzip file, replacing the destination only once complete.
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(destination))
+    with gzip.open(source, 'rb') as compressed, os.fdopen(descriptor, 'wb') as destination_file:
+        shutil.copyfileobj(compressed, destination_file)
+    os.replace(temporary_path, destination)
@@ -0,0 +1,89 @@
+# Pages of archived semesters, which show them read-only from their archives.
+# See `archive` for how semesters are archived and restored.
+import io
+
+import flask
+from flask_login import login_required, current_user
+
+from collegejump import app, archive, models
+
+def _archived_semester(semester_id):
+    # Look up an archived semester which the current user may see, aborting
+    # otherwise, and open its archive.
+    semester = models.Semester.query.get(semester_id)
+    if semester is None or not semester.archive_path:
+        return flask.abort(404)
+    if not current_user.is_interested_in(semester.id):
+        return flask.abort(403)
+    return semester, archive.open_archive(semester)
+
+@app.route('/archive/semester/<int:semester_id>')
+@login_required
+def archived_semester_page(semester_id):
+    """List the weeks of an archived semester."""
+    semester, semester_archive = _archived_semester(semester_id)
+    return flask.render_template('archived_semester.html',
+                                 semester=semester,
+                                 archived_at=semester_archive.info('archived_at'),
+                                 weeks=semester_archive.weeks())
+
+@app.route('/archive/semester/<int:semester_id>/week/<int:week_num>')
+@login_required
+def archived_week_page(semester_id, week_num):
+    """Show a week of an archived semester, read-only, with the submissions
+    the user could see when it was current."""
+    semester, semester_archive = _archived_semester(semester_id)
+    week = semester_archive.week(week_num)
+    if week is None:
+        return flask.abort(404)
+
+    assignment = semester_archive.assignment(week.id)
+    submissions = []
+    if assignment is not None:
+        author_ids = None
+        if not current_user.admin:
+            author_ids = [current_user.id] + list(current_user.mentee_ids)
+        submissions = semester_archive.submissions(assignment.id, author_ids)
+
+    # Users stay in the database, so look up the names of everyone shown.
+    user_ids = {s.author_id for s, _ in submissions} \
+            | {f.author_id for _, feedback in submissions for f in feedback}
+    names = dict(app.db.session.query(models.User.id, models.User.name)
+                 .filter(models.User.id.in_(user_ids))) if user_ids else {}
+
+    return flask.render_template('archived_week.html',
+                                 semester=semester,
+                                 week=week,
+                                 assignment=assignment,
+                                 documents=semester_archive.documents(week.id),
+                                 submissions=submissions,
+                                 names=names)
+
+@app.route('/archive/semester/<int:semester_id>/document/<int:document_id>')
+@login_required
+def archived_document_page(semester_id, document_id):
+    semester_archive = _archived_semester(semester_id)[1]
+    document = semester_archive.document(document_id)
+    if document is None:
+        return flask.abort(404)
+    return flask.send_file(io.BytesIO(document.data),
+                           attachment_filename=document.name,
+                           as_attachment=True)
+
+@app.route('/archive/semester/<int:semester_id>/submission/<int:submission_id>/attachment')
+@login_required
+def archived_attachment_page(semester_id, submission_id):
+    semester_archive = _archived_semester(semester_id)[1]
+    submission = semester_archive.submission(submission_id)
+    if submission is None or not submission.filename:
+        return flask.abort(404)
+
+    # Only let the author, the admins, and the author's mentors download the file.
+    if (current_user.id != submission.author_id) \
+            and (not current_user.admin) \
+            and (submission.author_id not in current_user.mentee_ids):
+        return flask.abort(403)
+
+    return flask.send_file(io.BytesIO(submission.filedata),
+                           attachment_filename=submission.filename,
+                           as_attachment=True)
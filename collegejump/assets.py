@@ -0,0 +1,178 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import flask
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None # pylint: disable=invalid-name
+
+from collegejump import app, compression
+
+STATIC_DIR = os.path.join(app.root_path, 'static')
+
+# Square sizes, in pixels, which images may be resized to. Pages show images at
+# the smaller size, and the larger for high density displays.
+IMAGE_SIZES = (50, 100)
+
+# Images which are resized ahead of time by `build_images()`.
+PIPELINE_IMAGES = ('shriver.jpeg', 'cj.jpg')
+
+# Formats images are converted to, as (MIME type, Pillow format, extension,
+# save options), most preferred first. Clients get the first they accept.
+IMAGE_FORMATS = [('image/webp', 'WEBP', '.webp', {'quality': 80, 'method': 6}),
+                 ('image/jpeg', 'JPEG', '.jpg', {'quality': 85, 'optimize': True,
+                                                 'progressive': True})]
+if Image is not None and not features.check('webp'):
+    IMAGE_FORMATS = IMAGE_FORMATS[1:]
+
+# Serializes building image variants.
+_image_lock = threading.Lock()
+
+# A year, which is as long as clients can be told to cache anything.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Content hashes of static files, keyed by path and modification time.
+_fingerprints = {}
+
+def fingerprint(path):
+    """Return a short hash of the content of a static file, or None if there
+    is no such file. URLs carrying it change whenever the file does, so they
+    can be cached indefinitely."""
+    filename = flask.safe_join(STATIC_DIR, path)
+    try:
+        key = (path, os.stat(filename).st_mtime)
+    except OSError:
+        return None
+
+    if key not in _fingerprints:
+        with open(filename, 'rb') as static_file:
+            _fingerprints[key] = hashlib.sha1(static_file.read()).hexdigest()[:12]
+    return _fingerprints[key]
+
+def send_static_file(path):
+    """Send a static file, preferring a precompressed variant that the client
+    accepts. If the URL carries the file's current fingerprint, the client may
+    cache the response forever."""
+    filename = flask.safe_join(STATIC_DIR, path)
+    if not os.path.isfile(filename):
+        return flask.abort(404)
+
+    # Use a precompressed variant if it is at least as new as the file.
+    send_filename, encoding = filename, None
+    for candidate in compression.acceptable_encodings(flask.request.accept_encodings):
+        variant = filename + compression.SUFFIXES[candidate]
+        if os.path.isfile(variant) \
+                and os.path.getmtime(variant) >= os.path.getmtime(filename):
+            send_filename, encoding = variant, candidate
+            break
+
+    response = flask.send_file(send_filename,
+                               mimetype=mimetypes.guess_type(filename)[0],
+                               conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return _cache_if_fingerprinted(response, path)
+
+def image_variant(path, size, mimetype):
+    """Return the filename of a static image resized to `size` and converted
+    to `mimetype`, building it if it is missing or out of date, or None if the
+    file isn't an image Pillow can read. Variants of older versions of the
+    image are removed as newer ones are built."""
+    source = flask.safe_join(STATIC_DIR, path)
+    pillow_format, extension, options = next((f, e, o) for m, f, e, o in IMAGE_FORMATS
+                                             if m == mimetype)
+    suffix = '-{}-{}{}'.format(size, path.replace('/', '_'), extension)
+    name = fingerprint(path) + suffix
+    variant = os.path.join(app.config['IMAGE_CACHE_DIR'], name)
+
+    with _image_lock:
+        if not os.path.isfile(variant):
+            try:
+                image = Image.open(source).convert('RGB')
+            except (IOError, ValueError):
+                app.logger.warning("Can't read %s as an image", path)
+                return None
+            # Stretch to a square, just as pages display them.
+            image = image.resize((size, size), Image.LANCZOS)
+
+            os.makedirs(app.config['IMAGE_CACHE_DIR'], exist_ok=True)
+            descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(variant))
+            with os.fdopen(descriptor, 'wb') as temporary_file:
+                image.save(temporary_file, pillow_format, **options)
+            os.replace(temporary_path, variant)
+            app.logger.debug("Built image variant %s", variant)
+
+            # Only the current version of each variant is kept.
+            for other in os.listdir(app.config['IMAGE_CACHE_DIR']):
+                if other != name and other.endswith(suffix) and len(other) == len(name):
+                    os.remove(os.path.join(app.config['IMAGE_CACHE_DIR'], other))
+    return variant
+
+def build_images():
+    """Build every variant of the pipeline images ahead of time, so no request
+    has to wait for one."""
+    if Image is None:
+        app.logger.warning("Pillow is not installed; serving images unchanged")
+        return
+    for path in PIPELINE_IMAGES:
+        for size in IMAGE_SIZES:
+            for mimetype, _, _, _ in IMAGE_FORMATS:
+                image_variant(path, size, mimetype)
+
+def send_image(path, size):
+    """Send a static image resized to `size`, in the best format the client
+    accepts. Without Pillow, send the original image instead."""
+    if size not in IMAGE_SIZES \
+            or not (mimetypes.guess_type(path)[0] or '').startswith('image/'):
+        return flask.abort(404)
+    if Image is None:
+        return send_static_file(path)
+    if fingerprint(path) is None:
+        return flask.abort(404)
+
+    # Clients which can decode WebP name it explicitly rather than through a
+    # wildcard, while anything can decode JPEG.
+    named = {value for value, quality in flask.request.accept_mimetypes if quality}
+    mimetype = next((m for m, _, _, _ in IMAGE_FORMATS if m in named), 'image/jpeg')
+
+    variant = image_variant(path, size, mimetype)
+    if variant is None:
+        return flask.abort(404)
+    response = flask.send_file(variant, mimetype=mimetype, conditional=True)
+    response.vary.add('Accept')
+    return _cache_if_fingerprinted(response, path)
+
+def _cache_if_fingerprinted(response, path):
+    # Let clients cache the response forever if the URL named the current
+    # fingerprint of the file it came from.
+    version = flask.request.args.get('v')
+    if version and version == fingerprint(path):
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(
+            IMMUTABLE_MAX_AGE)
+    return response
+
+# Pages rendered by `warm_up()`, as an anonymous visitor would see them.
+WARM_UP_PATHS = ('/', '/calendar', '/announcement/', '/login')
+
+def compile_templates():
+    """Compile every template, including those of Flask-Bootstrap, so that
+    they are in the bytecode cache and loaded in this process. Returns the
+    names of the templates."""
+    names = [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    app.logger.debug("Compiled %d templates", len(names))
+    return names
+
+def warm_up(paths=WARM_UP_PATHS):
+    """Render commonly visited pages once, before serving anyone, so that
+    the first visitors don't wait for everything to be loaded and compiled."""
+    client = app.test_client()
+    for path in paths:
+        status = client.get(path).status_code
+        app.logger.debug("Warmed up %s (%d)", path, status)
@@ -0,0 +1,324 @@
+import collections
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import threading
+import time
+from functools import wraps
+
+import flask
+from flask import Markup
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from werkzeug.urls import url_encode
+
+from collegejump import app
+
+
+class LRUCache(object):
+    """A small, thread-safe, size-bounded mapping which discards the least
+    recently used entries once full. If `ttl` is given, entries also expire
+    that many seconds after they were stored.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        """Return the value stored for `key`, or `default` if it is absent or
+        has expired."""
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= self._clock():
+                del self._entries[key]
+                return default
+
+            # Mark the entry as the most recently used.
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store `value` for `key`, evicting the oldest entry if full. A `ttl`
+        given here overrides the cache-wide one for this entry."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = self._clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove the entry for `key`, returning its value if it was present."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Sentinel for distinguishing a stored `None` from a missing entry.
+_MISSING = object()
+
+
+class PageCache(object):
+    """Caches whole responses for anonymous visitors, and fragments of pages for
+    everyone, until `invalidate()` is called because the content they show has
+    changed.
+
+    Entries are kept in a size-bounded in-process LRU. If PAGE_CACHE_DIR is
+    set, responses are also stored there, up to PAGE_CACHE_FILES of them, so
+    that worker processes share them, and invalidation in one worker reaches
+    all of them. Otherwise, other workers see changes once their entries reach
+    PAGE_CACHE_TTL.
+    """
+
+    def __init__(self):
+        self._responses = None
+        self._fragments = None
+        self._generation = 0
+
+    def _caches(self):
+        # Created on first use, so that they follow the final configuration.
+        if self._responses is None:
+            self._responses = LRUCache(maxsize=app.config['PAGE_CACHE_SIZE'],
+                                       ttl=app.config['PAGE_CACHE_TTL'])
+            self._fragments = LRUCache(maxsize=app.config['PAGE_CACHE_SIZE'] * 4,
+                                       ttl=app.config['PAGE_CACHE_TTL'])
+        return self._responses, self._fragments
+
+    @property
+    def directory(self):
+        return app.config['PAGE_CACHE_DIR']
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def generation(self):
+        """Return a number which changes every time the cache is invalidated.
+        With a cache directory, it is read once per application context, so a
+        page holding many fragments reads it once."""
+        if not self.directory:
+            return self._generation
+        if not flask.has_app_context():
+            return self._read_generation()
+        known = flask.g.setdefault('page_cache_generations', {})
+        if self.directory not in known:
+            known[self.directory] = self._read_generation()
+        return known[self.directory]
+
+    def _read_generation(self):
+        try:
+            with open(self._path('generation')) as generation_file:
+                return int(generation_file.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def invalidate(self):
+        """Forget every cached response and fragment, in all processes sharing
+        the cache directory."""
+        responses, fragments = self._caches()
+        responses.clear()
+        fragments.clear()
+        self._generation += 1
+
+        if self.directory:
+            generation = self._read_generation() + 1
+            _write_atomically(self._path('generation'), str(generation).encode('ascii'))
+            if flask.has_app_context():
+                flask.g.setdefault('page_cache_generations', {})[self.directory] = generation
+            for name in os.listdir(self.directory):
+                if name.endswith('.page'):
+                    try:
+                        os.remove(self._path(name))
+                    except OSError:
+                        pass # another worker beat us to it
+
+    def get_response(self, key):
+        """Return a cached response for `key`, or None."""
+        responses = self._caches()[0]
+        generation = self.generation()
+
+        entry = responses.get(key)
+        if entry is None and self.directory:
+            try:
+                with open(self._path(_hash(key) + '.page'), 'rb') as page_file:
+                    entry = pickle.load(page_file)
+            except (OSError, EOFError, pickle.PickleError):
+                entry = None
+            if entry is not None:
+                responses.set(key, entry)
+
+        if entry is None or entry[0] != generation:
+            return None
+        return flask.Response(entry[3], status=entry[1], headers=entry[2])
+
+    def set_response(self, key, response):
+        """Store a complete, buffered response for `key`."""
+        entry = (self.generation(), response.status_code,
+                 list(response.headers), response.get_data())
+        self._caches()[0].set(key, entry)
+        if self.directory:
+            _write_atomically(self._path(_hash(key) + '.page'), pickle.dumps(entry))
+            self._prune_files()
+
+    def _prune_files(self):
+        # Keep at most PAGE_CACHE_FILES pages in the directory, removing the
+        # least recently written.
+        paths = [self._path(name) for name in os.listdir(self.directory)
+                 if name.endswith('.page')]
+        excess = len(paths) - app.config['PAGE_CACHE_FILES']
+        if excess <= 0:
+            return
+        written = {}
+        for path in paths:
+            try:
+                written[path] = os.path.getmtime(path)
+            except OSError:
+                pass # removed by another worker
+        for path in sorted(written, key=written.get)[:excess]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass # another worker beat us to it
+
+    def fragment(self, key, render):
+        """Return the cached fragment for `key`, or call `render()` to produce
+        and cache it."""
+        fragments = self._caches()[1]
+        key = (self.generation(), key)
+        fragment = fragments.get(key)
+        if fragment is None:
+            fragment = render()
+            fragments.set(key, fragment)
+        return fragment
+
+# The single page cache for the application.
+pages = PageCache() # pylint: disable=invalid-name
+
+def cached_for_anonymous(*arg_names):
+    """Decorate a view so that GET requests by anonymous visitors are answered
+    from the page cache, if possible. The view may read the query arguments
+    named; requests with any others aren't cached, so that made-up query
+    strings can't fill the cache."""
+    def decorator(func):
+        @wraps(func)
+        def decorated_view(*args, **kwargs):
+            # Logged-in users see personalized pages, and pending flashed
+            # messages are shown only once, so neither can be shared.
+            if flask.request.method not in ('GET', 'HEAD') \
+                    or current_user.is_authenticated \
+                    or flask.session.get('_flashes') \
+                    or 'SETUP_KEY' in app.config \
+                    or any(name not in arg_names for name in flask.request.args):
+                return func(*args, **kwargs)
+
+            # Key on the arguments as the view reads them.
+            key = flask.request.base_url + '?' + url_encode(
+                {name: flask.request.args.get(name) for name in arg_names}, sort=True)
+            response = pages.get_response(key)
+            if response is not None:
+                # The cached response may be tagged by `conditional()`.
+                response.make_conditional(flask.request)
+            else:
+                response = flask.make_response(func(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough \
+                        and 'Set-Cookie' not in response.headers:
+                    pages.set_response(key, response)
+            return response
+        return decorated_view
+    return decorator
+
+
+def conditional(render, *parts):
+    """Respond to a request for a page whose content is determined entirely by
+    `parts`, such as ids and `models.version_of()` results.
+
+    If the client already has this version of the page, answer 304 Not
+    Modified without rendering. Otherwise, call `render()` and tag the response
+    with an ETag. The current user and the sidebar are accounted for
+    automatically. There is no Last-Modified time, since a page can change
+    without anything in it being updated later, such as when a row is deleted.
+    """
+    from collegejump import models
+
+    if current_user.is_authenticated:
+        parts += (current_user.version(), models.syllabus_version())
+    etag = _hash(repr((app.config['VERSION'],) + parts))
+
+    # Pending flashed messages are shown once, so the page must be rendered.
+    if flask.request.method in ('GET', 'HEAD') and not flask.session.get('_flashes'):
+        if flask.request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    response = flask.make_response(render())
+    response.set_etag(etag, weak=True)
+    # Let clients keep the page, but make them check that it is current.
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    return response
+
+
+class FragmentCacheExtension(Extension):
+    """Adds a `{% cache key, ... %}...{% endcache %}` tag to templates, which
+    renders its body once and serves it from the page cache afterwards. The
+    key must identify everything the body depends on, including data from
+    related rows, such as an author's name.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_cached', [nodes.List(key)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, caller): # pylint: disable=no-self-use
+        return Markup(pages.fragment(repr(key), caller))
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Stores compiled templates in a directory shared by every process.
+    Files are replaced atomically, so a process never loads one which another
+    is still writing.
+    """
+
+    def dump_bytecode(self, bucket):
+        buf = io.BytesIO()
+        bucket.write_bytecode(buf)
+        _write_atomically(self._get_cache_filename(bucket), buf.getvalue())
+
+
+def _hash(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _write_atomically(path, data):
+    # Write to a temporary file first, so readers never see partial data.
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(descriptor, 'wb') as temporary_file:
+        temporary_file.write(data)
+    os.replace(temporary_path, path)
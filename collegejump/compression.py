@@ -0,0 +1,187 @@
+# Compression helpers shared by the application and the build. This module must
+# not import the rest of the package, because `setup.py` loads it directly to
+# precompress static files.
+import gzip
+import io
+import os
+import zipfile
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # pylint: disable=invalid-name
+
+# Content encodings we can produce, in order of preference, and the suffix of
+# precompressed files in each.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Types of content which are worth compressing. Images, archives and the like
+# are compressed already.
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/feed+json',
+    'image/svg+xml',
+}
+COMPRESSIBLE_EXTENSIONS = {'.html', '.css', '.js', '.json', '.svg', '.txt', '.csv'}
+
+def compress(data, encoding):
+    """Compress bytes in the given content encoding."""
+    if encoding == 'br':
+        return brotli.compress(data)
+    elif encoding == 'gzip':
+        buf = io.BytesIO()
+        # A fixed mtime keeps the output the same for the same input.
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) as gzip_file:
+            gzip_file.write(data)
+        return buf.getvalue()
+    raise ValueError("Unsupported encoding {!r}".format(encoding))
+
+def acceptable_encodings(accept_encodings):
+    """Return the encodings we can produce which a client accepts, given its
+    parsed Accept-Encoding header, in order of preference."""
+    return [encoding for encoding in ENCODINGS if accept_encodings[encoding]]
+
+def precompress_directory(directory):
+    """Write precompressed variants, in every encoding we support, next to each
+    compressible file under `directory`. Returns the paths written."""
+    written = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as source:
+                data = source.read()
+            for encoding in ENCODINGS:
+                compressed = compress(data, encoding)
+                # Only keep variants which actually save something.
+                if len(compressed) < len(data):
+                    with open(path + SUFFIXES[encoding], 'wb') as variant:
+                        variant.write(compressed)
+                    written.append(path + SUFFIXES[encoding])
+    return written
+
+class _Pipe(object):
+    """A write-only file which holds what is written until it is taken. It
+    can't seek, so zipfile writes archives to it strictly in order."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(members, chunk_size=64 * 1024):
+    """Generate a ZIP archive piece by piece, from (name, date_time, data)
+    members, where `data` is bytes or an iterable of bytes. Only one member is
+    held in memory at a time, and members are read lazily if `members` is a
+    generator.
+    """
+    return (piece for piece in _zip_pieces(members, chunk_size) if piece)
+
+def _zip_pieces(members, chunk_size):
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, date_time, data in members:
+            chunks = data
+            if isinstance(data, bytes):
+                chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    yield pipe.take()
+            yield pipe.take()
+    # The central directory is written as the archive closes.
+    yield pipe.take()
+
+
+# Values stored compressed in the database begin with this, followed by zlib
+# data. Anything else is stored as it was given, such as values written before
+# compression, or those it wouldn't shrink.
+STORED_MAGIC = b'\x00cjz'
+
+# Stored values are only compressed if that saves at least this fraction.
+MIN_SAVING = 0.1
+
+# Leading bytes of formats which are compressed already, such as DOCX and other
+# ZIP-based documents, archives, images and media.
+COMPRESSED_SIGNATURES = (
+    b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'7z\xbc\xaf\x27\x1c',
+    b'\x28\xb5\x2f\xfd', b'Rar!', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'ID3',
+    b'OggS', b'fLaC',
+)
+
+def is_compressed_format(data):
+    """Guess from its first bytes whether data is in a compressed format,
+    which compressing again would hardly shrink."""
+    head = bytes(data[:12])
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return True
+    # WebP, and MP4 and other ISO media files, are marked after a length.
+    return (head[:4] == b'RIFF' and head[8:12] == b'WEBP') or head[4:8] == b'ftyp'
+
+def pack(data, level=6):
+    """Return bytes to store for `data`: compressed and marked, if that saves
+    enough space, or otherwise `data` itself."""
+    # Data which happens to begin with the mark must be compressed regardless,
+    # so that it isn't mistaken for compressed data when read.
+    if is_packed(data):
+        return STORED_MAGIC + zlib.compress(data, level)
+    if is_compressed_format(data):
+        return data
+
+    compressed = STORED_MAGIC + zlib.compress(data, level)
+    if len(compressed) <= len(data) * (1 - MIN_SAVING):
+        return compressed
+    return data
+
+def is_packed(value):
+    """Return whether a stored value was compressed by `pack()`."""
+    return value[:len(STORED_MAGIC)] == STORED_MAGIC
+
+def unpack(value):
+    """Return the original data of a value stored by `pack()`."""
+    if not is_packed(value):
+        return value
+    return zlib.decompress(bytes(value[len(STORED_MAGIC):]))
+
+def unpack_stream(value, chunk_size=64 * 1024):
+    """Generate the original data of a value stored by `pack()` in chunks of
+    about `chunk_size` bytes, without holding all of it at once."""
+    if not is_packed(value):
+        for start in range(0, len(value), chunk_size):
+            yield bytes(value[start:start + chunk_size])
+        return
+
+    value = memoryview(value)[len(STORED_MAGIC):]
+    decompressor = zlib.decompressobj()
+    for start in range(0, len(value), chunk_size):
+        chunk = decompressor.decompress(value[start:start + chunk_size], chunk_size)
+        while chunk:
+            yield chunk
+            chunk = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+def unpacked_size(value):
+    """Return the length of the original data of a value stored by `pack()`,
+    decompressing it a piece at a time to count it if need be."""
+    if not is_packed(value):
+        return len(value)
+    return sum(len(chunk) for chunk in unpack_stream(value))
@@ -1,11 +1,175 @@
 import csv
+import datetime
 import io
 import zipfile
+import sqlalchemy
 import sqlalchemy_utils
 
-from collegejump import app
+from collegejump import app, cache, compression, markup, models, search
 
-# Create any absent tables.
+def missing_schema(connection):
+    """Generate what the database lacks compared to the models, as (table,
+    column) pairs for missing columns and (table, index) pairs for missing
+    indexes. Missing tables show up as all of their columns missing.
+    """
+    inspector = sqlalchemy.inspect(connection)
+    for table in app.db.metadata.sorted_tables:
+        existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                yield table, column
+
+        # Indexes are listed from SQLite itself, since newer SQLAlchemy
+        # leaves indexes on expressions, such as lower(name), out of
+        # `get_indexes()`.
+        existing_indexes = {name for (name,) in connection.execute(
+            sqlalchemy.text("SELECT name FROM sqlite_master "
+                            "WHERE type = 'index' AND tbl_name = :table"),
+            table=table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                yield table, index
+
+def _renumber_repeated_weeks(connection):
+    # Week numbers weren't always unique within a semester, so number the
+    # weeks of any semester which repeats one 1, 2, ... again, in their current
+    # order, before they are required to be.
+    week = models.Week.__table__
+    repeated = {semester_id for (semester_id,) in connection.execute(
+        sqlalchemy.select([week.c.semester_id])
+        .group_by(week.c.semester_id, week.c.week_num)
+        .having(sqlalchemy.func.count() > 1))}
+    now = datetime.datetime.now()
+    for semester_id in sorted(repeated):
+        app.logger.warning("Renumbering the weeks of semester %d, which repeats week numbers",
+                           semester_id)
+        week_ids = [week_id for (week_id,) in connection.execute(
+            sqlalchemy.select([week.c.id])
+            .where(week.c.semester_id == semester_id)
+            .order_by(week.c.week_num, week.c.id))]
+        for week_num, week_id in enumerate(week_ids, 1):
+            connection.execute(week.update().where(week.c.id == week_id)
+                               .values(week_num=week_num, updated_at=now))
+
+# Data to fix before creating an index, by index name, as functions of the
+# connection.
+_BEFORE_INDEX = {
+    'ux_week_semester_id_week_num': _renumber_repeated_weeks,
+}
+
+def upgrade_db():
+    """Bring an existing database up to date with the models. `create_all()`
+    only creates absent tables, so this adds any columns and indexes introduced
+    since the database was created, then fills in data derived from them.
+    """
+    engine = app.db.engine
+    quote = engine.dialect.identifier_preparer.quote
+
+    with engine.begin() as connection:
+        # Take everything missing before changing anything.
+        for table, missing in list(missing_schema(connection)):
+            if isinstance(missing, sqlalchemy.Index):
+                if missing.name in _BEFORE_INDEX:
+                    _BEFORE_INDEX[missing.name](connection)
+                app.logger.info("Creating index %s", missing.name)
+                missing.create(connection)
+                continue
+
+            app.logger.info("Adding column %s.%s", table.name, missing.name)
+            connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                quote(table.name), quote(missing.name),
+                missing.type.compile(dialect=engine.dialect)))
+
+            # Give existing rows the column's default, if it has one.
+            if missing.default is not None:
+                value = missing.default.arg
+                if missing.default.is_callable:
+                    value = value(None)
+                connection.execute(table.update().values({missing.name: value}))
+
+    render_markdown(only_missing=True)
+    search.setup()
+
+def render_markdown(only_missing=False, batch_size=500):
+    """Fill in the pre-rendered HTML of every Markdown column, either for all
+    rows, or only those which have not been rendered yet.
+    """
+    with app.db.engine.begin() as connection:
+        for model, source, rendered in models.MARKDOWN_COLUMNS:
+            table = model.__table__
+            query = sqlalchemy.select([table.c.id, table.c[source]]) \
+                              .where(table.c[source] != None) # pylint: disable=singleton-comparison
+            if only_missing:
+                query = query.where(table.c[rendered] == None) # pylint: disable=singleton-comparison
+
+            update = table.update() \
+                          .where(table.c.id == sqlalchemy.bindparam('_id')) \
+                          .values({rendered: sqlalchemy.bindparam('_rendered')})
+
+            rows = connection.execute(query).fetchall()
+            if rows:
+                app.logger.info("Rendering Markdown for %d rows of %s", len(rows), table.name)
+            for start in range(0, len(rows), batch_size):
+                connection.execute(update, [{'_id': row[0], '_rendered': markup.render(row[1])}
+                                            for row in rows[start:start + batch_size]])
+
+def recompress(batch_size=100, vacuum=True):
+    """Compress the values of compressed columns which were stored before
+    they were compressed, a batch of rows per transaction, so the site can keep
+    serving meanwhile. Then, if `vacuum`, shrink the database file to match.
+    Returns the number of values rewritten.
+    """
+    rewritten = 0
+    for table in app.db.metadata.sorted_tables:
+        for column in table.columns:
+            if not isinstance(column.type, (models.CompressedBinary, models.CompressedText)):
+                continue
+
+            # Read the values as they are stored, to tell which are compressed,
+            # and write back what the column type would store for them.
+            stored = sqlalchemy.type_coerce(column, sqlalchemy.types.NullType())
+            update = table.update() \
+                          .where(table.c.id == sqlalchemy.bindparam('_id')) \
+                          .values({column.name: sqlalchemy.bindparam(
+                              '_value', type_=column.type.impl)})
+            last_id = 0
+            while True:
+                with app.db.engine.begin() as connection:
+                    rows = connection.execute(
+                        sqlalchemy.select([table.c.id, stored])
+                        .where(table.c.id > last_id)
+                        .where(column != None) # pylint: disable=singleton-comparison
+                        .order_by(table.c.id)
+                        .limit(batch_size)).fetchall()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+
+                    values = []
+                    for row_id, value in rows:
+                        if isinstance(value, bytes) and compression.is_packed(value):
+                            continue
+                        # Values which compression wouldn't shrink are stored
+                        # as they are, so they are left alone rather than
+                        # rewritten on every run.
+                        packed = column.type.process_bind_param(_original(column, value),
+                                                                connection.dialect)
+                        if packed != value:
+                            values.append({'_id': row_id, '_value': packed})
+                    if values:
+                        connection.execute(update, values)
+                        rewritten += len(values)
+            app.logger.info("Recompressed %s.%s", table.name, column.name)
+
+    if vacuum:
+        app.db.engine.execute('VACUUM')
+    return rewritten
+
+def _original(column, value):
+    # Return a stored value as the column type takes it.
+    if isinstance(column.type, models.CompressedText) and isinstance(value, bytes):
+        return value.decode('utf-8')
+    return bytes(value) if not isinstance(value, str) else value
 
 
 def export_db():
@@ -35,6 +199,20 @@ def export_db():
     archive_buf.seek(0)
     return archive_buf
 
+def parse_csv_datetimes(table, row):
+    """Convert any DateTime values of a CSV row, as written by `export_db()`,
+    which are still strings back into datetimes."""
+    for column in table.columns:
+        value = row.get(column.name)
+        if isinstance(column.type, sqlalchemy.DateTime) and isinstance(value, str):
+            if not value:
+                row[column.name] = None
+            elif '.' in value:
+                row[column.name] = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+            else:
+                row[column.name] = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return row
+
 def import_db(archive_path_or_buf):
     """DESTROY THE OLD DATABASE and import all of the tables in an archive as
     prepared by `export_db()`."""
@@ -76,10 +254,20 @@ def import_db(archive_path_or_buf):
                     for row in table_reader:
                         app.logger.debug("Importing row into %s: %r", table.name, row)
                         row = transform(row)
+                        row = parse_csv_datetimes(table, row)
                         connection.execute(table.insert(values=row))
             except:
                 transaction.rollback()
                 raise
 
     transaction.commit()
+
+    # Exports may come from older versions, or lack rendered HTML entirely.
+    render_markdown()
+
+    # The import bypassed the ORM, so no cached user data or pages, nor the
+    # search index, can be trusted.
+    models.UserPrincipal.forget()
+    cache.pages.invalidate()
+    search.rebuild()
     return
@@ -0,0 +1,238 @@
+# Live events, such as feedback on a student's submission, pushed to browsers
+# as Server-Sent Events so that nobody needs to keep reloading pages to see
+# them.
+#
+# Events are recorded in the `event` table in the same transaction as the
+# change they are about, and published to this process's subscribers once it
+# commits. A relay thread polls the table for events recorded by other
+# processes, so that every process's subscribers hear about everything, and
+# clients which reconnect catch up from the table too. Each connection waits
+# on an event of its own rather than a thread of its own, so when served with
+# gevent, a process holds thousands of idle connections cheaply.
+import collections
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import event
+
+from collegejump import app, models
+
+# An event as published to subscribers, with its data as JSON.
+Published = collections.namedtuple('Published', 'id user_id kind data')
+
+# Events held for a subscriber which is slow to take them, beyond which the
+# oldest are dropped.
+MAX_PENDING = 100
+
+# Missed events sent to a client which reconnects, at most.
+MAX_REPLAY = 100
+
+# How long clients wait before reconnecting, in milliseconds.
+RETRY_MS = 5000
+
+def _origin():
+    # Name this process, as the one which recorded an event. The pid is read
+    # each time, since processes may be forked after this is imported.
+    return '{}:{}'.format(socket.gethostname(), os.getpid())[:models.Event.ORIGIN_MAX_LENGTH]
+
+class Subscriber(object):
+    """A user's connection, holding the events published for them until it
+    takes them."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._pending = collections.deque(maxlen=MAX_PENDING)
+        self._ready = threading.Event()
+
+    def put(self, published):
+        self._pending.append(published)
+        self._ready.set()
+
+    def take(self, timeout):
+        """Return the events published since they were last taken, waiting up
+        to `timeout` seconds for any."""
+        self._ready.wait(timeout)
+        self._ready.clear()
+        taken = []
+        while self._pending:
+            taken.append(self._pending.popleft())
+        return taken
+
+class Broker(object):
+    """Passes published events on to the subscribers they are for."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(set)
+
+    def subscribe(self, user_id):
+        subscriber = Subscriber(user_id)
+        with self._lock:
+            self._subscribers[user_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.user_id]
+
+    def publish(self, published):
+        # Events for nobody in particular are for everyone.
+        with self._lock:
+            if published.user_id is None:
+                subscribers = [s for group in self._subscribers.values() for s in group]
+            else:
+                subscribers = list(self._subscribers.get(published.user_id, ()))
+        for subscriber in subscribers:
+            subscriber.put(published)
+
+    def count(self):
+        """Return the number of subscribers."""
+        with self._lock:
+            return sum(len(group) for group in self._subscribers.values())
+
+broker = Broker() # pylint: disable=invalid-name
+
+def _published(row):
+    return Published(row.id, row.user_id, row.kind, row.data)
+
+def missed(user_id, after_id, limit=MAX_REPLAY):
+    """Return the events for a user recorded after the event with id
+    `after_id`, oldest first, up to `limit` of them."""
+    Event = models.Event # pylint: disable=invalid-name
+    rows = Event.query.filter(Event.id > after_id) \
+                      .filter(app.db.or_(Event.user_id == user_id, Event.user_id.is_(None))) \
+                      .order_by(Event.id) \
+                      .limit(limit)
+    return [_published(row) for row in rows]
+
+def _format(published):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(published.id, published.kind,
+                                                     published.data)
+
+def stream(user_id, last_event_id=None):
+    """Return a generator of Server-Sent Events for a user, as they are
+    published, starting with those missed since `last_event_id` if given. A
+    comment is sent when nothing has happened for EVENTS_KEEPALIVE seconds, so
+    that proxies keep the connection open and closed ones are noticed. It
+    needs no request or application context once started."""
+    def generate():
+        # Subscribe before looking for missed events, so none fall in between.
+        subscriber = broker.subscribe(user_id)
+        try:
+            yield 'retry: {}\n\n'.format(RETRY_MS)
+            replayed = set()
+            if last_event_id is not None:
+                with app.app_context():
+                    backlog = missed(user_id, last_event_id)
+                for published in backlog:
+                    replayed.add(published.id)
+                    yield _format(published)
+
+            while True:
+                taken = subscriber.take(app.config['EVENTS_KEEPALIVE'])
+                if not taken:
+                    yield ': keepalive\n\n'
+                for published in taken:
+                    if published.id not in replayed:
+                        yield _format(published)
+        finally:
+            broker.unsubscribe(subscriber)
+    return generate()
+
+def describe(session, obj):
+    """Yield the (user id, kind, data) of the events about a new row, where a
+    user id of None means everyone. Called while the session is flushing."""
+    if isinstance(obj, models.Feedback):
+        submission = models.Submission.__table__
+        author_id = session.execute(app.db.select([submission.c.author_id])
+                                    .where(submission.c.id == obj.submission_id)).scalar()
+        if author_id is not None:
+            yield author_id, 'feedback', {'feedback_id': obj.id,
+                                          'submission_id': obj.submission_id}
+    elif isinstance(obj, models.Submission):
+        mentorships = models.mentorships
+        for (mentor_id,) in session.execute(
+                app.db.select([mentorships.c.mentor_id])
+                .where(mentorships.c.mentee_id == obj.author_id)):
+            yield mentor_id, 'submission', {'submission_id': obj.id,
+                                            'assignment_id': obj.assignment_id,
+                                            'author_id': obj.author_id}
+    elif isinstance(obj, models.Announcement):
+        yield None, 'announcement', {'announcement_id': obj.id, 'title': obj.title}
+
+# Record events about new rows as part of the same transaction, and publish
+# them here once it commits; a rolled back change never happened.
+@event.listens_for(app.db.session, 'after_flush')
+def _record_events(session, flush_context): # pylint: disable=unused-argument
+    table = models.Event.__table__
+    now = datetime.datetime.now()
+    for obj in session.new:
+        for user_id, kind, data in describe(session, obj):
+            data = json.dumps(data)
+            result = session.execute(table.insert().values(
+                user_id=user_id, kind=kind, data=data, timestamp=now, origin=_origin()))
+            session.info.setdefault('recorded_events', []).append(
+                Published(result.inserted_primary_key[0], user_id, kind, data))
+
+@event.listens_for(app.db.session, 'after_commit')
+def _publish_recorded_events(session):
+    for published in session.info.pop('recorded_events', ()):
+        broker.publish(published)
+
+@event.listens_for(app.db.session, 'after_soft_rollback')
+def _discard_recorded_events(session, previous_transaction): # pylint: disable=unused-argument
+    session.info.pop('recorded_events', None)
+
+def relay_once(after_id):
+    """Publish the events which other processes recorded after the event with
+    id `after_id`, returning the id of the last event seen. Must be called
+    within an application context."""
+    origin = _origin()
+    last_id = after_id
+    for row in models.Event.query.filter(models.Event.id > after_id).order_by(models.Event.id):
+        if row.origin != origin:
+            broker.publish(_published(row))
+        last_id = row.id
+    return last_id
+
+def prune():
+    """Delete events older than EVENTS_RETENTION seconds, which reconnecting
+    clients no longer need. Requires a commit afterwards."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=app.config['EVENTS_RETENTION'])
+    return models.Event.query.filter(models.Event.timestamp < cutoff) \
+                             .delete(synchronize_session=False)
+
+def start_relay():
+    """Start a thread passing on events from other processes every
+    EVENTS_POLL_INTERVAL seconds, and deleting old ones, for as long as the
+    process runs."""
+    with app.app_context():
+        last_id = app.db.session.query(app.db.func.max(models.Event.id)).scalar() or 0
+
+    def relay():
+        nonlocal last_id
+        pruned = datetime.datetime.now()
+        while True:
+            time.sleep(app.config['EVENTS_POLL_INTERVAL'])
+            try:
+                with app.app_context():
+                    last_id = relay_once(last_id)
+                    if datetime.datetime.now() - pruned > datetime.timedelta(minutes=1):
+                        prune()
+                        app.db.session.commit()
+                        pruned = datetime.datetime.now()
+            except Exception: # pylint: disable=broad-except
+                # Keep relaying; the database may be back by the next poll.
+                app.logger.exception("Failed to relay events")
+
+    thread = threading.Thread(target=relay, name='collegejump-events', daemon=True)
+    thread.start()
+    return thread
@@ -2,13 +2,14 @@ import datetime
 import os
 from urllib.parse import  urlparse, urljoin
 from flask_wtf import FlaskForm
+from flask_login import current_user
 from flask_wtf.file import FileField, FileRequired
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from wtforms import fields, validators, widgets
 from wtforms.validators import StopValidation, ValidationError
 import flask
 
-from collegejump import app, models
+from collegejump import app, models, uploads
 
 def is_safe_url(target):
     ref_url = urlparse(flask.request.host_url)
@@ -17,6 +18,12 @@ def is_safe_url(target):
            ref_url.netloc == test_url.netloc
 
 
+def semester_choices():
+    """Return (id, name) choices for every semester, in order."""
+    return app.db.session.query(models.Semester.id, models.Semester.name) \
+                         .order_by(models.Semester.order).all()
+
+
 class UserField(fields.StringField):
     """Field for specifying a user by email. Automatically ensures that user is
     present in the database, and allows access to the user model as `field.user()`.
@@ -89,6 +96,45 @@ class LoginForm(RedirectForm):
             if not form.user_model.check_password(field.data):
                 raise ValidationError('Incorrect password')
 
+class UploadField(fields.HiddenField):
+    """Hidden field holding the id of a finished resumable upload, filled in by
+    the page's script in place of a file field's own data. Ensures the upload
+    is the current user's and complete, and allows claiming its file as
+    `field.claim()`.
+    """
+
+    def __init__(self, purpose, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.purpose = purpose
+        self.upload = None
+
+    # pylint: disable=unused-argument
+    def post_validate(self, form, validation_stopped):
+        if validation_stopped or not self.data:
+            return
+        try:
+            upload_id = int(self.data)
+        except ValueError:
+            raise ValidationError("Invalid upload")
+        self.upload = uploads.find(upload_id, current_user.id, self.purpose)
+        if self.upload is None:
+            raise ValidationError("The upload has expired; please choose the file again")
+        if not self.upload.complete:
+            raise ValidationError("The upload is incomplete; please try again")
+
+    def claim(self):
+        """Return the name and data of the uploaded file, or None if there is
+        none, deleting the upload. Requires a commit afterwards."""
+        if self.upload is None:
+            return None
+        return uploads.claim(self.upload)
+
+def upload_field_options(purpose, field_name):
+    # Return attributes for a file field, telling the page's script to upload
+    # files chosen in it in chunks, filling in `field_name` when done.
+    return {'data-upload-purpose': purpose, 'data-upload-field': field_name}
+
+
 class WeekForm(FlaskForm):
     """A form for filling out a single week in a semester."""
     header = fields.StringField(
@@ -116,11 +162,19 @@ class WeekForm(FlaskForm):
 
     new_document = FileField(description="Add one file for download by students. "
                                          "Multiple files may be added by submitting "
-                                         "this form multiple times.")
+                                         "this form multiple times.",
+                             render_kw=upload_field_options('document', 'document_upload'))
+    document_upload = UploadField('document')
 
     submit = fields.SubmitField('Submit')
     delete = fields.SubmitField('Delete')
 
+class MoveWeekForm(FlaskForm):
+    """A form for moving a week to another position in its semester."""
+    week_num = fields.IntegerField('Week', [validators.required(),
+                                            validators.NumberRange(min=1)])
+    submit = fields.SubmitField('Move')
+
 class SemesterForm(FlaskForm):
     """A form for filling out an entire semester's syllabus at once."""
     name = fields.StringField('Name', [
@@ -151,6 +205,11 @@ class SemesterForm(FlaskForm):
         except NoResultFound:
             pass
 
+class CloneSemesterForm(SemesterForm):
+    """A form for creating a semester with a copy of another's syllabus."""
+    submit = fields.SubmitField('Clone')
+    delete = None
+
 class UserForm(FlaskForm):
     name = fields.StringField('Name', [
         validators.required(),
@@ -195,15 +254,16 @@ class UserForm(FlaskForm):
             self.password.validators.append(validators.optional())
             self.password.flags.required = False
 
-    def populate_semesters(self):
+    def populate_semesters(self, choices=None):
         """Populate options for semester enrollment. Must be called after instantiation and before
-        rendering.
+        rendering. If the (id, name) `choices` are already known, they are used
+        rather than being queried.
         """
         # Sometimes, fields get deleted for tweaking. Make sure the one we're
         # operating one is not, otherwise do nothing.
         if self.semesters_enrolled is not None:
-            self.semesters_enrolled.choices = [(s.id, s.name) for s \
-                    in models.Semester.query.order_by('order')]
+            self.semesters_enrolled.choices = choices if choices is not None \
+                    else semester_choices()
 
     def to_user_model(self, user=None):
         """Create a new user model, or fill out data in an existing one."""
@@ -266,6 +326,38 @@ class UserForm(FlaskForm):
             if not exists:
                 raise ValidationError('No user exists with email {}'.format(mentor_email))
 
+class SearchForm(FlaskForm):
+    """A form for searching everything the user can see, submitted by GET."""
+    class Meta: # pylint: disable=too-few-public-methods
+        csrf = False
+
+    q = fields.StringField('Search', [validators.optional()],
+                           render_kw={'placeholder': "Search"})
+    submit = fields.SubmitField('Search')
+
+class UserSearchForm(FlaskForm):
+    """A form for searching and filtering the user directory, submitted by
+    GET."""
+    class Meta: # pylint: disable=too-few-public-methods
+        csrf = False
+
+    search = fields.StringField('Search', [validators.optional()],
+                                filters=[lambda s: s.strip() if s else s],
+                                render_kw={'placeholder': "Start of name or email"})
+    role = fields.SelectField('Role', [validators.optional()],
+                              choices=[('', 'Any')] + [(r, r.title()) for r in models.User.ROLES])
+    semester = fields.SelectField('Semester', [validators.optional()], coerce=int,
+                                  choices=[])
+    mentor = UserField('Mentor Email', [validators.optional()],
+                       filters=[lambda s: s.lower() if s else s],
+                       render_kw={'placeholder': "Mentor email"})
+    submit = fields.SubmitField('Search')
+
+    def populate_semesters(self, choices):
+        """Populate options for the semester filter. Must be called after
+        instantiation and before validation."""
+        self.semester.choices = [(0, 'Any')] + list(choices)
+
 class FirstSetupUserInfoForm(UserForm):
     setup_key = fields.StringField('Setup Key', [
         validators.required(),
@@ -312,7 +404,9 @@ class AnnouncementForm(FlaskForm):
 
 class AnswerForm(FlaskForm):
     response = fields.TextAreaField('Response')
-    attachment = FileField('Attachment', description="Attach a file.")
+    attachment = FileField('Attachment', description="Attach a file.",
+                           render_kw=upload_field_options('submission', 'upload'))
+    upload = UploadField('submission')
     submit = fields.SubmitField('Submit')
 
     def to_submission_model(self, assignment, author, submission=None, timestamp=None):
@@ -328,7 +422,10 @@ class AnswerForm(FlaskForm):
         submission.author = author
         submission.assignment = assignment
 
-        if self.attachment.has_file():
+        uploaded = self.upload.claim()
+        if uploaded is not None:
+            submission.filename, submission.filedata = uploaded
+        elif self.attachment.has_file():
             submission.filename = os.path.basename(self.attachment.data.filename)
             submission.filedata = self.attachment.data.stream.read()
         else:
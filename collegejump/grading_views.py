@@ -0,0 +1,37 @@
+# The grading queue, where mentors and admins find the submissions awaiting
+# their feedback.
+import flask
+from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload, subqueryload
+
+from collegejump import app, models
+
+# Submissions listed per page of the grading queue.
+GRADING_PER_PAGE = 20
+
+@app.route('/grading')
+@login_required
+def grading_page():
+    """List the submissions awaiting feedback from a mentor or admin, oldest
+    first, with the number waiting in each week."""
+    if not current_user.admin and not current_user.mentee_ids:
+        return flask.abort(403)
+
+    week_id = flask.request.args.get('week', type=int)
+    page = max(flask.request.args.get('page', 1, type=int), 1)
+
+    pending = current_user.pending_feedback(week_id)
+    total = pending.order_by(None).count()
+    # Load everything the page shows up front. Attachments are never loaded.
+    submissions = pending.options(joinedload(models.Submission.author),
+                                  joinedload(models.Submission.assignment),
+                                  subqueryload(models.Submission.all_feedback)) \
+                         .limit(GRADING_PER_PAGE) \
+                         .offset((page - 1) * GRADING_PER_PAGE) \
+                         .all()
+
+    return flask.render_template('grading.html',
+                                 submissions=submissions,
+                                 weeks=current_user.pending_feedback_by_week(),
+                                 week_id=week_id, total=total, page=page,
+                                 pages=max((total - 1) // GRADING_PER_PAGE + 1, 1))
@@ -0,0 +1,58 @@
+# Health checks for load balancers and proxies. They are answered before
+# requests reach Flask, so they never touch sessions, templates or the sidebar,
+# and stay cheap however the site itself is doing.
+from sqlalchemy.exc import SQLAlchemyError
+
+from collegejump import database
+
+LIVENESS_PATH = '/healthz'
+READINESS_PATH = '/readyz'
+
+class HealthCheckMiddleware(object):
+    """WSGI middleware answering LIVENESS_PATH whenever the process is up, and
+    READINESS_PATH when the database can be reached and is up to date with
+    the models. Other requests are passed on to the application.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        # Once the schema has been seen to be current, it stays that way, so
+        # later checks only ping the database.
+        self._schema_current = False
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == LIVENESS_PATH:
+            return _respond(start_response, '200 OK', 'ok')
+        elif path == READINESS_PATH:
+            problem = self.readiness_problem()
+            if problem:
+                return _respond(start_response, '503 Service Unavailable', problem)
+            return _respond(start_response, '200 OK', 'ready')
+        return self.wsgi_app(environ, start_response)
+
+    def readiness_problem(self):
+        """Return why the application can't serve requests, or None if it
+        can."""
+        try:
+            with self.app.app_context():
+                with self.app.db.engine.connect() as connection:
+                    connection.execute('SELECT 1')
+                    if not self._schema_current:
+                        missing = next(database.missing_schema(connection), None)
+                        if missing is not None:
+                            return 'database needs upgrading: {}.{} is missing'.format(
+                                missing[0].name, missing[1].name)
+                        self._schema_current = True
+        except SQLAlchemyError as error:
+            self.app.logger.warning("Readiness check failed: %s", error)
+            return 'database unavailable'
+        return None
+
+def _respond(start_response, status, text):
+    body = (text + '\n').encode('utf-8')
+    start_response(status, [('Content-Type', 'text/plain; charset=utf-8'),
+                            ('Content-Length', str(len(body))),
+                            ('Cache-Control', 'no-store')])
+    return [body]
@@ -0,0 +1,49 @@
+# Limits on the size of request bodies. Every view accepts bodies up to
+# MAX_CONTENT_LENGTH bytes, unless it is marked with `limit_body()` to take
+# files; bodies declared larger are refused before any of them is read. Files
+# in forms are spooled to temporary files once they pass FORM_SPOOL_SIZE, so
+# that large uploads aren't held in memory.
+import tempfile
+
+import flask
+
+from collegejump import app
+
+def limit_body(*config_keys):
+    """Decorate a view to accept request bodies up to the sum of the given
+    configuration values, such as the largest file it takes plus
+    MAX_FORM_MEMORY_SIZE for the rest of the form. Must be applied directly
+    below `app.route`."""
+    def decorator(func):
+        func.body_limit_keys = config_keys
+        return func
+    return decorator
+
+def describe_size(size):
+    """Return a size in bytes as a short readable string."""
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            return '{:g} {}'.format(round(size, 1), unit)
+        size /= 1024
+    return '{:g} GB'.format(round(size, 1))
+
+class LimitedRequest(flask.Request):
+    """A request which knows how large a body its view accepts, and spools
+    large files in forms to disk."""
+
+    @property
+    def max_content_length(self):
+        view = app.view_functions.get(self.endpoint) if self.url_rule else None
+        keys = getattr(view, 'body_limit_keys', None)
+        if keys is None:
+            return app.config['MAX_CONTENT_LENGTH']
+        return sum(app.config[key] for key in keys)
+
+    @property
+    def max_form_memory_size(self):
+        return app.config['MAX_FORM_MEMORY_SIZE']
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=app.config['FORM_SPOOL_SIZE'],
+                                             mode='wb+')
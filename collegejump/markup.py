@@ -0,0 +1,24 @@
+import hashlib
+
+from collegejump.cache import LRUCache
+
+# Rendered HTML of recently seen Markdown source which wasn't pre-rendered,
+# keyed by a hash of the source.
+_rendered = LRUCache(maxsize=512)
+
+def render(source):
+    """Render Markdown source into an HTML string."""
+    # Imported here, since it is slow to import and most uses of the package
+    # never render anything.
+    import markdown
+    return markdown.markdown(source or '')
+
+def render_cached(source):
+    """Render Markdown source, reusing the HTML if the same source was rendered
+    recently."""
+    key = hashlib.sha1((source or '').encode('utf-8')).hexdigest()
+    html = _rendered.get(key)
+    if html is None:
+        html = render(source)
+        _rendered.set(key, html)
+    return html
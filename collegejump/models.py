@@ -1,22 +1,32 @@
+import collections
 import datetime
 import io
+import itertools
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.types import TypeDecorator
 
-from collegejump import app
+from collegejump import app, cache, compression, markup
+from collegejump.cache import LRUCache
 
 # pylint: disable=invalid-name
 mentorships = app.db.Table('mentorships', app.db.metadata,
                            app.db.Column('mentee_id', app.db.Integer,
                                          app.db.ForeignKey('user.id')),
                            app.db.Column('mentor_id', app.db.Integer,
-                                         app.db.ForeignKey('user.id')))
+                                         app.db.ForeignKey('user.id')),
+                           app.db.Index('ix_mentorships_mentee_id', 'mentee_id'),
+                           app.db.Index('ix_mentorships_mentor_id', 'mentor_id'))
 
 enrollment = app.db.Table('enrollment', app.db.metadata,
                           app.db.Column('user_id', app.db.Integer,
                                         app.db.ForeignKey('user.id')),
                           app.db.Column('semester_id', app.db.Integer,
-                                        app.db.ForeignKey('semester.id')))
+                                        app.db.ForeignKey('semester.id')),
+                          app.db.Index('ix_enrollment_user_id', 'user_id'),
+                          app.db.Index('ix_enrollment_semester_id', 'semester_id'))
 
 week_assignments = app.db.Table('week_assignments', app.db.metadata,
                                 app.db.Column('week_id',
@@ -24,7 +34,9 @@ week_assignments = app.db.Table('week_assignments', app.db.metadata,
                                               app.db.ForeignKey('week.id')),
                                 app.db.Column('assignment_id',
                                               app.db.Integer,
-                                              app.db.ForeignKey('assignment.id')))
+                                              app.db.ForeignKey('assignment.id')),
+                                app.db.Index('ix_week_assignments_assignment_id',
+                                             'assignment_id'))
 
 week_documents = app.db.Table('week_documents', app.db.metadata,
                               app.db.Column('week_id',
@@ -35,6 +47,63 @@ week_documents = app.db.Table('week_documents', app.db.metadata,
                                             app.db.ForeignKey('document.id')))
 
 
+def _prefix_of(column, prefix):
+    """Return a condition that `column` starts with `prefix`. This is written
+    as a range rather than with LIKE, so that an index on the column is used.
+    """
+    return app.db.and_(column >= prefix,
+                       column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+def _updated_at_column():
+    """Return a column recording when a row was last changed. Views use these
+    to tell clients whether a page has changed since they last saw it."""
+    return app.db.Column(app.db.DateTime(), default=datetime.datetime.now,
+                         onupdate=datetime.datetime.now)
+
+class CompressedBinary(TypeDecorator):
+    """Binary data, stored compressed when that saves space. Values stored
+    before compression, or which wouldn't shrink, are stored as they are."""
+    impl = app.db.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        return compression.pack(bytes(value)) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return compression.unpack(value) if value is not None else None
+
+    def process_literal_param(self, value, dialect):
+        raise NotImplementedError("Compressed values can't be written as SQL literals")
+
+class CompressedText(TypeDecorator):
+    """Text, stored as compressed UTF-8 when that saves space, and otherwise as
+    plain text."""
+    impl = app.db.Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        packed = compression.pack(value.encode('utf-8'))
+        return packed if compression.is_packed(packed) else value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return compression.unpack(value).decode('utf-8')
+        return value
+
+    def process_literal_param(self, value, dialect):
+        raise NotImplementedError("Compressed values can't be written as SQL literals")
+
+
+def _bcrypt():
+    # Return the application's bcrypt, setting it up on first use for scripts
+    # which skipped the web layer, so those which never hash a password don't
+    # import it.
+    if not hasattr(app, 'bcrypt'):
+        from flask_bcrypt import Bcrypt
+        app.bcrypt = Bcrypt(app)
+    return app.bcrypt
+
+
 class User(app.db.Model, UserMixin):
     NAME_MAX_LENGTH = 128
     EMAIL_MAX_LENGTH = 128
@@ -56,6 +125,13 @@ class User(app.db.Model, UserMixin):
 
     semesters = app.db.relationship('Semester', secondary=enrollment)
 
+    # Supports listing and searching users by name, ignoring case. Emails are
+    # stored in lower case, and indexed by their uniqueness.
+    __table_args__ = (app.db.Index('ix_user_name_lower', app.db.func.lower(name)),)
+
+    # Roles users can be filtered by in the directory.
+    ROLES = ('admin', 'mentor', 'student')
+
     def __init__(self, email, plaintext, name=None, admin=False):
         self.name = name
         self.email = email.lower()
@@ -76,12 +152,163 @@ class User(app.db.Model, UserMixin):
     # when accessing the property like a regular variable.
     @password.setter
     def _set_password(self, plaintext):
-        self._password = app.bcrypt.generate_password_hash(plaintext)
+        self._password = _bcrypt().generate_password_hash(plaintext)
 
     def check_password(self, plaintext):
         """Check whether an entered plaintext password matches the stored hashed
         copy. Returns True or False."""
-        return app.bcrypt.check_password_hash(self.password, plaintext)
+        return _bcrypt().check_password_hash(self.password, plaintext)
+
+    @classmethod
+    def directory(cls, search=None, role=None, semester_id=None, mentor_id=None):
+        """Return a query for the id, name, email and admin flag of users,
+        ordered by name, and optionally filtered. `search` matches the start of
+        either the name or the email, ignoring case. `role` is one of `ROLES`,
+        where students are those who are neither admins nor mentors.
+        """
+        name = app.db.func.lower(cls.name)
+        query = app.db.session.query(cls.id, cls.name, cls.email, cls.admin) \
+                              .order_by(name, cls.id)
+
+        if search:
+            search = search.lower()
+            query = query.filter(app.db.or_(_prefix_of(name, search),
+                                            _prefix_of(cls.email, search)))
+
+        mentor_ids = app.db.session.query(mentorships.c.mentor_id)
+        if role == 'admin':
+            query = query.filter(cls.admin == True) # pylint: disable=singleton-comparison
+        elif role == 'mentor':
+            query = query.filter(cls.id.in_(mentor_ids))
+        elif role == 'student':
+            query = query.filter(cls.admin != True, # pylint: disable=singleton-comparison
+                                 ~cls.id.in_(mentor_ids))
+
+        if semester_id is not None:
+            query = query.filter(cls.id.in_(
+                app.db.session.query(enrollment.c.user_id)
+                .filter(enrollment.c.semester_id == semester_id)))
+
+        if mentor_id is not None:
+            query = query.filter(cls.id.in_(
+                app.db.session.query(mentorships.c.mentee_id)
+                .filter(mentorships.c.mentor_id == mentor_id)))
+
+        return query
+
+    def principal(self):
+        """Return a UserPrincipal describing this user."""
+        return UserPrincipal(self.id, self.admin,
+                             [m.id for m in self.mentees],
+                             [s.id for s in self.semesters],
+                             model=self)
+
+    def interested_semesters(self):
+        """See `UserPrincipal.interested_semesters`."""
+        return self.principal().interested_semesters()
+
+    def gradeable_submissions(self):
+        """See `UserPrincipal.gradeable_submissions`."""
+        return self.principal().gradeable_submissions()
+
+    def submissions_for_feedback(self, assignment):
+        """See `UserPrincipal.submissions_for_feedback`."""
+        return self.principal().submissions_for_feedback(assignment)
+
+    def pending_feedback(self, week_id=None):
+        """See `UserPrincipal.pending_feedback`."""
+        return self.principal().pending_feedback(week_id)
+
+    def pending_feedback_by_week(self):
+        """See `UserPrincipal.pending_feedback_by_week`."""
+        return self.principal().pending_feedback_by_week()
+
+    @staticmethod
+    @app.login_manager.user_loader
+    def load_user(user_id):
+        return UserPrincipal.load(int(user_id))
+
+    @classmethod
+    def transform_csv_row(cls, row):
+        row['_password'] = row['_password'].lstrip('b\'').rstrip('\'')
+        return row
+
+class UserPrincipal(UserMixin):
+    """A lightweight stand-in for a logged-in User, holding only what is needed
+    for authorization and navigation on every request: the user's id, admin
+    flag, mentee ids and enrolled semester ids.
+
+    The data behind principals is kept in a short-lived per-process cache, so
+    most requests never load the User itself. Any other attribute is read from
+    the full User model, which is loaded on first use. Principals are
+    read-only: changes are made to `model`.
+    """
+    # Cache of user id -> (admin, mentee ids, semester ids).
+    _cache = LRUCache(maxsize=1024)
+
+    def __init__(self, user_id, admin, mentee_ids, semester_ids, model=None):
+        self.id = user_id
+        self.admin = admin
+        self.mentee_ids = frozenset(mentee_ids)
+        self.semester_ids = frozenset(semester_ids)
+        self._model = model
+
+    def __repr__(self):
+        return '<UserPrincipal {!r}>'.format(self.id)
+
+    def __getattr__(self, name):
+        # Only called for attributes the principal doesn't have itself.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def __setattr__(self, name, value):
+        # Writes would otherwise land on the principal and be lost, rather
+        # than reach the User they appear to change.
+        if name not in ('id', 'admin', 'mentee_ids', 'semester_ids', '_model'):
+            raise AttributeError("can't set {!r} on a principal; set it on its model"
+                                 .format(name))
+        super().__setattr__(name, value)
+
+    @property
+    def model(self):
+        """The full User model, loaded from the database on first access."""
+        if self._model is None:
+            self._model = User.query.get(self.id)
+        return self._model
+
+    @classmethod
+    def load(cls, user_id):
+        """Return the principal for a user id, or None if there is no such
+        user. Uses the cache when possible."""
+        data = cls._cache.get(user_id)
+        if data is None:
+            row = app.db.session.query(User.admin).filter(User.id == user_id).first()
+            if row is None:
+                return None
+            mentee_ids = app.db.session.query(mentorships.c.mentee_id) \
+                                       .filter(mentorships.c.mentor_id == user_id)
+            semester_ids = app.db.session.query(enrollment.c.semester_id) \
+                                         .filter(enrollment.c.user_id == user_id)
+            data = (bool(row.admin),
+                    frozenset(i for (i,) in mentee_ids),
+                    frozenset(i for (i,) in semester_ids))
+            cls._cache.set(user_id, data, ttl=app.config['USER_CACHE_TTL'])
+
+        return cls(user_id, *data)
+
+    def version(self):
+        """Return a tuple which changes whenever the principal does."""
+        return (self.id, self.admin, sorted(self.mentee_ids), sorted(self.semester_ids))
+
+    @classmethod
+    def forget(cls, user_ids=None):
+        """Drop cached principals for the given user ids, or all of them."""
+        if user_ids is None:
+            cls._cache.clear()
+        else:
+            for user_id in user_ids:
+                cls._cache.pop(user_id)
 
     def interested_semesters(self):
         """Return a generator for all semesters in descending order in which the
@@ -93,43 +320,83 @@ class User(app.db.Model, UserMixin):
             # If the user is an admin, show all semesters.
             return Semester.query.order_by(Semester.order.desc())
 
-        elif not self.mentees:
+        elif not self.mentee_ids:
             # If the user is a student, show just the enrolled semesters.
-            return sorted(self.semesters, key=lambda s: s.order, reverse=True)
+            return Semester.query.filter(Semester.id.in_(self.semester_ids)) \
+                                 .order_by(Semester.order.desc())
 
         # If the user is a mentor, include themselves and their students as
         # persons of interest, then query on those semesters.
-        poi = [self] + self.mentees
-        poi_ids = [p.id for p in poi]
+        poi_ids = [self.id] + list(self.mentee_ids)
         return app.db.session.query(Semester) \
                              .join(enrollment) \
                              .filter(enrollment.c.user_id.in_(poi_ids)) \
+                             .distinct() \
                              .order_by(Semester.order.desc())
 
-    def submissions_for_feedback(self, assignment):
-        """Return a generator for all submissions on the assignment in
-        descending order of timestamp which the user has permission to give
-        feedback on. For mentors, this is any submission their mentees have
-        made. For admins, this is all submissions.
+    def is_interested_in(self, semester_id):
+        """Return whether the semester is among `interested_semesters()`,
+        without listing them all."""
+        if self.admin or semester_id in self.semester_ids:
+            return True
+        elif not self.mentee_ids:
+            return False
+        return app.db.session.query(
+            app.db.session.query(enrollment)
+            .filter(enrollment.c.semester_id == semester_id,
+                    enrollment.c.user_id.in_(self.mentee_ids)).exists()).scalar()
+
+    def gradeable_submissions(self):
+        """Return a query for every submission the user may give feedback on.
+        For mentors, this is any submission their mentees have made. For
+        admins, this is all submissions.
         """
+        query = Submission.query
         if self.admin:
-            return sorted(assignment.submissions, key=lambda s: s.timestamp, reverse=True)
-
-        mentee_ids = [m.id for m in self.mentees]
-        return app.db.session.query(Submission) \
-                             .filter_by(assignment=assignment) \
-                             .filter(Submission.author_id.in_(mentee_ids)) \
-                             .order_by(Submission.timestamp.desc())
+            return query
+        elif not self.mentee_ids:
+            return query.filter(app.db.false())
+        return query.filter(Submission.author_id.in_(self.mentee_ids))
 
-    @staticmethod
-    @app.login_manager.user_loader
-    def load_user(user_id):
-        return User.query.get(user_id)
-
-    @classmethod
-    def transform_csv_row(cls, row):
-        row['_password'] = row['_password'].lstrip('b\'').rstrip('\'')
-        return row
+    def submissions_for_feedback(self, assignment):
+        """Return a query for the submissions on the assignment which the user
+        may give feedback on, newest first, with their authors and feedback
+        loaded along with them.
+        """
+        return self.gradeable_submissions() \
+                   .filter(Submission.assignment_id == assignment.id) \
+                   .options(joinedload(Submission.author),
+                            subqueryload(Submission.all_feedback).joinedload(Feedback.author)) \
+                   .order_by(Submission.timestamp.desc(), Submission.id.desc())
+
+    def pending_feedback(self, week_id=None):
+        """Return a query for the submissions the user may give feedback on
+        which have none yet, oldest first, optionally only those for the
+        assignments of one week.
+        """
+        query = self.gradeable_submissions().filter(~Submission.all_feedback.any())
+        if week_id is not None:
+            query = query.filter(Submission.assignment_id.in_(
+                app.db.session.query(week_assignments.c.assignment_id)
+                .filter(week_assignments.c.week_id == week_id)))
+        return query.order_by(Submission.timestamp, Submission.id)
+
+    def pending_feedback_by_week(self):
+        """Return the number of submissions awaiting feedback from the user for
+        each week with any, as (week id, semester name, week number, header,
+        count) rows in syllabus order.
+        """
+        return self.pending_feedback().order_by(None) \
+                   .join(week_assignments,
+                         week_assignments.c.assignment_id == Submission.assignment_id) \
+                   .join(Week, Week.id == week_assignments.c.week_id) \
+                   .join(Semester, Semester.id == Week.semester_id) \
+                   .with_entities(Week.id, Semester.name, Week.week_num, Week.header,
+                                  app.db.func.count(Submission.id)) \
+                   .group_by(Week.id, Semester.name, Semester.order,
+                             Week.week_num, Week.header) \
+                   .order_by(Semester.order.desc(), Week.week_num) \
+                   .all()
 
 class Announcement(app.db.Model):
     TITLE_MAX_LENGTH = 128
@@ -143,6 +410,14 @@ class Announcement(app.db.Model):
     author_id = app.db.Column(app.db.Integer, app.db.ForeignKey('user.id'))
     author = app.db.relationship('User')
 
+    # Rendered HTML of `content`, kept up to date automatically.
+    content_html = app.db.Column(app.db.Text)
+
+    updated_at = _updated_at_column()
+
+    # Supports listing announcements newest first, a page at a time.
+    __table_args__ = (app.db.Index('ix_announcement_timestamp_id', 'timestamp', 'id'),)
+
     def __init__(self, author_email, title, content, timestamp=None):
         self.author = User.query.filter_by(email=author_email).one()
         self.title = title
@@ -155,6 +430,24 @@ class Announcement(app.db.Model):
     def __repr__(self):
         return '<Announcement {!r}>'.format(self.title)
 
+    @classmethod
+    def page(cls, before=None, per_page=20):
+        """Return a list of up to `per_page` announcements, newest first,
+        starting after the (timestamp, id) position `before` if given, and
+        whether there are any older ones.
+        """
+        query = cls.query.options(joinedload(cls.author)) \
+                         .order_by(cls.timestamp.desc(), cls.id.desc())
+        if before is not None:
+            timestamp, announcement_id = before
+            query = query.filter(app.db.or_(
+                cls.timestamp < timestamp,
+                app.db.and_(cls.timestamp == timestamp, cls.id < announcement_id)))
+
+        # Fetch one extra announcement to learn whether there are more.
+        announcements = query.limit(per_page + 1).all()
+        return announcements[:per_page], len(announcements) > per_page
+
     @classmethod
     def transform_csv_row(cls, row):
         row['timestamp'] = datetime.datetime.strptime(row['timestamp'],
@@ -171,6 +464,13 @@ class Semester(app.db.Model):
     # for ordering semesters
     order = app.db.Column(app.db.Integer, unique=True)
 
+    updated_at = _updated_at_column()
+
+    # If the semester's content has been moved out of the database by
+    # `archive.archive_semester()`, the name of the file holding it, within
+    # ARCHIVE_DIR.
+    archive_path = app.db.Column(app.db.String(255), nullable=True)
+
     def __init__(self, name, order):
         self.name = name
         self.order = order
@@ -178,6 +478,43 @@ class Semester(app.db.Model):
     def __repr__(self):
         return '<Semester {!r}>'.format(self.name)
 
+    def clone(self, name, order):
+        """Create a semester with the given name and order, holding copies of
+        this semester's weeks and their assignments. The copies share this
+        semester's documents rather than duplicating their data. Rows are
+        copied in bulk, as part of the current transaction."""
+        clone = Semester(name, order)
+        app.db.session.add(clone)
+        app.db.session.flush()
+
+        week_ids = [i for (i,) in app.db.session.query(Week.id)
+                    .filter(Week.semester_id == self.id)]
+        if not week_ids:
+            return clone
+        assignment_ids = [i for (i,) in app.db.session.query(week_assignments.c.assignment_id)
+                          .filter(week_assignments.c.week_id.in_(week_ids)).distinct()]
+
+        # Copies are numbered after every existing row, in the same order as
+        # the originals, so links between them are copied by adding the same
+        # offsets to both ends.
+        week_offset = _id_offset(Week, week_ids)
+        assignment_offset = _id_offset(Assignment, assignment_ids)
+
+        week, assignment = Week.__table__, Assignment.__table__
+        _copy_rows(week, week.c.id.in_(week_ids),
+                   id=week.c.id + week_offset,
+                   semester_id=app.db.literal(clone.id),
+                   updated_at=app.db.literal(datetime.datetime.now()))
+        if assignment_ids:
+            _copy_rows(assignment, assignment.c.id.in_(assignment_ids),
+                       id=assignment.c.id + assignment_offset)
+        _copy_rows(week_assignments, week_assignments.c.week_id.in_(week_ids),
+                   week_id=week_assignments.c.week_id + week_offset,
+                   assignment_id=week_assignments.c.assignment_id + assignment_offset)
+        _copy_rows(week_documents, week_documents.c.week_id.in_(week_ids),
+                   week_id=week_documents.c.week_id + week_offset)
+        return clone
+
 class Week(app.db.Model):
     HEADER_MAX_LENGTH = 64
     INTRO_MAX_LENGTH = 1024
@@ -189,6 +526,10 @@ class Week(app.db.Model):
 
     header = app.db.Column(app.db.String(HEADER_MAX_LENGTH))
     intro = app.db.Column(app.db.String(INTRO_MAX_LENGTH))
+    # Rendered HTML of `intro`, kept up to date automatically.
+    intro_html = app.db.Column(app.db.Text)
+
+    updated_at = _updated_at_column()
 
     semester = app.db.relationship('Semester',
                                    backref=app.db.backref('weeks', order_by=week_num))
@@ -196,7 +537,10 @@ class Week(app.db.Model):
     assignments = app.db.relationship('Assignment', secondary=week_assignments, uselist=True)
     documents = app.db.relationship('Document', secondary=week_documents)
 
-    __table_args__ = tuple(app.db.UniqueConstraint('semester_id', 'week_num'))
+    # A unique index rather than a constraint, so that `upgrade_db()` adds it to
+    # existing databases.
+    __table_args__ = (app.db.Index('ux_week_semester_id_week_num',
+                                   'semester_id', 'week_num', unique=True),)
 
     def __init__(self, semester_id, week_num, header, intro):
         self.semester_id = semester_id
@@ -207,6 +551,63 @@ class Week(app.db.Model):
     def __repr__(self):
         return '<Week {!r} in {!r}>'.format(self.week_num, self.semester.name)
 
+    @classmethod
+    def next_week_num(cls, semester_id):
+        """Return the number a week appended to the semester would take."""
+        last = app.db.session.query(app.db.func.max(cls.week_num)) \
+                             .filter(cls.semester_id == semester_id).scalar()
+        return (last or 0) + 1
+
+    @classmethod
+    def _renumber(cls, semester_id, week_num, low, high=None):
+        # Give the weeks numbered from `low` through `high`, or through the
+        # end, the number computed by the `week_num` expression, in one pass
+        # over the rows. The database checks uniqueness row by row, so the new
+        # numbers are first written negated, where they can't collide with any
+        # others, then flipped back. Moved weeks count as updated, since their
+        # pages show the new numbers.
+        table = cls.__table__
+        selected = table.c.week_num >= low
+        if high is not None:
+            selected &= table.c.week_num <= high
+        app.db.session.execute(
+            table.update()
+            .where(table.c.semester_id == semester_id)
+            .where(selected)
+            .values(week_num=-week_num, updated_at=datetime.datetime.now()))
+        app.db.session.execute(
+            table.update()
+            .where(table.c.semester_id == semester_id)
+            .where(table.c.week_num < 0)
+            .values(week_num=-table.c.week_num))
+
+    def move_to(self, week_num):
+        """Move this week to position `week_num` in its semester, shifting the
+        weeks between its old and new positions to close the gap. Positions past
+        the end move it to the end. Other weeks loaded in the session keep their
+        old numbers until it is committed."""
+        last = Week.next_week_num(self.semester_id) - 1
+        week_num = max(1, min(week_num, last))
+        if week_num == self.week_num:
+            return
+
+        # This week takes the new position, and those it passes step towards
+        # the position it left.
+        table = Week.__table__
+        step = -1 if week_num > self.week_num else 1
+        app.db.session.flush()
+        Week._renumber(self.semester_id,
+                       app.db.case([(table.c.id == self.id, week_num)],
+                                   else_=table.c.week_num + step),
+                       min(self.week_num, week_num), max(self.week_num, week_num))
+        app.db.session.expire(self, ['week_num', 'updated_at'])
+
+    def remove(self):
+        """Delete this week, and renumber the weeks after it to close the gap."""
+        app.db.session.delete(self)
+        app.db.session.flush()
+        Week._renumber(self.semester_id, Week.__table__.c.week_num - 1, self.week_num + 1)
+
 class Assignment(app.db.Model):
     NAME_MAX_LENGTH = 64
     INSTRUCTIONS_MAX_LENGTH = 4096
@@ -215,6 +616,8 @@ class Assignment(app.db.Model):
     name = app.db.Column(app.db.String(NAME_MAX_LENGTH))
     instructions = app.db.Column(app.db.String(INSTRUCTIONS_MAX_LENGTH))
     questions = app.db.Column(app.db.Text)  # a JSON blob
+    # Rendered HTML of `instructions`, kept up to date automatically.
+    instructions_html = app.db.Column(app.db.Text)
 
 
 class Document(app.db.Model):
@@ -222,7 +625,8 @@ class Document(app.db.Model):
 
     id = app.db.Column(app.db.Integer, primary_key=True)
     name = app.db.Column(app.db.String(NAME_MAX_LENGTH))
-    data = app.db.Column(app.db.LargeBinary)
+    # Documents are only loaded when they are downloaded.
+    data = app.db.deferred(app.db.Column(CompressedBinary))
 
     def __init__(self, name, data):
         self.name = name
@@ -235,14 +639,33 @@ class Document(app.db.Model):
         """Return a file-like representation of the data of this file."""
         return io.BytesIO(self.data)
 
+def stored_binary(column, row_id):
+    """Return the data of a CompressedBinary column in the row with the given
+    id as it is stored, without decompressing it, or None if there is no such
+    row or it has no data."""
+    table = column.table
+    return app.db.session.execute(
+        app.db.select([app.db.type_coerce(column, app.db.LargeBinary)])
+        .where(table.c.id == row_id)).scalar()
+
+def stream_binary(column, row_id, chunk_size=64 * 1024):
+    """Return the data of a CompressedBinary column in the row with the given
+    id as a generator of chunks, decompressed as they are reached, or None if
+    there is no such row or it has no data."""
+    stored = stored_binary(column, row_id)
+    if stored is None:
+        return None
+    return compression.unpack_stream(stored, chunk_size)
+
 class Submission(app.db.Model):
     FILENAME_MAX_LENGTH = 64
 
     id = app.db.Column(app.db.Integer, primary_key=True)
 
-    text = app.db.Column(app.db.Text)
+    text = app.db.Column(CompressedText)
     filename = app.db.Column(app.db.String(FILENAME_MAX_LENGTH), nullable=True)
-    filedata = app.db.Column(app.db.LargeBinary, nullable=True)
+    # Attachments are only loaded when they are used.
+    filedata = app.db.deferred(app.db.Column(CompressedBinary, nullable=True))
     timestamp = app.db.Column(app.db.DateTime())
 
     author_id = app.db.Column(app.db.Integer, app.db.ForeignKey('user.id'))
@@ -251,6 +674,13 @@ class Submission(app.db.Model):
     assignment_id = app.db.Column(app.db.Integer, app.db.ForeignKey('assignment.id'))
     assignment = app.db.relationship('Assignment', backref='submissions')
 
+    updated_at = _updated_at_column()
+
+    # Support finding submissions by author or assignment, in order.
+    __table_args__ = (app.db.Index('ix_submission_author_id_timestamp', 'author_id', 'timestamp'),
+                      app.db.Index('ix_submission_assignment_id_timestamp',
+                                   'assignment_id', 'timestamp'))
+
     def attachment_file_like(self):
         """Return a file-like representation of the data of this file."""
         return io.BytesIO(self.filedata)
@@ -258,7 +688,7 @@ class Submission(app.db.Model):
 class Feedback(app.db.Model):
     id = app.db.Column(app.db.Integer, primary_key=True)
 
-    text = app.db.Column(app.db.Text)
+    text = app.db.Column(CompressedText)
     timestamp = app.db.Column(app.db.DateTime())
 
     submission_id = app.db.Column(app.db.Integer, app.db.ForeignKey('submission.id'))
@@ -266,3 +696,226 @@ class Feedback(app.db.Model):
 
     author_id = app.db.Column(app.db.Integer, app.db.ForeignKey('user.id'))
     author = app.db.relationship('User')
+
+    updated_at = _updated_at_column()
+
+    # Supports finding the feedback on a submission, or that there is none.
+    __table_args__ = (app.db.Index('ix_feedback_submission_id', 'submission_id'),)
+
+class Upload(app.db.Model):
+    """A file being uploaded in chunks, so that an interrupted upload can be
+    resumed. What has been received is kept in a file in UPLOAD_DIR until the
+    upload is claimed by the submission or document it was for."""
+    PURPOSES = ('submission', 'document')
+    PURPOSE_MAX_LENGTH = 16
+    FILENAME_MAX_LENGTH = 64
+
+    id = app.db.Column(app.db.Integer, primary_key=True)
+    user_id = app.db.Column(app.db.Integer, app.db.ForeignKey('user.id'))
+    purpose = app.db.Column(app.db.String(PURPOSE_MAX_LENGTH))
+    filename = app.db.Column(app.db.String(FILENAME_MAX_LENGTH))
+    # The size of the whole file, and how many bytes have been received.
+    size = app.db.Column(app.db.Integer)
+    received = app.db.Column(app.db.Integer, default=0)
+
+    updated_at = _updated_at_column()
+
+    def __init__(self, user_id, purpose, filename, size):
+        self.user_id = user_id
+        self.purpose = purpose
+        self.filename = filename
+        self.size = size
+        self.received = 0
+
+    def __repr__(self):
+        return '<Upload {!r} of {!r}>'.format(self.id, self.filename)
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+class Event(app.db.Model):
+    """Something a user is told about as it happens, such as feedback on their
+    submission, recorded by `events` so that every process can pass it on to
+    its subscribers, and clients which reconnect can catch up."""
+    KIND_MAX_LENGTH = 32
+    ORIGIN_MAX_LENGTH = 64
+
+    id = app.db.Column(app.db.Integer, primary_key=True)
+    # Who the event is for, or None if it is for everyone.
+    user_id = app.db.Column(app.db.Integer, app.db.ForeignKey('user.id'), nullable=True)
+    kind = app.db.Column(app.db.String(KIND_MAX_LENGTH))
+    data = app.db.Column(app.db.Text)  # a JSON blob
+    timestamp = app.db.Column(app.db.DateTime())
+    # The process which recorded the event, and has already published it.
+    origin = app.db.Column(app.db.String(ORIGIN_MAX_LENGTH))
+
+    # Supports deleting old events. Ids are never reused, even once every
+    # event has been pruned, since relays and reconnecting clients ask for
+    # those after the last id they saw.
+    __table_args__ = (app.db.Index('ix_event_timestamp', 'timestamp'),
+                      {'sqlite_autoincrement': True})
+
+    def __repr__(self):
+        return '<Event {!r} {!r}>'.format(self.id, self.kind)
+
+class Notification(app.db.Model):
+    """An event queued by `notifications` to be emailed to a user, along with
+    any others, in their next digest."""
+    KIND_MAX_LENGTH = 32
+    CLAIM_MAX_LENGTH = 32
+
+    id = app.db.Column(app.db.Integer, primary_key=True)
+    user_id = app.db.Column(app.db.Integer, app.db.ForeignKey('user.id'))
+    kind = app.db.Column(app.db.String(KIND_MAX_LENGTH))
+    data = app.db.Column(app.db.Text)  # a JSON blob
+    created = app.db.Column(app.db.DateTime())
+    # When the digest including it was sent, or None while it is queued.
+    sent_at = app.db.Column(app.db.DateTime(), nullable=True)
+    # Which worker is sending it, and since when, or None while it waits.
+    claimed_by = app.db.Column(app.db.String(CLAIM_MAX_LENGTH), nullable=True)
+    claimed_at = app.db.Column(app.db.DateTime(), nullable=True)
+
+    # Supports finding each recipient's queued notifications.
+    __table_args__ = (app.db.Index('ix_notification_sent_at_user_id', 'sent_at', 'user_id'),)
+
+    def __repr__(self):
+        return '<Notification {!r} {!r}>'.format(self.id, self.kind)
+
+
+# What the week page shows a user besides the week itself: its assignment, the
+# user's own submissions to it, and a page of those they may give feedback on.
+WeekContents = collections.namedtuple('WeekContents',
+                                      'assignment submissions to_grade more_to_grade')
+
+def week_contents(week, principal, page=1, per_page=20):
+    """Gather what the week page shows `principal` for `week`, with authors
+    and feedback loaded, in a fixed number of queries however many
+    submissions there are.
+    """
+    # Only the first assignment of a week is shown.
+    assignment = week.assignments[0] if week.assignments else None
+    if assignment is None:
+        return WeekContents(None, [], [], False)
+
+    submissions = Submission.query \
+            .filter_by(author_id=principal.id, assignment_id=assignment.id) \
+            .options(joinedload(Submission.author),
+                     subqueryload(Submission.all_feedback).joinedload(Feedback.author)) \
+            .order_by(Submission.timestamp.desc(), Submission.id.desc()) \
+            .all()
+
+    # Fetch one extra to learn whether there are more pages.
+    to_grade = principal.submissions_for_feedback(assignment) \
+                        .limit(per_page + 1) \
+                        .offset((page - 1) * per_page) \
+                        .all()
+
+    return WeekContents(assignment, submissions, to_grade[:per_page], len(to_grade) > per_page)
+
+def version_of(query, model):
+    """Return the number of rows matched by a query on `model`, and the latest
+    time any of them was updated. Together, these change whenever a matching
+    row is added, removed or changed.
+    """
+    return tuple(query.with_entities(app.db.func.count(model.id),
+                                     app.db.func.max(model.updated_at)).one())
+
+def _id_offset(model, ids):
+    # Return what to add to `ids` to number copies of their rows after every
+    # row of the model.
+    if not ids:
+        return 0
+    last = app.db.session.query(app.db.func.max(model.id)).scalar()
+    return last - min(ids) + 1
+
+def _copy_rows(table, condition, **values):
+    # Copy the rows of `table` matching `condition` with a single INSERT ...
+    # SELECT, computing the columns named in `values` from the given
+    # expressions instead.
+    names = [column.name for column in table.columns]
+    query = app.db.select([values.get(name, table.c[name]) for name in names]) \
+                  .where(condition)
+    app.db.session.execute(table.insert().from_select(names, query))
+
+def syllabus_version():
+    """Return the version of all semesters and weeks, as shown in the
+    sidebar."""
+    return version_of(Semester.query, Semester) + version_of(Week.query, Week)
+
+# Columns holding Markdown source, as (model, source column, HTML column). The
+# HTML is rendered whenever the source is set, so pages never need to.
+MARKDOWN_COLUMNS = (
+    (Announcement, 'content', 'content_html'),
+    (Week, 'intro', 'intro_html'),
+    (Assignment, 'instructions', 'instructions_html'),
+)
+
+def _prerender_markdown(model, source, rendered):
+    # pylint: disable=unused-argument,unused-variable
+    @event.listens_for(getattr(model, source), 'set')
+    def render(target, value, oldvalue, initiator):
+        setattr(target, rendered, markup.render(value) if value is not None else None)
+
+for _model, _source, _rendered in MARKDOWN_COLUMNS:
+    _prerender_markdown(_model, _source, _rendered)
+
+# Changes to relationships, such as documents being added to a week, don't
+# necessarily update the row itself, so mark such rows as updated explicitly.
+@event.listens_for(app.db.session, 'before_flush')
+def _touch_updated_rows(session, flush_context, instances): # pylint: disable=unused-argument
+    now = datetime.datetime.now()
+    for obj in session.dirty:
+        if hasattr(obj, 'updated_at') and session.is_modified(obj):
+            obj.updated_at = now
+
+# Keep the principal cache honest: whenever users, their mentorships or their
+# enrollments change, note whose principals are stale during the flush, and
+# drop them once the change is committed.
+@event.listens_for(app.db.session, 'after_flush')
+def _collect_stale_principals(session, flush_context): # pylint: disable=unused-argument
+    stale = session.info.setdefault('stale_principals', set())
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, User):
+            stale.add(obj.id)
+            # A change in mentorship also changes the other user's principal.
+            for attr in ('mentors', 'mentees'):
+                history = inspect(obj).attrs[attr].history
+                stale.update(u.id for u in itertools.chain(history.added or (),
+                                                           history.deleted or ()))
+
+    # Deleting a user or semester takes association rows with it, which may
+    # touch any number of principals, so start over.
+    if any(isinstance(obj, (User, Semester)) for obj in session.deleted):
+        stale.add(None)
+
+@event.listens_for(app.db.session, 'after_commit')
+def _forget_stale_principals(session):
+    stale = session.info.pop('stale_principals', set())
+    if None in stale:
+        UserPrincipal.forget()
+    elif stale:
+        UserPrincipal.forget(stale)
+
+@event.listens_for(app.db.session, 'after_soft_rollback')
+def _discard_stale_principals(session, previous_transaction): # pylint: disable=unused-argument
+    session.info.pop('stale_principals', None)
+
+# Cached pages show announcements and their authors' names, so forget them
+# whenever either changes.
+@event.listens_for(app.db.session, 'after_flush')
+def _collect_stale_pages(session, flush_context): # pylint: disable=unused-argument
+    if any(isinstance(obj, Announcement)
+           for obj in itertools.chain(session.new, session.dirty, session.deleted)) \
+            or any(isinstance(obj, User) and inspect(obj).attrs.name.history.has_changes()
+                   for obj in session.dirty):
+        session.info['stale_pages'] = True
+
+@event.listens_for(app.db.session, 'after_commit')
+def _forget_stale_pages(session):
+    if session.info.pop('stale_pages', False):
+        cache.pages.invalidate()
+
+@event.listens_for(app.db.session, 'after_soft_rollback')
+def _discard_stale_pages(session, previous_transaction): # pylint: disable=unused-argument
+    session.info.pop('stale_pages', None)
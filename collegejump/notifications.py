@@ -0,0 +1,258 @@
+# Email notifications of new submissions, feedback and announcements. Events
+# are queued in the `notification` table as part of the change they are about,
+# and a background worker sends each recipient one digest of everything queued
+# for them, so a busy afternoon of feedback is one email rather than dozens.
+# Mail is only ever sent by the worker, never while handling a request.
+#
+# To try it out, run a debugging SMTP server, which prints what it receives:
+#
+#     python -m smtpd -n -c DebuggingServer localhost:1025
+#
+# and start the site with `--mail-server localhost --mail-port 1025`.
+import collections
+import datetime
+import email.message
+import json
+import smtplib
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from collegejump import app, events, models
+
+# Sent notifications are deleted once they are this old.
+SENT_RETENTION = datetime.timedelta(days=7)
+
+# Notifications claimed by a worker which hasn't sent them in this long, such
+# as one which was stopped, are claimed again.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+# Queue notifications as part of the same transaction as the change they are
+# about, whether or not this process sends mail, since another may. Events for
+# everyone are queued for every user.
+@event.listens_for(app.db.session, 'after_flush')
+def _queue_notifications(session, flush_context): # pylint: disable=unused-argument
+    table = models.Notification.__table__
+    users = models.User.__table__
+    now = datetime.datetime.now()
+    for obj in session.new:
+        for user_id, kind, data in events.describe(session, obj):
+            data = json.dumps(data)
+            if user_id is not None:
+                session.execute(table.insert().values(user_id=user_id, kind=kind, data=data,
+                                                      created=now))
+                continue
+            session.execute(table.insert().from_select(
+                ['user_id', 'kind', 'data', 'created'],
+                app.db.select([users.c.id, app.db.literal(kind), app.db.literal(data),
+                               app.db.literal(now)])))
+
+def _connect():
+    # Open one connection to the mail server, for sending a whole round of
+    # digests.
+    smtp = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=30)
+    if app.config['MAIL_USE_TLS']:
+        smtp.starttls()
+    if app.config['MAIL_USERNAME']:
+        smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+    return smtp
+
+def _subjects(notifications):
+    # Load what the notifications are about, a query per kind, as
+    # {(kind, id): model}.
+    ids = collections.defaultdict(set)
+    for notification in notifications:
+        data = json.loads(notification.data)
+        if notification.kind == 'announcement':
+            ids[models.Announcement].add(data['announcement_id'])
+        elif notification.kind == 'feedback':
+            ids[models.Feedback].add(data['feedback_id'])
+        else:
+            ids[models.Submission].add(data['submission_id'])
+
+    options = {models.Announcement: [],
+               models.Feedback: [joinedload(models.Feedback.author),
+                                 joinedload(models.Feedback.submission)
+                                 .joinedload(models.Submission.assignment)],
+               models.Submission: [joinedload(models.Submission.author),
+                                   joinedload(models.Submission.assignment)]}
+    subjects = {}
+    for model, model_ids in ids.items():
+        for row in model.query.filter(model.id.in_(model_ids)).options(*options[model]):
+            subjects[(model, row.id)] = row
+    return subjects
+
+def _name(obj, attribute='name', default='someone'):
+    return getattr(obj, attribute, None) or default
+
+def _line(notification, subjects):
+    # Describe a notification in a line of the digest, or return None if what
+    # it was about has since been deleted.
+    data = json.loads(notification.data)
+    if notification.kind == 'announcement':
+        announcement = subjects.get((models.Announcement, data['announcement_id']))
+        if announcement is not None:
+            return "New announcement: {}".format(announcement.title)
+    elif notification.kind == 'feedback':
+        feedback = subjects.get((models.Feedback, data['feedback_id']))
+        if feedback is not None:
+            return "{} left feedback on your submission to {}.".format(
+                _name(feedback.author),
+                _name(feedback.submission and feedback.submission.assignment,
+                      default='an assignment'))
+    else:
+        submission = subjects.get((models.Submission, data['submission_id']))
+        if submission is not None:
+            return "{} submitted {}.".format(_name(submission.author),
+                                             _name(submission.assignment,
+                                                   default='an assignment'))
+    return None
+
+def digest(user, lines):
+    """Return the email message telling a user what happened."""
+    message = email.message.EmailMessage()
+    message['From'] = app.config['MAIL_SENDER']
+    message['To'] = user.email
+    message['Subject'] = "College JUMP: {} new update{}".format(
+        len(lines), '' if len(lines) == 1 else 's')
+    message.set_content("Hello {},\n\nHere is what happened on College JUMP:\n\n{}\n".format(
+        _name(user, default='there'), '\n'.join('- ' + line for line in lines)))
+    return message
+
+def _permanent(error):
+    # Whether the mail server refused a digest for good, rather than for now.
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+def _claim(user_ids, now):
+    # Claim the queued notifications of some recipients for this worker, in
+    # one statement, so that other processes' workers leave them alone.
+    # Returns the claim, naming the claimed rows.
+    claim = uuid.uuid4().hex
+    table = models.Notification.__table__
+    app.db.session.execute(table.update()
+                           .where(table.c.user_id.in_(user_ids))
+                           .where(table.c.sent_at.is_(None))
+                           .where(app.db.or_(table.c.claimed_by.is_(None),
+                                             table.c.claimed_at < now - CLAIM_TIMEOUT))
+                           .values(claimed_by=claim, claimed_at=now))
+    app.db.session.commit()
+    return claim
+
+def _release(claim):
+    # Give up the claimed notifications which weren't sent, for the next round.
+    table = models.Notification.__table__
+    app.db.session.execute(table.update()
+                           .where(table.c.claimed_by == claim)
+                           .where(table.c.sent_at.is_(None))
+                           .values(claimed_by=None, claimed_at=None))
+    app.db.session.commit()
+
+def _mark_sent(notification_ids, now):
+    # Mark notifications sent and commit, so that nothing sent is sent again.
+    table = models.Notification.__table__
+    app.db.session.execute(table.update()
+                           .where(table.c.id.in_(notification_ids))
+                           .values(sent_at=now))
+    app.db.session.commit()
+
+def _send_claimed(smtp, claim, now):
+    # Send a digest of each recipient's claimed notifications, returning the
+    # number sent.
+    Notification = models.Notification # pylint: disable=invalid-name
+    queued = Notification.query.filter(Notification.claimed_by == claim) \
+                               .order_by(Notification.created, Notification.id) \
+                               .all()
+    subjects = _subjects(queued)
+
+    by_user = collections.OrderedDict()
+    for notification in queued:
+        by_user.setdefault(notification.user_id, []).append(notification)
+    users = {user.id: user for user in models.User.query.filter(
+        models.User.id.in_(list(by_user)))}
+
+    # Write every message before sending any, since each commit expires what
+    # was loaded.
+    messages = []
+    for user_id, notifications in by_user.items():
+        user = users.get(user_id)
+        lines = [line for line in (_line(n, subjects) for n in notifications)
+                 if line is not None]
+        message = digest(user, lines) if user and user.email and lines else None
+        messages.append((user_id, [n.id for n in notifications], message))
+
+    sent = 0
+    for user_id, notification_ids, message in messages:
+        if message is not None:
+            try:
+                smtp.send_message(message)
+                sent += 1
+            except smtplib.SMTPServerDisconnected:
+                raise # the rest wait for the next round
+            except smtplib.SMTPException as error:
+                if not _permanent(error):
+                    app.logger.warning("Couldn't send notifications to user %d yet: %s",
+                                       user_id, error)
+                    continue
+                app.logger.warning("Mail server refused notifications for user %d: %s",
+                                   user_id, error)
+        _mark_sent(notification_ids, now)
+    return sent
+
+def send_digests(now=None):
+    """Send a digest to each recipient whose oldest queued notification has
+    waited NOTIFICATION_DELAY seconds, so that notifications arriving close
+    together are sent together. Digests are sent over one SMTP connection,
+    claiming NOTIFICATION_BATCH_SIZE recipients' notifications at a time, so
+    that workers in other processes don't send them too, and each is marked
+    sent as soon as the server accepts it. Digests the server refuses for good
+    are logged and dropped; others are left for the next round. Returns the
+    number of digests sent. Must be called within an application context."""
+    now = now or datetime.datetime.now()
+    Notification = models.Notification # pylint: disable=invalid-name
+    cutoff = now - datetime.timedelta(seconds=app.config['NOTIFICATION_DELAY'])
+    due = [user_id for (user_id,) in app.db.session.query(Notification.user_id)
+           .filter(Notification.sent_at.is_(None))
+           .group_by(Notification.user_id)
+           .having(app.db.func.min(Notification.created) <= cutoff)]
+
+    sent = 0
+    if due:
+        batch_size = app.config['NOTIFICATION_BATCH_SIZE']
+        with _connect() as smtp:
+            for start in range(0, len(due), batch_size):
+                claim = _claim(due[start:start + batch_size], now)
+                try:
+                    sent += _send_claimed(smtp, claim, now)
+                finally:
+                    # Whatever wasn't sent waits for the next round.
+                    _release(claim)
+
+    # Forget notifications sent long ago.
+    Notification.query.filter(Notification.sent_at < now - SENT_RETENTION) \
+                      .delete(synchronize_session=False)
+    app.db.session.commit()
+    return sent
+
+def start_worker():
+    """Start a thread sending digests every NOTIFICATION_INTERVAL seconds, for
+    as long as the process runs."""
+    def work():
+        while True:
+            time.sleep(app.config['NOTIFICATION_INTERVAL'])
+            try:
+                with app.app_context():
+                    sent = send_digests()
+                if sent:
+                    app.logger.info("Sent %d notification digests", sent)
+            except Exception: # pylint: disable=broad-except
+                # The queue is kept, so they are sent once the server is back.
+                app.logger.exception("Failed to send notification digests")
+
+    thread = threading.Thread(target=work, name='collegejump-notifications', daemon=True)
+    thread.start()
+    return thread
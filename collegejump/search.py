@@ -0,0 +1,506 @@
+import collections
+import itertools
+import re
+import threading
+
+import flask
+import sqlalchemy
+from flask import Markup
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from collegejump import app, models
+
+# Kinds of searchable things. Each is numbered by its position, plus one, and
+# index rows are numbered `id * KIND_SLOTS + number`, so a row can be found,
+# replaced or removed by the id of what it indexes alone.
+KINDS = ('announcement', 'week', 'assignment', 'submission', 'feedback')
+KIND_SLOTS = 8
+
+# Searches use at most this many words.
+MAX_TERMS = 10
+
+# Marks the start and end of matches in snippets, before they are escaped.
+_MATCH_START, _MATCH_END = '\x02', '\x03'
+
+# A search result: what kind of thing was found, its id, a title, a snippet of
+# the text around the match, and where to see it.
+Hit = collections.namedtuple('Hit', 'kind id title snippet url')
+
+def _rowid(kind, ref_id):
+    return ref_id * KIND_SLOTS + KINDS.index(kind) + 1
+
+def _unpack(rowid):
+    return KINDS[rowid % KIND_SLOTS - 1], rowid // KIND_SLOTS
+
+def terms(query):
+    """Split a search query into lower case words, the same way the index
+    splits text."""
+    return re.findall(r'[^\W_]+', (query or '').lower())[:MAX_TERMS]
+
+
+class Scope(object):
+    """What a user may find by searching: the same things they can see when
+    browsing. Admins see everything. Others see announcements, weeks and
+    assignments of the semesters they're interested in, and submissions, and
+    feedback on them, by themselves and their mentees.
+    """
+
+    def __init__(self, principal):
+        self.everything = principal.admin
+        if self.everything:
+            return
+
+        self.semester_ids = frozenset(
+            i for (i,) in principal.interested_semesters()
+                                   .with_entities(models.Semester.id).order_by(None))
+        self.assignment_ids = frozenset()
+        if self.semester_ids:
+            self.assignment_ids = frozenset(
+                i for (i,) in app.db.session.query(models.week_assignments.c.assignment_id)
+                .join(models.Week, models.Week.id == models.week_assignments.c.week_id)
+                .filter(models.Week.semester_id.in_(self.semester_ids)))
+        self.owner_ids = frozenset([principal.id]) | principal.mentee_ids
+
+    def allows(self, rowid, semester_id, owner_id):
+        """Return whether an index row, with the given semester and owner, may
+        be seen."""
+        if self.everything:
+            return True
+        kind, ref_id = _unpack(rowid)
+        if kind == 'announcement':
+            return True
+        elif kind == 'week':
+            return semester_id in self.semester_ids
+        elif kind == 'assignment':
+            return ref_id in self.assignment_ids
+        return owner_id in self.owner_ids
+
+
+def _document(obj):
+    # Return the kind of a model instance, then the title, body, semester id
+    # and owner id indexed for it, or None if it isn't searchable. Submissions
+    # and feedback are owned by the author of the submission.
+    if isinstance(obj, models.Announcement):
+        return ('announcement', obj.title, obj.content, None, None)
+    elif isinstance(obj, models.Week):
+        return ('week', obj.header, obj.intro, obj.semester_id, None)
+    elif isinstance(obj, models.Assignment):
+        return ('assignment', obj.name, obj.instructions, None, None)
+    elif isinstance(obj, models.Submission):
+        return ('submission', None, obj.text, None, obj.author_id)
+    elif isinstance(obj, models.Feedback):
+        owner_id = obj.submission.author_id if obj.submission is not None else None
+        return ('feedback', None, obj.text, None, owner_id)
+    return None
+
+def _queries():
+    # Return a query for each kind, as (kind, query) pairs, selecting the id,
+    # title, body, semester id and owner id of everything of that kind.
+    announcement = models.Announcement.__table__
+    week = models.Week.__table__
+    assignment = models.Assignment.__table__
+    submission = models.Submission.__table__
+    feedback = models.Feedback.__table__
+    # Columns which some kinds don't have.
+    no_title = sqlalchemy.null().label('title')
+    no_semester = sqlalchemy.null().label('semester_id')
+    no_owner = sqlalchemy.null().label('owner_id')
+
+    return (
+        ('announcement', sqlalchemy.select([announcement.c.id, announcement.c.title,
+                                            announcement.c.content, no_semester, no_owner])),
+        ('week', sqlalchemy.select([week.c.id, week.c.header, week.c.intro,
+                                    week.c.semester_id, no_owner])),
+        ('assignment', sqlalchemy.select([assignment.c.id, assignment.c.name,
+                                          assignment.c.instructions, no_semester, no_owner])),
+        ('submission', sqlalchemy.select([submission.c.id, no_title, submission.c.text,
+                                          no_semester, submission.c.author_id])),
+        ('feedback', sqlalchemy.select([feedback.c.id, no_title, feedback.c.text,
+                                        no_semester, submission.c.author_id])
+                               .select_from(feedback.outerjoin(
+                                   submission, feedback.c.submission_id == submission.c.id))),
+    )
+
+def _documents(connection, queries=None):
+    # Generate (rowid, title, body, semester id, owner id) for everything
+    # searchable in the database, or only what the given queries select.
+    for kind, query in queries or _queries():
+        for ref_id, title, body, semester_id, owner_id in connection.execute(query):
+            yield _rowid(kind, ref_id), title, body, semester_id, owner_id
+
+
+class FTSIndex(object):
+    """A search index kept in the database, as an SQLite FTS5 table. Changes
+    are written in the same transaction as the rows they index, so every
+    process sees them at once. The table keeps its own uncompressed copy of
+    the text it indexes, which snippets are cut from.
+    """
+    transactional = True
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    @staticmethod
+    def create(connection):
+        """Create the index table, returning whether it did not already
+        exist. Raises OperationalError if SQLite lacks FTS5."""
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_index'").first()
+        connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index "
+                           "USING fts5(title, body, semester_id UNINDEXED, owner_id UNINDEXED)")
+        return exists is None
+
+    @staticmethod
+    def apply(connection, changes):
+        """Write changes, as (rowid, document or None to remove) pairs."""
+        removed = [{'rowid': rowid} for rowid, document in changes if document is None]
+        written = [dict(zip(('rowid', 'title', 'body', 'semester_id', 'owner_id'),
+                            (rowid,) + document))
+                   for rowid, document in changes if document is not None]
+        if removed:
+            connection.execute(sqlalchemy.text(
+                "DELETE FROM search_index WHERE rowid = :rowid"), removed)
+        if written:
+            connection.execute(sqlalchemy.text(
+                "INSERT OR REPLACE INTO search_index (rowid, title, body, semester_id, owner_id) "
+                "VALUES (:rowid, :title, :body, :semester_id, :owner_id)"), written)
+
+    def rebuild(self):
+        with self.engine.begin() as connection:
+            connection.execute("DELETE FROM search_index")
+            self.apply(connection, [(rowid, tuple(document))
+                                    for rowid, *document in _documents(connection)])
+
+    def search(self, scope, words, limit, offset):
+        """Return up to `limit` (rowid, snippet) pairs of matching rows in
+        `scope`, best first, after skipping `offset` of them."""
+        # Quote each word, so nothing is taken as query syntax, and match the
+        # last one as a prefix, since it may not have been finished.
+        params = {'query': ' '.join('"{}"'.format(w) for w in words) + '*',
+                  'limit': limit, 'offset': offset,
+                  'start': _MATCH_START, 'end': _MATCH_END}
+
+        visible = ''
+        if not scope.everything:
+            visible = ("AND (rowid % {slots} = 1"
+                       " OR (rowid % {slots} = 2 AND semester_id IN ({semesters}))"
+                       " OR (rowid % {slots} = 3 AND rowid / {slots} IN ({assignments}))"
+                       " OR (rowid % {slots} > 3 AND owner_id IN ({owners})))").format(
+                           slots=KIND_SLOTS,
+                           semesters=_bind_list('s', scope.semester_ids, params),
+                           assignments=_bind_list('a', scope.assignment_ids, params),
+                           owners=_bind_list('o', scope.owner_ids, params))
+
+        # Matches in titles count for more than those in the body.
+        return self.engine.execute(sqlalchemy.text(
+            "SELECT rowid, snippet(search_index, -1, :start, :end, '…', 16) "
+            "FROM search_index WHERE search_index MATCH :query " + visible +
+            " ORDER BY bm25(search_index, 5.0, 1.0) LIMIT :limit OFFSET :offset"),
+                                   params).fetchall()
+
+def _bind_list(prefix, values, params):
+    # Add values to the parameters, returning a list of their names for an
+    # IN clause. An empty list matches nothing.
+    names = []
+    for i, value in enumerate(values):
+        params['{}{}'.format(prefix, i)] = value
+        names.append(':{}{}'.format(prefix, i))
+    return ', '.join(names) or 'NULL'
+
+
+class MemoryIndex(object):
+    """A search index kept in the memory of each process, for databases
+    without FTS5. It is built on first use, and updated when this process
+    commits changes; other processes' changes are only seen once it is
+    rebuilt.
+    """
+    transactional = False
+
+    # Occurrences of a word in a title count this many times.
+    TITLE_WEIGHT = 5
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._documents = None
+        self._postings = None
+
+    def _add(self, rowid, document):
+        title, body, _, _ = document
+        self._documents[rowid] = document
+        counts = collections.Counter(terms(body))
+        for word in terms(title):
+            counts[word] += self.TITLE_WEIGHT
+        for word, count in counts.items():
+            self._postings[word][rowid] = count
+
+    def _remove(self, rowid):
+        document = self._documents.pop(rowid, None)
+        if document is not None:
+            for word in set(terms(document[0]) + terms(document[1])):
+                self._postings[word].pop(rowid, None)
+
+    def apply(self, connection, changes): # pylint: disable=unused-argument
+        """Apply committed changes, as (rowid, document or None) pairs."""
+        with self._lock:
+            # Until the index is built, there is nothing to keep up to date.
+            if self._documents is None:
+                return
+            for rowid, document in changes:
+                self._remove(rowid)
+                if document is not None:
+                    self._add(rowid, document)
+
+    def rebuild(self):
+        with self._lock:
+            self._documents = {}
+            self._postings = collections.defaultdict(dict)
+            with self.engine.connect() as connection:
+                for rowid, *document in _documents(connection):
+                    self._add(rowid, tuple(document))
+
+    def search(self, scope, words, limit, offset):
+        """See `FTSIndex.search`."""
+        if self._documents is None:
+            self.rebuild()
+
+        with self._lock:
+            # Every word must match, the last as a prefix.
+            *exact, last = words
+            prefixed = [p for word, p in self._postings.items() if word.startswith(last)]
+            scores = collections.Counter()
+            for postings in prefixed:
+                scores.update(postings)
+            for word in exact:
+                postings = self._postings.get(word, {})
+                scores = collections.Counter({rowid: score + postings[rowid]
+                                              for rowid, score in scores.items()
+                                              if rowid in postings})
+
+            ranked = sorted(scores, key=lambda rowid: (-scores[rowid], -rowid))
+            visible = (rowid for rowid in ranked
+                       if scope.allows(rowid, *self._documents[rowid][2:]))
+            return [(rowid, _snippet(self._documents[rowid], exact, last))
+                    for rowid in itertools.islice(visible, offset, offset + limit)]
+
+def _snippet(document, exact, prefix, width=16):
+    # Return about `width` words of a document around its first match, with
+    # matching words marked, in the same way as FTS5's snippet().
+    def matches(word):
+        return any(w in exact or w.startswith(prefix) for w in terms(word))
+
+    words = (document[1] or document[0] or '').split()
+    first = next((i for i, word in enumerate(words) if matches(word)), 0)
+    start = max(first - width // 4, 0)
+    shown = [_MATCH_START + word + _MATCH_END if matches(word) else word
+             for word in words[start:start + width]]
+    return ('…' if start > 0 else '') + ' '.join(shown) \
+            + ('…' if start + width < len(words) else '')
+
+
+# The index in use, chosen by `setup()`.
+app.search_index = None
+
+def setup():
+    """Choose and prepare the search index, building it if it is new. Called
+    when the database is brought up to date."""
+    engine = app.db.engine
+    if app.config['SEARCH_USE_FTS'] and engine.dialect.name == 'sqlite':
+        try:
+            with engine.begin() as connection:
+                created = FTSIndex.create(connection)
+            app.search_index = FTSIndex(engine)
+            if created:
+                app.logger.info("Building the search index")
+                app.search_index.rebuild()
+            return
+        except OperationalError:
+            app.logger.warning("SQLite lacks FTS5; searching with an in-memory index")
+    app.search_index = MemoryIndex(engine)
+
+def rebuild():
+    """Rebuild the search index from scratch, such as after an import which
+    bypassed the ORM."""
+    if app.search_index is None:
+        setup()
+    app.search_index.rebuild()
+
+def index_semester(semester_id):
+    """Index the weeks of a semester, their assignments, and submissions and
+    feedback on those, as part of the current transaction, after they were
+    written without the ORM, such as by `Semester.clone()`."""
+    if app.search_index is None:
+        return
+    week = models.Week.__table__
+    assignment = models.Assignment.__table__
+    submission = models.Submission.__table__
+    feedback = models.Feedback.__table__
+    assignment_ids = sqlalchemy.select([models.week_assignments.c.assignment_id]) \
+            .select_from(models.week_assignments.join(
+                week, week.c.id == models.week_assignments.c.week_id)) \
+            .where(week.c.semester_id == semester_id)
+    submission_ids = sqlalchemy.select([submission.c.id]) \
+            .where(submission.c.assignment_id.in_(assignment_ids))
+
+    queries = dict(_queries())
+    queries = (('week', queries['week'].where(week.c.semester_id == semester_id)),
+               ('assignment', queries['assignment'].where(assignment.c.id.in_(assignment_ids))),
+               ('submission', queries['submission'].where(submission.c.id.in_(submission_ids))),
+               ('feedback', queries['feedback'].where(
+                   feedback.c.submission_id.in_(submission_ids))))
+    session = app.db.session()
+    _queue_changes(session, [(rowid, tuple(document)) for rowid, *document
+                             in _documents(session.connection(), queries)])
+
+def unindex(kind, ids):
+    """Remove things of one kind from the index, by id, as part of the current
+    transaction, after they were deleted without the ORM."""
+    if app.search_index is None:
+        return
+    _queue_changes(app.db.session(), [(_rowid(kind, ref_id), None) for ref_id in ids])
+
+def search(principal, query, page=1, per_page=20):
+    """Search for what `principal` may see, returning a list of hits on the
+    given page, best first, and whether there are more pages."""
+    words = terms(query)
+    if not words:
+        return [], False
+    if app.search_index is None:
+        setup()
+
+    rows = app.search_index.search(Scope(principal), words, per_page + 1, (page - 1) * per_page)
+    return _describe(principal, rows[:per_page]), len(rows) > per_page
+
+def _highlight(snippet):
+    # Escape a snippet, then turn match markers into highlighting.
+    return Markup(str(Markup.escape(snippet or ''))
+                  .replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>'))
+
+def _describe(principal, rows):
+    # Turn index rows into hits, looking up titles and links a kind at a time.
+    ids = collections.defaultdict(list)
+    for rowid, _ in rows:
+        kind, ref_id = _unpack(rowid)
+        ids[kind].append(ref_id)
+    described = {}
+
+    def week_url(semester_id, week_num):
+        return flask.url_for('week_page', semester_id=semester_id, week_num=week_num)
+
+    def weeks_of(assignment_ids):
+        # Map assignments to the first week showing them which the user may
+        # see.
+        query = app.db.session.query(models.week_assignments.c.assignment_id,
+                                     models.Week.semester_id, models.Week.week_num) \
+                              .join(models.Week,
+                                    models.Week.id == models.week_assignments.c.week_id) \
+                              .filter(models.week_assignments.c.assignment_id.in_(assignment_ids)) \
+                              .order_by(models.Week.semester_id.desc(), models.Week.week_num)
+        if not principal.admin:
+            query = query.filter(models.Week.semester_id.in_(
+                principal.interested_semesters().with_entities(models.Semester.id)
+                .order_by(None)))
+        weeks = {}
+        for assignment_id, semester_id, week_num in query:
+            weeks.setdefault(assignment_id, week_url(semester_id, week_num))
+        return weeks
+
+    def submission_url(submission_id, author_id, assignment_url):
+        # Authors see their submissions on the week page, while mentors and
+        # admins give feedback on their own page.
+        if author_id == principal.id:
+            return assignment_url
+        return flask.url_for('feedback_page', submission_id=submission_id)
+
+    if ids['announcement']:
+        for ref_id, title in app.db.session.query(models.Announcement.id,
+                                                  models.Announcement.title) \
+                .filter(models.Announcement.id.in_(ids['announcement'])):
+            described['announcement', ref_id] = (
+                title, flask.url_for('announcement_page', announcement_id=ref_id))
+
+    if ids['week']:
+        for ref_id, header, semester_id, week_num in app.db.session.query(
+                models.Week.id, models.Week.header, models.Week.semester_id,
+                models.Week.week_num).filter(models.Week.id.in_(ids['week'])):
+            described['week', ref_id] = ('Week {}: {}'.format(week_num, header),
+                                         week_url(semester_id, week_num))
+
+    if ids['assignment']:
+        weeks = weeks_of(ids['assignment'])
+        for ref_id, name in app.db.session.query(models.Assignment.id, models.Assignment.name) \
+                .filter(models.Assignment.id.in_(ids['assignment'])):
+            described['assignment', ref_id] = (name, weeks.get(ref_id))
+
+    for kind, model in (('submission', models.Submission), ('feedback', models.Feedback)):
+        if not ids[kind]:
+            continue
+        query = app.db.session.query(model.id, models.Submission.id,
+                                     models.Submission.author_id,
+                                     models.Submission.assignment_id,
+                                     models.User.name, models.Assignment.name) \
+                              .select_from(model)
+        if model is models.Feedback:
+            query = query.join(models.Feedback.submission)
+        query = query.outerjoin(models.User, models.User.id == models.Submission.author_id) \
+                     .outerjoin(models.Assignment,
+                                models.Assignment.id == models.Submission.assignment_id) \
+                     .filter(model.id.in_(ids[kind]))
+        results = query.all()
+        weeks = weeks_of([r[3] for r in results])
+        for ref_id, submission_id, author_id, assignment_id, author, assignment in results:
+            title = '{} by {} on {}'.format('Submission' if kind == 'submission' else
+                                            'Feedback on submission',
+                                            author, assignment)
+            described[kind, ref_id] = (title, submission_url(submission_id, author_id,
+                                                             weeks.get(assignment_id)))
+
+    hits = []
+    for rowid, snippet in rows:
+        kind, ref_id = _unpack(rowid)
+        # Skip rows for things which have since gone away.
+        if (kind, ref_id) in described:
+            title, url = described[kind, ref_id]
+            hits.append(Hit(kind, ref_id, title, _highlight(snippet), url))
+    return hits
+
+
+# Keep the index up to date with changes made through the ORM. The database
+# index is written as part of each flush, so it commits or rolls back along
+# with everything else; the in-memory index is updated once changes commit.
+@event.listens_for(app.db.session, 'after_flush')
+def _collect_search_changes(session, flush_context): # pylint: disable=unused-argument
+    if app.search_index is None:
+        return
+
+    changes = []
+    for obj in itertools.chain(session.new, session.dirty):
+        document = _document(obj)
+        if document is not None and (obj in session.new or session.is_modified(obj)):
+            changes.append((_rowid(document[0], obj.id), document[1:]))
+    for obj in session.deleted:
+        document = _document(obj)
+        if document is not None:
+            changes.append((_rowid(document[0], obj.id), None))
+
+    _queue_changes(session, changes)
+
+def _queue_changes(session, changes):
+    # Write changes to the index along with the session's transaction.
+    if not changes:
+        return
+    if app.search_index.transactional:
+        app.search_index.apply(session.connection(), changes)
+    else:
+        session.info.setdefault('search_changes', []).extend(changes)
+
+@event.listens_for(app.db.session, 'after_commit')
+def _apply_search_changes(session):
+    changes = session.info.pop('search_changes', None)
+    if changes:
+        app.search_index.apply(None, changes)
+
+@event.listens_for(app.db.session, 'after_soft_rollback')
+def _discard_search_changes(session, previous_transaction): # pylint: disable=unused-argument
+    session.info.pop('search_changes', None)
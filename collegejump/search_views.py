@@ -0,0 +1,16 @@
+# The search page, listing what a user may see which matches their query.
+import flask
+from flask_login import login_required, current_user
+
+from collegejump import app, forms, search
+
+# Search results listed per page.
+SEARCH_RESULTS_PER_PAGE = 20
+
+@app.route('/search')
+@login_required
+def search_page():
+    form = forms.SearchForm(flask.request.args)
+    page = max(flask.request.args.get('page', 1, type=int), 1)
+    hits, more = search.search(current_user, form.q.data, page, SEARCH_RESULTS_PER_PAGE)
+    return flask.render_template('search.html', form=form, hits=hits, page=page, more=more)
@@ -0,0 +1,42 @@
+// Listens for new feedback, submissions and announcements while a page is
+// open, and offers to reload the page when any arrive, rather than leaving
+// users to reload it over and over to find out.
+(function() {
+    'use strict';
+
+    var EVENTS_URL = document.currentScript.dataset.eventsUrl;
+
+    var MESSAGES = {
+        feedback: 'New feedback on your submission.',
+        submission: 'A mentee has submitted an assignment.',
+        announcement: 'A new announcement was posted.'
+    };
+
+    if (!window.EventSource) {
+        return;
+    }
+
+    var notice = null;
+
+    function show(message) {
+        if (!notice) {
+            notice = document.createElement('div');
+            notice.className = 'alert alert-info';
+            notice.setAttribute('role', 'status');
+            var content = document.querySelector('.col-sm-8') || document.body;
+            content.insertBefore(notice, content.firstChild);
+        }
+        notice.textContent = message + ' ';
+        var reload = document.createElement('a');
+        reload.href = window.location.href;
+        reload.className = 'alert-link';
+        reload.textContent = 'Reload';
+        notice.appendChild(reload);
+    }
+
+    // The browser reconnects by itself, sending the last event seen.
+    var source = new EventSource(EVENTS_URL);
+    Object.keys(MESSAGES).forEach(function(kind) {
+        source.addEventListener(kind, function() { show(MESSAGES[kind]); });
+    });
+})();
@@ -0,0 +1,173 @@
+// Uploads files chosen in file fields marked with data-upload-purpose in
+// chunks, when their form is submitted, so that a large upload over a flaky
+// connection picks up where it left off rather than starting over. The form
+// is then submitted with the id of the finished upload, in the hidden field
+// named by data-upload-field, instead of the file itself.
+(function() {
+    'use strict';
+
+    // How long to wait before each retry of a failed chunk, in milliseconds.
+    var RETRY_DELAYS = [1000, 2000, 5000, 10000, 30000, 60000];
+
+    // Where uploads are started, given by the page.
+    var NEW_UPLOAD_URL = document.currentScript.dataset.uploadUrl;
+
+    // An error which retrying won't help.
+    function Failure(message) {
+        this.message = message;
+    }
+
+    if (!window.fetch || !window.Blob || !Blob.prototype.slice) {
+        return; // Forms are submitted with the whole file instead.
+    }
+
+    function wait(delay) {
+        return new Promise(function(resolve) { setTimeout(resolve, delay); });
+    }
+
+    function send(form, method, url, body, contentType) {
+        var headers = {'Accept': 'application/json'};
+        var csrf = form.querySelector('input[name=csrf_token]');
+        if (csrf) {
+            headers['X-CSRFToken'] = csrf.value;
+        }
+        if (contentType) {
+            headers['Content-Type'] = contentType;
+        }
+        return fetch(url, {method: method, body: body, headers: headers,
+                           credentials: 'same-origin'})
+            .then(function(response) {
+                return response.json().catch(function() { return {}; })
+                    .then(function(reply) {
+                        reply.status = response.status;
+                        return reply;
+                    });
+            });
+    }
+
+    // Uploads of the same file are resumed after reloading the page, too.
+    function resumeKey(purpose, file) {
+        return ['upload', purpose, file.name, file.size, file.lastModified].join(':');
+    }
+
+    function start(form, purpose, file) {
+        var key = resumeKey(purpose, file);
+        var create = function() {
+            return send(form, 'POST', NEW_UPLOAD_URL,
+                        JSON.stringify({purpose: purpose, filename: file.name, size: file.size}),
+                        'application/json')
+                .then(function(reply) {
+                    if (reply.status !== 201) {
+                        throw new Failure(reply.error || 'The upload could not be started');
+                    }
+                    localStorage.setItem(key, reply.url);
+                    return reply;
+                });
+        };
+
+        var url = localStorage.getItem(key);
+        if (!url) {
+            return create();
+        }
+        return send(form, 'GET', url).then(function(reply) {
+            return reply.status === 200 ? reply : create();
+        });
+    }
+
+    function upload(form, input, progress) {
+        var file = input.files[0];
+        var purpose = input.dataset.uploadPurpose;
+        var retries = 0;
+
+        function report(upload) {
+            progress.textContent = 'Uploaded ' +
+                Math.floor(100 * upload.offset / Math.max(upload.size, 1)) + '%';
+        }
+
+        function next(upload) {
+            report(upload);
+            if (upload.offset >= upload.size) {
+                localStorage.removeItem(resumeKey(purpose, file));
+                return upload;
+            }
+            var chunk = file.slice(upload.offset, upload.offset + upload.chunk_size);
+            return send(form, 'PUT', upload.url + '?offset=' + upload.offset, chunk,
+                        'application/octet-stream')
+                .then(function(reply) {
+                    if (reply.status === 200) {
+                        retries = 0;
+                        return next(reply);
+                    } else if (reply.status === 409) {
+                        // The server has more, or less, than we thought.
+                        upload.offset = reply.offset;
+                        return next(upload);
+                    } else if (reply.status < 500) {
+                        throw new Failure(reply.error || 'The upload failed');
+                    }
+                    throw new Error('The server failed');
+                })
+                .catch(function(error) {
+                    // Connections and servers fail for a while; try again.
+                    if (error instanceof Failure) {
+                        throw error;
+                    } else if (retries >= RETRY_DELAYS.length) {
+                        throw new Failure('The upload failed; submit again to resume');
+                    }
+                    progress.textContent = 'Connection lost; retrying';
+                    return wait(RETRY_DELAYS[retries++]).then(function() {
+                        return send(form, 'GET', upload.url);
+                    }).then(function(reply) {
+                        return next(reply.status === 200 ? reply : upload);
+                    }, function() {
+                        return next(upload);
+                    });
+                });
+        }
+
+        return start(form, purpose, file).then(next);
+    }
+
+    document.addEventListener('click', function(event) {
+        // Remember which button submitted the form, to submit it again.
+        var button = event.target.closest('button[type=submit], input[type=submit]');
+        if (button && button.form) {
+            button.form.uploadSubmitter = button;
+        }
+    });
+
+    document.addEventListener('submit', function(event) {
+        var form = event.target;
+        var input = form.querySelector('input[type=file][data-upload-purpose]');
+        var submitter = form.uploadSubmitter;
+        if (!input || !input.files.length || input.disabled
+                || (submitter && submitter.name === 'delete')) {
+            return;
+        }
+        event.preventDefault();
+
+        var progress = document.createElement('p');
+        progress.className = 'help-block';
+        input.parentNode.appendChild(progress);
+
+        upload(form, input, progress).then(function(finished) {
+            form.querySelector('input[name="' + input.dataset.uploadField + '"]').value =
+                finished.id;
+            // Don't send the file again, but do send the button pressed.
+            input.disabled = true;
+            if (submitter && submitter.name) {
+                var pressed = document.createElement('input');
+                pressed.type = 'hidden';
+                pressed.name = submitter.name;
+                pressed.value = submitter.value;
+                form.appendChild(pressed);
+            }
+            form.submit();
+        }, function(error) {
+            progress.textContent = error.message;
+            var group = input.closest('.form-group');
+            if (group) {
+                group.classList.add('has-error');
+            }
+        });
+    });
+})();
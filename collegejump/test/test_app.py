@@ -2,6 +2,8 @@
 
 # pylint: disable=R,C,W; refactoring, convention, warnings
 
+import datetime
+
 import pytest # pylint: disable=import-error
 
 @pytest.fixture(scope="module")
@@ -9,6 +11,9 @@ def collegejump():
     import collegejump
     collegejump.app.config['WTF_CSRF_ENABLED'] = False # disable CSRF validation
     collegejump.init_app()
+    with collegejump.app.app_context():
+        collegejump.init_db()
+        collegejump.init_process()
 
     return collegejump
 
@@ -126,3 +131,1228 @@ class TestUser():
 
 
 
+
+@pytest.fixture(scope="module")
+def people(collegejump):
+    '''Create an admin, a mentor, and a student enrolled in a one-week
+    semester, returning their ids by role.'''
+    models = collegejump.models
+    with collegejump.app.app_context():
+        collegejump.app.db.create_all()
+        admin = models.User('admin@email.com', 'admin password', 'Admin', admin=True)
+        mentor = models.User('mentor@email.com', 'mentor password', 'Mentor')
+        student = models.User('student@email.com', 'student password', 'Student')
+        student.mentors = [mentor]
+        semester = models.Semester('Fall', 1)
+        student.semesters = [semester]
+        collegejump.app.db.session.add_all([admin, mentor, student, semester])
+        collegejump.app.db.session.commit()
+
+        week = models.Week(semester.id, 1, 'First Week', 'Welcome to *College JUMP*')
+        collegejump.app.db.session.add(week)
+        collegejump.app.db.session.commit()
+
+        return {'admin': admin.id, 'mentor': mentor.id,
+                'student': student.id, 'semester': semester.id}
+
+def login(client, role):
+    return client.post('/login', data=dict(
+        email='{}@email.com'.format(role),
+        password='{} password'.format(role)), follow_redirects=True)
+
+class TestUserPrincipal():
+
+    def test_principal_contents(self, collegejump, people):
+        with collegejump.app.app_context():
+            principal = collegejump.models.UserPrincipal.load(people['mentor'])
+            assert not principal.admin
+            assert principal.mentee_ids == {people['student']}
+            assert principal.name == 'Mentor' # read through from the model
+            with pytest.raises(AttributeError):
+                principal.name = 'Renamed' # but never written through
+
+            assert collegejump.models.UserPrincipal.load(-1) is None
+
+    def test_principal_invalidated(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            assert models.UserPrincipal.load(people['student']).semester_ids \
+                    == {people['semester']}
+
+            student = models.User.query.get(people['student'])
+            student.semesters = []
+            collegejump.app.db.session.commit()
+            assert models.UserPrincipal.load(people['student']).semester_ids == set()
+
+            student.semesters = [models.Semester.query.get(people['semester'])]
+            collegejump.app.db.session.commit()
+            assert models.UserPrincipal.load(people['student']).semester_ids \
+                    == {people['semester']}
+
+    def test_student_week_page(self, client, people):
+        login(client, 'student')
+        rv = client.get('/semester/{}/week/1'.format(people['semester']))
+        assert rv.status_code == 200
+        assert b'First Week' in rv.data
+        client.get('/logout')
+
+class TestMarkdown():
+
+    def test_rendered_on_set(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            week = models.Week.query.filter_by(semester_id=people['semester']).first()
+            assert week.intro_html == '<p>Welcome to <em>College JUMP</em></p>'
+
+    def test_rendered_missing(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            week = models.Week.query.filter_by(semester_id=people['semester']).first()
+            collegejump.app.db.session.execute(
+                models.Week.__table__.update().values(intro_html=None))
+            collegejump.app.db.session.commit()
+
+            collegejump.database.render_markdown(only_missing=True)
+            collegejump.app.db.session.refresh(week)
+            assert week.intro_html == '<p>Welcome to <em>College JUMP</em></p>'
+
+class TestPageCache():
+
+    def test_announcement_invalidates(self, collegejump, client, people, monkeypatch):
+        monkeypatch.delitem(collegejump.app.config, 'SETUP_KEY', raising=False)
+        assert b'Cached News' not in client.get('/').data
+
+        with collegejump.app.app_context():
+            announcement = collegejump.models.Announcement('admin@email.com',
+                                                           'Cached News', 'Hello')
+            collegejump.app.db.session.add(announcement)
+            collegejump.app.db.session.commit()
+
+        assert b'Cached News' in client.get('/').data
+
+    def test_author_renamed(self, collegejump, client, people, monkeypatch):
+        monkeypatch.delitem(collegejump.app.config, 'SETUP_KEY', raising=False)
+        models = collegejump.models
+        with collegejump.app.app_context():
+            collegejump.app.db.session.add(models.Announcement('admin@email.com',
+                                                               'Renamed News', 'Hello'))
+            collegejump.app.db.session.commit()
+        assert b'by Admin' in client.get('/').data
+
+        with collegejump.app.app_context():
+            admin = models.User.query.get(people['admin'])
+            name, admin.name = admin.name, 'Renamed Admin'
+            collegejump.app.db.session.commit()
+        try:
+            assert b'by Renamed Admin' in client.get('/').data
+        finally:
+            with collegejump.app.app_context():
+                models.User.query.get(people['admin']).name = name
+                collegejump.app.db.session.commit()
+
+    def test_generation_read_once(self, collegejump, monkeypatch, tmpdir):
+        monkeypatch.setitem(collegejump.app.config, 'PAGE_CACHE_DIR', str(tmpdir))
+        pages = collegejump.cache.PageCache()
+        reads = []
+        read = pages._read_generation # pylint: disable=protected-access
+        monkeypatch.setattr(pages, '_read_generation', lambda: reads.append(1) or read())
+
+        with collegejump.app.test_request_context('/'):
+            for fragment in ('a', 'b', 'c'):
+                pages.fragment(fragment, lambda: 'rendered')
+            pages.invalidate()
+            assert pages.fragment('a', lambda: 'again') == 'again'
+        assert len(reads) == 2
+
+    def test_unknown_arguments(self, collegejump, client, monkeypatch, tmpdir):
+        monkeypatch.delitem(collegejump.app.config, 'SETUP_KEY', raising=False)
+        monkeypatch.setitem(collegejump.app.config, 'PAGE_CACHE_DIR', str(tmpdir))
+        monkeypatch.setitem(collegejump.app.config, 'PAGE_CACHE_FILES', 2)
+        monkeypatch.setattr(collegejump.cache, 'pages', collegejump.cache.PageCache())
+        for made_up in range(3):
+            assert client.get('/calendar?x={}'.format(made_up)).status_code == 200
+        assert tmpdir.listdir() == []
+
+        # Pages are cached for the arguments the view reads, up to the limit.
+        for per_page in (1, 2, 3):
+            client.get('/announcement/?per_page={}'.format(per_page))
+        assert len(tmpdir.listdir(lambda path: path.ext == '.page')) == 2
+
+    def test_shared_directory(self, collegejump, monkeypatch, tmpdir):
+        monkeypatch.setitem(collegejump.app.config, 'PAGE_CACHE_DIR', str(tmpdir))
+        first, second = collegejump.cache.PageCache(), collegejump.cache.PageCache()
+
+        with collegejump.app.test_request_context('/'):
+            first.set_response('/', collegejump.app.response_class('cached'))
+            assert second.get_response('/').get_data() == b'cached'
+
+            second.invalidate()
+            assert first.get_response('/') is None
+
+class TestConditionalGet():
+
+    def test_week_not_modified(self, collegejump, client, people):
+        login(client, 'student')
+        url = '/semester/{}/week/1'.format(people['semester'])
+        rv = client.get(url)
+        assert rv.status_code == 200
+        etag = rv.headers['ETag']
+
+        rv = client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+        with collegejump.app.app_context():
+            week = collegejump.models.Week.query.filter_by(semester_id=people['semester']).one()
+            week.header = 'First Week, Revised'
+            collegejump.app.db.session.commit()
+
+        rv = client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert b'First Week, Revised' in rv.data
+        client.get('/logout')
+
+    def test_author_renamed(self, collegejump, client, people, monkeypatch):
+        monkeypatch.delitem(collegejump.app.config, 'SETUP_KEY', raising=False)
+        models = collegejump.models
+        db = collegejump.app.db
+        with collegejump.app.app_context():
+            announcement = models.Announcement('admin@email.com', 'Bylined', 'Hello')
+            db.session.add(announcement)
+            db.session.commit()
+            url = '/announcement/{}'.format(announcement.id)
+        etags = {url: client.get(url).headers['ETag'],
+                 '/announcement/feed.json':
+                     client.get('/announcement/feed.json').headers['ETag']}
+
+        with collegejump.app.app_context():
+            admin = models.User.query.get(people['admin'])
+            name, admin.name = admin.name, 'Retitled Admin'
+            db.session.commit()
+        try:
+            for page, etag in etags.items():
+                rv = client.get(page, headers={'If-None-Match': etag})
+                assert rv.status_code == 200
+                assert b'Retitled Admin' in rv.data
+        finally:
+            with collegejump.app.app_context():
+                models.User.query.get(people['admin']).name = name
+                db.session.commit()
+
+    def test_deletion_not_hidden(self, collegejump, client, people):
+        # Deleting a row changes a page without updating anything later, so
+        # If-Modified-Since alone never gets a 304.
+        rv = client.get('/announcement/')
+        assert 'Last-Modified' not in rv.headers
+        rv = client.get('/announcement/',
+                        headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        assert rv.status_code == 200
+
+class TestCompression():
+
+    def test_gzip_page(self, client):
+        import gzip
+        rv = client.get('/calendar', headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert b'</html>' in gzip.decompress(rv.data)
+
+        rv = client.get('/calendar')
+        assert 'Content-Encoding' not in rv.headers
+
+    def test_static_fingerprint(self, collegejump, client):
+        import flask
+        with collegejump.app.test_request_context('/'):
+            url = flask.url_for('send_static', path='theme.css')
+        assert '?v=' in url
+
+        rv = client.get(url)
+        assert rv.status_code == 200
+        assert 'immutable' in rv.headers['Cache-Control']
+
+        rv = client.get('/static/theme.css?v=stale')
+        assert 'immutable' not in rv.headers['Cache-Control']
+
+    def test_pack(self):
+        import os
+        from collegejump import compression
+        text = b'student,answer\n' * 1000
+        for data in (b'', text, os.urandom(1000), b'PK\x03\x04' + text,
+                     compression.STORED_MAGIC + b'!'):
+            packed = compression.pack(data)
+            assert compression.unpack(packed) == data
+            assert b''.join(compression.unpack_stream(packed, chunk_size=100)) == data
+        assert len(compression.pack(text)) < len(text) // 5
+        # Already compressed formats are stored as they are.
+        assert compression.pack(b'PK\x03\x04' + text) == b'PK\x03\x04' + text
+
+    def test_stored_compressed(self, collegejump, client, people):
+        import os
+        import sqlalchemy
+        from collegejump import compression, database
+        models = collegejump.models
+        db = collegejump.app.db
+        text = 'An essay about compression. ' * 200
+        with collegejump.app.app_context():
+            document = models.Document('notes.txt', text.encode('utf-8'))
+            # Write one submission as it was stored before compression.
+            legacy = models.Submission(author_id=people['student'],
+                                       timestamp=datetime.datetime.now())
+            db.session.add_all([document, legacy])
+            db.session.commit()
+            table = models.Submission.__table__
+            db.session.execute(table.update().where(table.c.id == legacy.id)
+                               .values(text=sqlalchemy.literal_column("'" + text + "'")))
+            db.session.commit()
+
+            def stored(table, column, row_id):
+                return db.session.execute(
+                    sqlalchemy.select([sqlalchemy.type_coerce(table.c[column],
+                                                              sqlalchemy.types.NullType())])
+                    .where(table.c.id == row_id)).scalar()
+            assert compression.is_packed(stored(models.Document.__table__, 'data', document.id))
+            assert stored(table, 'text', legacy.id) == text
+
+            # Values which wouldn't shrink are left as they are.
+            noise = models.Document('noise.bin', os.urandom(1000))
+            db.session.add(noise)
+            db.session.commit()
+
+            assert database.recompress(vacuum=False) >= 1
+            assert compression.is_packed(stored(table, 'text', legacy.id))
+            assert database.recompress(vacuum=False) == 0
+            db.session.expire_all()
+            assert models.Submission.query.get(legacy.id).text == text
+            document_id = document.id
+
+        login(client, 'student')
+        rv = client.get('/document/{}'.format(document_id))
+        assert rv.data == text.encode('utf-8')
+        assert 'notes.txt' in rv.headers['Content-Disposition']
+        assert rv.headers['Content-Length'] == str(len(rv.data))
+
+        rv = client.get('/document/{}'.format(document_id),
+                        headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+
+        rv = client.get('/document/{}'.format(document_id), headers={'Range': 'bytes=3-9'})
+        assert rv.status_code == 206
+        assert rv.data == text.encode('utf-8')[3:10]
+        client.get('/logout')
+
+class TestImages():
+
+    def test_variants(self, collegejump, client, monkeypatch, tmpdir):
+        pytest.importorskip('PIL')
+        monkeypatch.setitem(collegejump.app.config, 'IMAGE_CACHE_DIR', str(tmpdir))
+
+        rv = client.get('/image/50/cj.jpg', headers={'Accept': 'image/webp,*/*'})
+        assert rv.status_code == 200
+        assert rv.mimetype == 'image/webp'
+
+        rv = client.get('/image/50/cj.jpg', headers={'Accept': '*/*'})
+        assert rv.mimetype == 'image/jpeg'
+        assert len(rv.data) < 10000
+
+        assert client.get('/image/37/cj.jpg').status_code == 404
+        assert client.get('/image/50/theme.css').status_code == 404
+
+    def test_broken_and_stale(self, collegejump, client, monkeypatch, tmpdir):
+        pytest.importorskip('PIL')
+        import os
+        import shutil
+        from collegejump import assets
+        static, cache = tmpdir.mkdir('static'), tmpdir.mkdir('cache')
+        monkeypatch.setattr(assets, 'STATIC_DIR', str(static))
+        monkeypatch.setitem(collegejump.app.config, 'IMAGE_CACHE_DIR', str(cache))
+
+        static.join('broken.jpg').write(b'not an image')
+        assert client.get('/image/50/broken.jpg').status_code == 404
+
+        # Only the variant of the image's current version is kept.
+        image = str(static.join('photo.jpg'))
+        shutil.copy(os.path.join(collegejump.app.root_path, 'static', 'cj.jpg'), image)
+        assert client.get('/image/50/photo.jpg').status_code == 200
+        with open(image, 'ab') as appended:
+            appended.write(b'\0')
+        os.utime(image, (0, 0))
+        assert client.get('/image/50/photo.jpg').status_code == 200
+        assert len(cache.listdir()) == 1
+
+class TestAnnouncementPages():
+
+    def test_feed_pages(self, collegejump, client, people):
+        import json
+        models = collegejump.models
+        with collegejump.app.app_context():
+            for i in range(5):
+                collegejump.app.db.session.add(
+                    models.Announcement('admin@email.com', 'Paged {}'.format(i), 'Body'))
+            collegejump.app.db.session.commit()
+            total = models.Announcement.query.count()
+
+        seen = []
+        url = '/announcement/feed.json?per_page=2'
+        while url:
+            feed = json.loads(client.get(url).data.decode('utf-8'))
+            assert len(feed['items']) <= 2
+            seen.extend(item['id'] for item in feed['items'])
+            url = feed.get('next_url')
+        assert len(seen) == len(set(seen)) == total
+
+    def test_older_link(self, client, people):
+        rv = client.get('/announcement/?per_page=2')
+        assert b'Older' in rv.data
+        assert client.get('/announcement/?before=garbage').status_code == 400
+
+
+class TestUserDirectory():
+
+    def test_filters(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            def emails(**kwargs):
+                return [row.email for row in models.User.directory(**kwargs)]
+
+            assert emails(search='STU') == ['student@email.com']
+            assert emails(search='mentor@') == ['mentor@email.com']
+            assert emails(role='admin') == ['admin@email.com']
+            assert emails(role='student', search='student') == ['student@email.com']
+            assert emails(mentor_id=people['mentor']) == ['student@email.com']
+            assert 'student@email.com' in emails(semester_id=people['semester'])
+
+    def test_page(self, client, people):
+        login(client, 'admin')
+        rv = client.get('/account/all?search=stu')
+        assert b'student@email.com' in rv.data
+        assert b'mentor@email.com' not in rv.data
+        rv = client.get('/account/all?mentor=nobody@email.com')
+        assert rv.status_code == 200
+        assert b'has-error' in rv.data
+
+
+class TestSearch():
+
+    @pytest.fixture(scope="class")
+    def submitted(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            assignment = models.Assignment(name='Essay', instructions='Describe a giraffe')
+            week = models.Week.query.filter_by(semester_id=people['semester']).first()
+            week.assignments.append(assignment)
+            submission = models.Submission(text='Giraffes have long necks',
+                                           author_id=people['student'], assignment=assignment)
+            hidden = models.Submission(text='Giraffes are tall', author_id=people['admin'],
+                                       assignment=assignment)
+            collegejump.app.db.session.add_all([submission, hidden])
+            collegejump.app.db.session.commit()
+            return submission.id
+
+    def hits(self, collegejump, role, query, people):
+        with collegejump.app.test_request_context():
+            principal = collegejump.models.UserPrincipal.load(people[role])
+            return collegejump.search.search(principal, query)[0]
+
+    def test_visibility(self, collegejump, people, submitted):
+        from collegejump import search
+        assert isinstance(collegejump.app.search_index, search.FTSIndex)
+        student = self.hits(collegejump, 'student', 'describe', people)
+        assert {h.kind for h in student} == {'assignment'}
+        student = self.hits(collegejump, 'student', 'giraffes', people)
+        assert [(h.kind, h.id) for h in student] == [('submission', submitted)]
+        assert '<mark>Giraffes</mark>' in student[0].snippet
+        assert len(self.hits(collegejump, 'mentor', 'giraffes', people)) == 1
+        assert len(self.hits(collegejump, 'admin', 'giraffes', people)) == 2
+        # The last word is matched as a prefix.
+        assert len(self.hits(collegejump, 'admin', 'long ne', people)) == 1
+
+    def test_memory_index(self, collegejump, people, submitted):
+        from collegejump import search
+        with collegejump.app.test_request_context():
+            index = search.MemoryIndex(collegejump.app.db.engine)
+            scope = search.Scope(collegejump.models.UserPrincipal.load(people['student']))
+            rows = index.search(scope, ['giraffes'], 10, 0)
+            assert [search._unpack(rowid) for rowid, _ in rows] == [('submission', submitted)]
+            assert index.search(scope, ['gir'], 10, 0)
+
+    def test_page(self, client, people, submitted):
+        login(client, 'student')
+        rv = client.get('/search?q=necks')
+        assert b'<mark>necks</mark>' in rv.data
+        client.get('/logout')
+
+
+class TestGrading():
+
+    def test_pending_feedback(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            assignment = models.Assignment(name='Poem', instructions='Write a poem')
+            week = models.Week.query.filter_by(semester_id=people['semester']).first()
+            week.assignments.append(assignment)
+            graded = models.Submission(text='Roses', author_id=people['student'],
+                                       assignment=assignment,
+                                       timestamp=datetime.datetime.now())
+            pending = models.Submission(text='Violets', author_id=people['student'],
+                                        assignment=assignment,
+                                        timestamp=datetime.datetime.now())
+            collegejump.app.db.session.add_all([graded, pending])
+            collegejump.app.db.session.add(models.Feedback(submission=graded, text='Nice',
+                                                           author_id=people['mentor']))
+            collegejump.app.db.session.commit()
+
+            mentor = models.UserPrincipal.load(people['mentor'])
+            ids = [s.id for s in mentor.pending_feedback(week.id)]
+            assert pending.id in ids and graded.id not in ids
+            counts = {row[0]: row[-1] for row in mentor.pending_feedback_by_week()}
+            assert counts[week.id] == len(ids)
+
+            student = models.UserPrincipal.load(people['student'])
+            assert student.pending_feedback().count() == 0
+
+    def test_submissions_for_feedback(self, collegejump, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            assignment = models.Assignment.query.filter_by(name='Poem').one()
+            for role, count in (('admin', 2), ('mentor', 2), ('student', 0)):
+                principal = models.UserPrincipal.load(people[role])
+                submissions = principal.submissions_for_feedback(assignment).all()
+                assert len(submissions) == count
+                # Attachments are left in the database.
+                assert all('filedata' not in s.__dict__ for s in submissions)
+            admin = models.UserPrincipal.load(people['admin'])
+            timestamps = [s.timestamp for s in admin.submissions_for_feedback(assignment)]
+            assert timestamps == sorted(timestamps, reverse=True)
+
+    def test_page(self, client, people):
+        login(client, 'mentor')
+        rv = client.get('/grading')
+        assert b'Violets' in rv.data and b'Roses' not in rv.data
+        client.get('/logout')
+        login(client, 'student')
+        assert client.get('/grading').status_code == 403
+        client.get('/logout')
+
+
+class TestSubmissionsArchive():
+
+    def test_download(self, collegejump, client, people):
+        import io, zipfile
+        models = collegejump.models
+        with collegejump.app.app_context():
+            assignment = models.Assignment(name='Drawing', instructions='Draw a cat')
+            submission = models.Submission(text='Here it is', author_id=people['student'],
+                                           assignment=assignment, filename='cat.png',
+                                           filedata=b'\x89PNG' * 1000,
+                                           timestamp=datetime.datetime.now())
+            collegejump.app.db.session.add(submission)
+            collegejump.app.db.session.commit()
+            assignment_id, submission_id = assignment.id, submission.id
+
+        login(client, 'mentor')
+        rv = client.get('/assignment/{}/submissions.zip'.format(assignment_id))
+        archive = zipfile.ZipFile(io.BytesIO(rv.data))
+        folder = 'Student-{}/'.format(submission_id)
+        assert archive.read(folder + 'response.txt') == b'Here it is'
+        assert archive.read(folder + 'cat.png') == b'\x89PNG' * 1000
+        client.get('/logout')
+
+        login(client, 'student')
+        rv = client.get('/assignment/{}/submissions.zip'.format(assignment_id))
+        assert rv.status_code == 403
+        client.get('/logout')
+
+
+class TestWeekPage():
+
+    def count_queries(self, collegejump, client, url):
+        from sqlalchemy import event
+        queries = []
+        def count(*args):
+            queries.append(args)
+        with collegejump.app.app_context():
+            engine = collegejump.app.db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            assert client.get(url).status_code == 200
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return len(queries)
+
+    def test_fixed_queries(self, collegejump, client, people):
+        models = collegejump.models
+        login(client, 'mentor')
+        url = '/semester/{}/week/1'.format(people['semester'])
+        client.get(url)
+        before = self.count_queries(collegejump, client, url)
+
+        with collegejump.app.app_context():
+            week = models.Week.query.filter_by(semester_id=people['semester']).one()
+            for i in range(5):
+                submission = models.Submission(text='More {}'.format(i),
+                                               author_id=people['student'],
+                                               assignment=week.assignments[0],
+                                               timestamp=datetime.datetime.now())
+                collegejump.app.db.session.add(models.Feedback(submission=submission,
+                                                               text='Good',
+                                                               author_id=people['mentor']))
+            collegejump.app.db.session.commit()
+
+        assert self.count_queries(collegejump, client, url) == before
+        client.get('/logout')
+
+
+class TestWeekOrder():
+
+    def headers(self, collegejump, semester_id):
+        with collegejump.app.app_context():
+            return [w.header for w in collegejump.models.Week.query
+                    .filter_by(semester_id=semester_id).order_by('week_num')]
+
+    def test_reorder(self, collegejump, client, people):
+        models = collegejump.models
+        with collegejump.app.app_context():
+            semester = models.Semester('Reordered', 10)
+            collegejump.app.db.session.add(semester)
+            collegejump.app.db.session.commit()
+            semester_id = semester.id
+
+        login(client, 'admin')
+        url = '/syllabus/semester/{}'.format(semester_id)
+        for header in 'ABCDE':
+            client.post(url, data={'header': header, 'intro': 'Intro'})
+        assert self.headers(collegejump, semester_id) == list('ABCDE')
+        assert b'/week/5/move' in client.get(url).data
+
+        client.post(url + '/week/1/move', data={'week_num': 4})
+        assert self.headers(collegejump, semester_id) == list('BCDAE')
+        client.post(url + '/week/5/move', data={'week_num': 2})
+        assert self.headers(collegejump, semester_id) == list('BECDA')
+        # Positions past the end move the week to the end.
+        client.post(url + '/week/1/move', data={'week_num': 99})
+        assert self.headers(collegejump, semester_id) == list('ECDAB')
+
+        client.post(url + '/week/2', data={'delete': 'Delete'})
+        assert self.headers(collegejump, semester_id) == list('EDAB')
+        client.post(url, data={'header': 'F', 'intro': 'Intro'})
+        with collegejump.app.app_context():
+            assert [w.week_num for w in models.Week.query.filter_by(semester_id=semester_id)
+                    .order_by('week_num')] == [1, 2, 3, 4, 5]
+        assert self.headers(collegejump, semester_id) == list('EDABF')
+        client.get('/logout')
+
+    def test_unique(self, collegejump, people):
+        from sqlalchemy.exc import IntegrityError
+        models = collegejump.models
+        with collegejump.app.app_context():
+            collegejump.app.db.session.add(
+                models.Week(people['semester'], 1, 'Duplicate', 'Intro'))
+            with pytest.raises(IntegrityError):
+                collegejump.app.db.session.commit()
+            collegejump.app.db.session.rollback()
+
+    def test_upgrade_renumbers_repeats(self, collegejump):
+        # Databases from before week numbers were unique may repeat them.
+        from collegejump import database
+        models = collegejump.models
+        db = collegejump.app.db
+        with collegejump.app.app_context():
+            semester = models.Semester('Repeated', 11)
+            db.session.add(semester)
+            db.session.commit()
+            semester_id = semester.id
+            db.engine.execute('DROP INDEX ux_week_semester_id_week_num')
+            db.session.add_all([models.Week(semester_id, n, h, '')
+                                for n, h in ((2, 'B'), (1, 'A'), (2, 'C'), (5, 'D'))])
+            db.session.commit()
+
+            database.upgrade_db()
+            assert [(w.week_num, w.header) for w in models.Week.query
+                    .filter_by(semester_id=semester_id).order_by('week_num')] \
+                    == [(1, 'A'), (2, 'B'), (3, 'C'), (4, 'D')]
+            assert not list(database.missing_schema(db.engine.connect()))
+
+
+class TestCloneSemester():
+
+    def test_clone(self, collegejump, client, people):
+        from collegejump import search
+        models = collegejump.models
+        db = collegejump.app.db
+        with collegejump.app.app_context():
+            semester = models.Semester('Template', 20)
+            db.session.add(semester)
+            db.session.flush()
+            document = models.Document('handout.txt', b'handout')
+            for num in (1, 2):
+                week = models.Week(semester.id, num, 'Cloned week {}'.format(num), 'Quokkas')
+                week.assignments = [models.Assignment(name='Essay {}'.format(num),
+                                                      instructions='Write')]
+                week.documents = [document]
+                db.session.add(week)
+            db.session.commit()
+            semester_id = semester.id
+
+        login(client, 'admin')
+        rv = client.post('/syllabus/semester/{}/clone'.format(semester_id),
+                         data={'clone-name': 'Copy', 'clone-order': 21})
+        assert rv.status_code == 302
+
+        with collegejump.app.app_context():
+            copy = models.Semester.query.filter_by(name='Copy').one()
+            original = models.Semester.query.get(semester_id)
+            assert [(w.week_num, w.header) for w in copy.weeks] \
+                    == [(w.week_num, w.header) for w in original.weeks]
+            for old, new in zip(original.weeks, copy.weeks):
+                assert new.id != old.id
+                assert [a.name for a in new.assignments] == [a.name for a in old.assignments]
+                assert new.assignments[0].id != old.assignments[0].id
+                # The document is shared, not copied.
+                assert [d.id for d in new.documents] == [d.id for d in old.documents]
+            assert models.Document.query.filter_by(name='handout.txt').count() == 1
+
+            week_ids = sorted(w.id for w in original.weeks + copy.weeks)
+
+        # The copies can be found by searching.
+        with collegejump.app.test_request_context():
+            principal = models.UserPrincipal.load(people['admin'])
+            assert sorted(hit.id for hit in search.search(principal, 'quokkas')[0]) == week_ids
+
+        # Orders must still be unique.
+        client.post('/syllabus/semester/{}/clone'.format(semester_id),
+                    data={'clone-name': 'Another', 'clone-order': 21})
+        with collegejump.app.app_context():
+            assert models.Semester.query.filter_by(name='Another').count() == 0
+        client.get('/logout')
+
+
+class TestArchive():
+
+    def test_archive_and_restore(self, collegejump, client, people, monkeypatch, tmpdir):
+        from collegejump import search
+        models = collegejump.models
+        db = collegejump.app.db
+        monkeypatch.setitem(collegejump.app.config, 'ARCHIVE_DIR', str(tmpdir.join('archives')))
+        monkeypatch.setitem(collegejump.app.config, 'ARCHIVE_CACHE_DIR',
+                            str(tmpdir.join('cache')))
+
+        with collegejump.app.app_context():
+            semester = models.Semester('Bygone', 30)
+            other = models.Semester('Current', 31)
+            student = models.User.query.get(people['student'])
+            student.semesters.append(semester)
+            db.session.add_all([semester, other])
+            db.session.flush()
+            shared = models.Document('shared.txt', b'shared')
+            week = models.Week(semester.id, 1, 'Bygone week', 'Wombats')
+            week.assignments = [models.Assignment(name='Old essay', instructions='Write')]
+            week.documents = [shared, models.Document('old.txt', b'old')]
+            current = models.Week(other.id, 1, 'Current week', 'Intro')
+            current.documents = [shared]
+            submission = models.Submission(text='My wombat essay', author_id=people['student'],
+                                           assignment=week.assignments[0],
+                                           filename='essay.txt', filedata=b'essay',
+                                           timestamp=datetime.datetime.now())
+            feedback = models.Feedback(submission=submission, text='Fine work',
+                                       author_id=people['mentor'])
+            db.session.add_all([week, current, submission, feedback])
+            db.session.commit()
+            semester_id = semester.id
+            before = {'week': week.id, 'submission': submission.id,
+                      'document': week.documents[1].id, 'shared': shared.id}
+
+        def found(role, query):
+            with collegejump.app.test_request_context():
+                principal = models.UserPrincipal.load(people[role])
+                return [hit.kind for hit in search.search(principal, query)[0]]
+        assert sorted(found('admin', 'wombat')) == ['submission', 'week']
+
+        login(client, 'admin')
+        client.post('/syllabus/semester/{}/archive'.format(semester_id))
+        with collegejump.app.app_context():
+            assert models.Semester.query.get(semester_id).archive_path
+            assert models.Week.query.filter_by(semester_id=semester_id).count() == 0
+            assert models.Submission.query.get(before['submission']) is None
+            assert models.Document.query.get(before['document']) is None
+            # The document shared with another semester stays.
+            assert models.Document.query.get(before['shared']) is not None
+        assert len(tmpdir.join('archives').listdir()) == 1
+        assert found('admin', 'wombat') == []
+        client.get('/logout')
+
+        # The student may still see the archived week, their submission, and its
+        # feedback.
+        login(client, 'student')
+        rv = client.get('/archive/semester/{}/week/1'.format(semester_id))
+        assert rv.status_code == 200
+        assert b'My wombat essay' in rv.data and b'Fine work' in rv.data
+        rv = client.get('/archive/semester/{}/document/{}'.format(semester_id,
+                                                                  before['document']))
+        assert rv.data == b'old'
+        rv = client.get('/archive/semester/{}/submission/{}/attachment'.format(
+            semester_id, before['submission']))
+        assert rv.data == b'essay'
+        client.get('/logout')
+
+        # Ids may be reused while the semester is archived.
+        with collegejump.app.app_context():
+            db.session.execute(models.Document.__table__.insert().values(
+                id=before['document'], name='new.txt', data=b'new'))
+            db.session.commit()
+
+        login(client, 'admin')
+        client.post('/syllabus/semester/{}/restore'.format(semester_id))
+        with collegejump.app.app_context():
+            assert models.Semester.query.get(semester_id).archive_path is None
+            week = models.Week.query.filter_by(semester_id=semester_id).one()
+            assert week.id == before['week']
+            assert sorted(d.name for d in week.documents) == ['old.txt', 'shared.txt']
+            assert models.Document.query.get(before['document']).name == 'new.txt'
+            submission = week.assignments[0].submissions[0]
+            assert submission.id == before['submission'] and submission.filedata == b'essay'
+            assert [f.text for f in submission.all_feedback] == ['Fine work']
+        assert tmpdir.join('archives').listdir() == []
+        assert sorted(found('admin', 'wombat')) == ['submission', 'week']
+        client.get('/logout')
+
+    def test_restore_after_shared_deleted(self, collegejump, monkeypatch, tmpdir):
+        from collegejump import archive
+        models = collegejump.models
+        db = collegejump.app.db
+        monkeypatch.setitem(collegejump.app.config, 'ARCHIVE_DIR', str(tmpdir.join('archives')))
+        monkeypatch.setitem(collegejump.app.config, 'ARCHIVE_CACHE_DIR',
+                            str(tmpdir.join('cache')))
+
+        with collegejump.app.app_context():
+            semester = models.Semester('Long gone', 32)
+            other = models.Semester('Also gone', 33)
+            db.session.add_all([semester, other])
+            db.session.flush()
+            shared = models.Document('handout.txt', b'handout')
+            week = models.Week(semester.id, 1, 'Long gone week', 'Intro')
+            week.documents = [shared]
+            other_week = models.Week(other.id, 1, 'Also gone week', 'Intro')
+            other_week.documents = [shared]
+            db.session.add_all([week, other_week])
+            db.session.commit()
+            archive.archive_semester(semester)
+
+            # The other semester goes, and the document with it.
+            db.session.execute(models.week_documents.delete().where(
+                models.week_documents.c.week_id == other_week.id))
+            db.session.delete(other_week)
+            db.session.delete(models.Document.query.get(shared.id))
+            db.session.commit()
+
+            archive.restore_semester(models.Semester.query.get(semester.id))
+            week = models.Week.query.filter_by(semester_id=semester.id).one()
+            assert [(d.name, d.data) for d in week.documents] == [('handout.txt', b'handout')]
+
+
+class TestUploads():
+
+    def test_resumable_upload(self, collegejump, client, people, monkeypatch, tmpdir):
+        models = collegejump.models
+        db = collegejump.app.db
+        monkeypatch.setitem(collegejump.app.config, 'UPLOAD_DIR', str(tmpdir))
+        with collegejump.app.app_context():
+            semester = models.Semester('Uploads', 40)
+            student = models.User.query.get(people['student'])
+            student.semesters.append(semester)
+            db.session.add(semester)
+            db.session.flush()
+            week = models.Week(semester.id, 1, 'Upload week', 'Intro')
+            week.assignments = [models.Assignment(name='Worksheet', instructions='Scan it')]
+            db.session.add(week)
+            db.session.commit()
+            semester_id = semester.id
+
+        data = bytes(range(256)) * 10
+        login(client, 'student')
+        rv = client.post('/upload', json={'purpose': 'submission', 'filename': 'scan.png',
+                                          'size': collegejump.app.config['MAX_ATTACHMENT_SIZE'] + 1})
+        assert rv.status_code == 413
+        rv = client.post('/upload', json={'purpose': 'document', 'filename': 'notes.txt',
+                                          'size': 10})
+        assert rv.status_code == 403
+
+        rv = client.post('/upload', json={'purpose': 'submission', 'filename': 'scan.png',
+                                          'size': len(data)})
+        assert rv.status_code == 201
+        url = rv.get_json()['url']
+
+        assert client.put(url + '?offset=0', data=data[:1000]).get_json()['offset'] == 1000
+        # Sending the same chunk again, as after a lost reply, is harmless.
+        rv = client.put(url + '?offset=0', data=data[:1000])
+        assert rv.status_code == 409 and rv.get_json()['offset'] == 1000
+        assert client.get(url).get_json()['offset'] == 1000
+        rv = client.put(url + '?offset=1000', data=data[1000:] + b'extra')
+        assert rv.status_code == 413
+        rv = client.put(url + '?offset=1000', data=data[1000:])
+        upload_id = rv.get_json()['id']
+        assert rv.get_json()['offset'] == len(data)
+
+        rv = client.post('/semester/{}/week/1'.format(semester_id),
+                         data={'response': 'Scanned worksheet', 'upload': upload_id})
+        assert rv.status_code == 302
+        with collegejump.app.app_context():
+            submission = models.Submission.query.filter_by(text='Scanned worksheet').one()
+            assert submission.filename == 'scan.png' and submission.filedata == data
+            assert models.Upload.query.get(upload_id) is None
+        assert tmpdir.listdir() == []
+        client.get('/logout')
+
+
+class TestBodyLimits():
+
+    def test_limits(self, collegejump, client, people):
+        import io
+        config = collegejump.app.config
+        login(client, 'student')
+        # Ordinary forms only take MAX_CONTENT_LENGTH.
+        rv = client.post('/login', data={'email': 'x' * config['MAX_CONTENT_LENGTH']})
+        assert rv.status_code == 413
+        assert b'at most 1 MB' in rv.data
+
+        # A week's page takes an attachment on top of the rest of the form.
+        week_url = '/semester/{}/week/1'.format(people['semester'])
+        attachment = b'x' * (2 * config['MAX_CONTENT_LENGTH'])
+        rv = client.post(week_url, data={'response': 'Too big',
+                                         'attachment': (io.BytesIO(attachment), 'big.bin')})
+        assert rv.status_code != 413
+        old_size = config['MAX_ATTACHMENT_SIZE']
+        config['MAX_ATTACHMENT_SIZE'] = 1024
+        try:
+            rv = client.post(week_url, data={'response': 'Too big',
+                                             'attachment': (io.BytesIO(attachment), 'big.bin')})
+            assert rv.status_code == 413
+        finally:
+            config['MAX_ATTACHMENT_SIZE'] = old_size
+        client.get('/logout')
+
+    def test_spooled(self, collegejump):
+        import io
+        import flask
+        app = collegejump.app
+        size = app.config['FORM_SPOOL_SIZE']
+        for length, on_disk in ((size // 2, False), (size * 2, True)):
+            data = {'file': (io.BytesIO(b'x' * length), 'file.bin')}
+            with app.test_request_context('/database/', method='POST', data=data):
+                stream = flask.request.files['file'].stream
+                assert stream._rolled == on_disk # pylint: disable=protected-access
+                assert len(stream.read()) == length
+
+
+class TestApi():
+
+    def test_api(self, collegejump, client, people):
+        models = collegejump.models
+        db = collegejump.app.db
+        with collegejump.app.app_context():
+            student = models.User.query.get(people['student'])
+            semester, hidden = models.Semester('API', 50), models.Semester('Hidden', 51)
+            student.semesters.append(semester)
+            db.session.add_all([semester, hidden])
+            db.session.flush()
+            assignment = models.Assignment(name='Essay', instructions='Write')
+            weeks = [models.Week(semester.id, n, 'API week {}'.format(n), '') for n in (1, 2)]
+            weeks[0].assignments = [assignment]
+            db.session.add_all(weeks)
+            db.session.add(models.Submission(text='My essay', author=student,
+                                             assignment=assignment,
+                                             timestamp=datetime.datetime.now()))
+            db.session.commit()
+            semester_id, hidden_id, assignment_id = semester.id, hidden.id, assignment.id
+
+        assert client.get('/api/v1/semesters').status_code == 401
+
+        login(client, 'student')
+        rv = client.get('/api/v1/semesters?fields=id,name')
+        assert {'id': semester_id, 'name': 'API'} in rv.get_json()['data']
+        assert hidden_id not in [s['id'] for s in rv.get_json()['data']]
+        rv = client.get('/api/v1/semesters?fields=id', headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 200
+        assert client.get('/api/v1/semesters?fields=id',
+                          headers={'If-None-Match': rv.headers['ETag']}).status_code == 304
+        rv = client.get('/api/v1/semesters?fields=id,secret')
+        assert rv.status_code == 400 and 'secret' in rv.get_json()['error']
+        assert client.get('/api/v1/semesters/{}'.format(hidden_id)).status_code == 403
+        assert client.get('/api/v1/nothing').get_json()['status'] == 404
+
+        rv = client.get('/api/v1/semesters/{}/weeks?per_page=1'.format(semester_id))
+        first = rv.get_json()
+        assert [w['header'] for w in first['data']] == ['API week 1']
+        assert first['data'][0]['assignment_ids'] == [assignment_id]
+        second = client.get(first['next']).get_json()
+        assert [w['header'] for w in second['data']] == ['API week 2']
+        assert second['next'] is None
+
+        rv = client.get('/api/v1/submissions?assignment_id={}'.format(assignment_id))
+        mine = rv.get_json()['data']
+        assert [s['text'] for s in mine] == ['My essay'] and mine[0]['feedback'] == []
+        url = '/api/v1/assignments/{}/submissions'.format(assignment_id)
+        assert client.get(url).status_code == 403
+        client.get('/logout')
+
+        login(client, 'mentor')
+        rv = client.get(url + '?fields=id,author')
+        assert rv.get_json()['data'] == [{'id': mine[0]['id'], 'author': 'Student'}]
+        assert client.get('/api/v1/submissions/{}'.format(mine[0]['id'])).status_code == 200
+        client.get('/logout')
+
+
+class TestEvents():
+
+    def test_published(self, collegejump, people):
+        models = collegejump.models
+        events = collegejump.events
+        db = collegejump.app.db
+        student = events.broker.subscribe(people['student'])
+        mentor = events.broker.subscribe(people['mentor'])
+        try:
+            with collegejump.app.app_context():
+                author = models.User.query.get(people['student'])
+                submission = models.Submission(text='Live', author=author,
+                                               timestamp=datetime.datetime.now())
+                db.session.add(submission)
+                db.session.commit()
+                assert [e.kind for e in mentor.take(0)] == ['submission']
+                assert student.take(0) == []
+
+                # Nothing is published for a change which is rolled back.
+                db.session.add(models.Feedback(submission=submission, text='Oops'))
+                db.session.flush()
+                db.session.rollback()
+                assert student.take(0) == []
+
+                db.session.add(models.Feedback(submission=submission, text='Good'))
+                db.session.add(models.Announcement('admin@email.com', 'Live', 'News'))
+                db.session.commit()
+                assert sorted(e.kind for e in student.take(0)) == ['announcement', 'feedback']
+                assert [e.kind for e in mentor.take(0)] == ['announcement']
+
+                # Events from other processes are relayed from the table.
+                last_id = db.session.query(db.func.max(models.Event.id)).scalar()
+                db.session.add(models.Event(user_id=people['mentor'], kind='submission',
+                                            data='{}', origin='elsewhere'))
+                db.session.commit()
+                assert mentor.take(0) == []
+                assert events.relay_once(last_id) == last_id + 1
+                assert [e.id for e in mentor.take(0)] == [last_id + 1]
+        finally:
+            events.broker.unsubscribe(student)
+            events.broker.unsubscribe(mentor)
+
+    def test_ids_not_reused(self, collegejump):
+        models = collegejump.models
+        db = collegejump.app.db
+        with collegejump.app.app_context():
+            db.session.add(models.Event(kind='announcement', data='{}', origin='elsewhere'))
+            db.session.commit()
+            last_id = db.session.query(db.func.max(models.Event.id)).scalar()
+            models.Event.query.delete()
+            db.session.commit()
+            event = models.Event(kind='announcement', data='{}', origin='elsewhere')
+            db.session.add(event)
+            db.session.commit()
+            assert event.id > last_id
+
+    def test_stream(self, collegejump, client, people, monkeypatch):
+        models = collegejump.models
+        events = collegejump.events
+        db = collegejump.app.db
+        with collegejump.app.app_context():
+            event = models.Event(user_id=people['student'], kind='feedback', data='{}',
+                                 origin='elsewhere')
+            db.session.add(event)
+            db.session.commit()
+            event_id = event.id
+
+        login(client, 'student')
+        # Streams are only served when each needn't take a thread.
+        assert client.get('/events').status_code == 404
+        monkeypatch.setitem(collegejump.app.config, 'EVENT_STREAMS', True)
+        rv = client.get('/events', headers={'Last-Event-ID': str(event_id - 1)},
+                        buffered=False)
+        assert rv.mimetype == 'text/event-stream'
+        chunks = iter(rv.response)
+        assert next(chunks).startswith(b'retry:')
+        assert next(chunks) == 'id: {}\nevent: feedback\ndata: {{}}\n\n'.format(
+            event_id).encode()
+        assert events.broker.count() == 1
+        rv.close()
+        assert events.broker.count() == 0
+        client.get('/logout')
+
+
+class TestNotifications():
+
+    def test_digests(self, collegejump, people):
+        import asyncore
+        import email
+        import smtpd
+        import threading
+        models = collegejump.models
+        notifications = collegejump.notifications
+        db = collegejump.app.db
+        config = collegejump.app.config
+
+        # A local SMTP server, which keeps what it receives.
+        received, refusals = {}, {}
+        class Server(smtpd.SMTPServer):
+            def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+                if rcpttos[0] in refusals:
+                    return refusals[rcpttos[0]]
+                received[rcpttos[0]] = email.message_from_bytes(data)
+        server = Server(('127.0.0.1', 0), None)
+        threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1}, daemon=True).start()
+        config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.socket.getsockname()[1])
+        try:
+            with collegejump.app.app_context():
+                # Notifications are queued all along, but only these are tested.
+                models.Notification.query.delete()
+                student = models.User.query.get(people['student'])
+                submission = models.Submission(text='Mail', author=student,
+                                               timestamp=datetime.datetime.now())
+                db.session.add(submission)
+                db.session.commit()
+                db.session.add(models.Feedback(submission=submission, text='Nice',
+                                               author=models.User.query.get(people['mentor'])))
+                db.session.add(models.Announcement('admin@email.com', 'Mailed', 'News'))
+                db.session.commit()
+                users = models.User.query.count()
+
+                # Nothing is sent until the oldest has waited, so more can join it.
+                assert notifications.send_digests() == 0
+                later = datetime.datetime.now() + datetime.timedelta(
+                    seconds=config['NOTIFICATION_DELAY'] + 1)
+                assert notifications.send_digests(later) == users
+                assert notifications.send_digests(later) == 0
+
+            digest = received['student@email.com']
+            assert digest['Subject'] == 'College JUMP: 2 new updates'
+            assert 'Mentor left feedback' in digest.get_payload()
+            assert 'New announcement: Mailed' in digest.get_payload()
+            digest = received['mentor@email.com']
+            assert 'Student submitted an assignment.' in digest.get_payload()
+
+            # Digests refused for good are dropped, and others kept for later,
+            # without holding up anyone else's.
+            received.clear()
+            refusals.update({'student@email.com': '550 No thanks',
+                             'mentor@email.com': '451 Try later'})
+            with collegejump.app.app_context():
+                db.session.add(models.Announcement('admin@email.com', 'Refused', 'News'))
+                db.session.commit()
+                later += datetime.timedelta(seconds=config['NOTIFICATION_DELAY'] + 1)
+                assert notifications.send_digests(later) == users - 2
+                refusals.clear()
+                assert notifications.send_digests(later) == 1
+            assert 'mentor@email.com' in received
+            assert 'student@email.com' not in received
+
+            # Notifications claimed by another process's worker are left to
+            # it, unless it has stopped.
+            received.clear()
+            with collegejump.app.app_context():
+                db.session.add(models.Announcement('admin@email.com', 'Claimed', 'News'))
+                db.session.commit()
+                later += datetime.timedelta(seconds=config['NOTIFICATION_DELAY'] + 1)
+                user_ids = [user_id for (user_id,) in db.session.query(models.User.id)]
+                notifications._claim(user_ids, later) # pylint: disable=protected-access
+                assert notifications.send_digests(later) == 0
+                assert notifications.send_digests(later + notifications.CLAIM_TIMEOUT
+                                                  + datetime.timedelta(seconds=1)) == users
+        finally:
+            config['MAIL_SERVER'] = None
+            server.close()
+
+
+class TestTemplates():
+
+    def test_compile_templates(self, collegejump, tmpdir):
+        from collegejump import assets, cache
+        env = collegejump.app.jinja_env
+        original = env.bytecode_cache
+        env.bytecode_cache = cache.TemplateBytecodeCache(str(tmpdir))
+        env.cache.clear()
+        try:
+            with collegejump.app.app_context():
+                names = assets.compile_templates()
+        finally:
+            env.bytecode_cache = original
+        assert 'theme.html' in names and 'bootstrap/base.html' in names
+        assert len(tmpdir.listdir()) == len(names)
+
+
+class TestHealth():
+
+    def test_probes(self, collegejump, client):
+        rv = client.get('/healthz')
+        assert rv.status_code == 200 and rv.data == b'ok\n'
+        assert 'Set-Cookie' not in rv.headers
+        rv = client.get('/readyz')
+        assert rv.status_code == 200 and rv.data == b'ready\n'
+
+    def test_missing_schema(self, collegejump):
+        from collegejump import database
+        with collegejump.app.app_context():
+            with collegejump.app.db.engine.connect() as connection:
+                assert list(database.missing_schema(connection)) == []
+
+    def test_expression_index_found(self, collegejump, monkeypatch):
+        # Newer SQLAlchemy leaves expression indexes out of get_indexes(), which
+        # mustn't make upgrades create them again.
+        from sqlalchemy.engine import reflection
+        from collegejump import database
+        get_indexes = reflection.Inspector.get_indexes
+        monkeypatch.setattr(reflection.Inspector, 'get_indexes',
+                            lambda self, table_name, **kw: [
+                                i for i in get_indexes(self, table_name, **kw)
+                                if i['name'] != 'ix_user_name_lower'])
+        with collegejump.app.app_context():
+            with collegejump.app.db.engine.connect() as connection:
+                assert list(database.missing_schema(connection)) == []
+            database.upgrade_db()
+
+class TestStartup():
+
+    def test_main(self, tmpdir):
+        # Run the startup path in a process of its own, since it configures
+        # and initializes the application, stopping where it would serve.
+        import os
+        import subprocess
+        import sys
+        script = '\n'.join([
+            "import collegejump, collegejump.__main__ as main",
+            "collegejump.app.config['IMAGE_CACHE_DIR'] = 'images'",
+            "collegejump.app.run = lambda **kwargs: print('serving')",
+            "main.main(main.parse(['--db', 'startup.db', '--template-cache-dir', 'templates']))",
+        ])
+        package_root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=package_root)
+        env.pop('COLLEGEJUMP_GEVENT', None)
+        result = subprocess.run([sys.executable, '-c', script], cwd=str(tmpdir), env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=120)
+        output = result.stdout.decode('utf-8', 'replace')
+        assert result.returncode == 0, output
+        assert 'serving' in output
+        # Resized images are built before serving, if Pillow is installed.
+        from collegejump import assets
+        if assets.Image is not None:
+            assert tmpdir.join('images').listdir()
+
+    def test_gevent_off(self):
+        # Only a true value turns gevent on; importing would fail without it.
+        import os
+        import subprocess
+        import sys
+        package_root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        for value in ('0', 'false', 'no', ''):
+            env = dict(os.environ, PYTHONPATH=package_root, COLLEGEJUMP_GEVENT=value)
+            output = subprocess.check_output(
+                [sys.executable, '-c', 'import collegejump; print(collegejump.GEVENT)'],
+                env=env, timeout=60)
+            assert output.strip() == b'False'
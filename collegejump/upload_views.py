@@ -0,0 +1,69 @@
+# The endpoints of resumable uploads, which the upload script sends files to
+# in chunks. See `uploads` for how uploads are stored and claimed.
+import flask
+from flask_login import login_required, current_user
+
+from collegejump import app, models, uploads
+from collegejump.limits import limit_body
+
+def _upload_reply(upload, status=200):
+    # Describe an upload to the script sending it.
+    return flask.jsonify(id=upload.id, offset=upload.received, size=upload.size,
+                         chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+                         url=flask.url_for('upload_page', upload_id=upload.id)), status
+
+def _upload_error(message, status, **kwargs):
+    return flask.jsonify(error=message, **kwargs), status
+
+@app.route('/upload', methods=["POST"])
+@login_required
+def new_upload_page():
+    """Start a resumable upload, given the purpose, name and size of the
+    file as JSON."""
+    declared = flask.request.get_json(silent=True) or {}
+    purpose, filename, size = (declared.get(key) for key in ('purpose', 'filename', 'size'))
+    if purpose not in models.Upload.PURPOSES or not filename \
+            or not isinstance(size, int) or size < 0:
+        return _upload_error("Expected a purpose, filename and size", 400)
+    if purpose == 'document' and not current_user.admin:
+        return flask.abort(403)
+    if size > uploads.max_size(purpose):
+        return _upload_error("Files may be at most {} MB".format(
+            uploads.max_size(purpose) // (1024 * 1024)), 413)
+
+    upload = uploads.create(current_user.id, purpose,
+                            filename[:models.Upload.FILENAME_MAX_LENGTH], size)
+    app.db.session.commit()
+    return _upload_reply(upload, 201)
+
+@app.route('/upload/<int:upload_id>', methods=["GET", "PUT", "DELETE"])
+@limit_body('UPLOAD_CHUNK_SIZE')
+@login_required
+def upload_page(upload_id):
+    """Report how much of an upload has been received, so it can be resumed,
+    receive a chunk of it at `?offset=`, or cancel it."""
+    upload = uploads.find(upload_id, current_user.id)
+    if upload is None:
+        return _upload_error("No such upload", 404)
+
+    if flask.request.method == 'DELETE':
+        uploads.discard(upload)
+        app.db.session.commit()
+        return '', 204
+    elif flask.request.method == 'GET':
+        return _upload_reply(upload)
+
+    # Check the chunk against its headers before reading any of it.
+    offset = flask.request.args.get('offset', type=int)
+    length = flask.request.content_length
+    if length is None:
+        return _upload_error("A Content-Length is required", 411)
+    if length > app.config['UPLOAD_CHUNK_SIZE'] or (offset or 0) + length > upload.size:
+        return _upload_error("The chunk is too large", 413)
+    if not uploads.write_chunk(upload, offset, flask.request.stream, length):
+        # Tell the client where to continue from.
+        app.db.session.refresh(upload)
+        return _upload_error("Expected a chunk at offset {}".format(upload.received), 409,
+                             offset=upload.received)
+    app.db.session.refresh(upload)
+    return _upload_reply(upload)
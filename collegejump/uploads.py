@@ -0,0 +1,109 @@
+# Resumable uploads. A client declares a file, sends it in chunks at given
+# offsets, and may ask how much has been received to resume after losing its
+# connection. Once complete, the upload is claimed by the form it was for,
+# which stores the file as a submission's attachment or a week's document.
+import datetime
+import os
+
+from sqlalchemy import event
+
+from collegejump import app, models
+
+# The request body is copied to the upload's file this many bytes at a time.
+COPY_SIZE = 64 * 1024
+
+def max_size(purpose):
+    """Return the largest file which may be uploaded for `purpose`."""
+    if purpose == 'document':
+        return app.config['MAX_DOCUMENT_SIZE']
+    return app.config['MAX_ATTACHMENT_SIZE']
+
+def _path(upload):
+    return os.path.join(app.config['UPLOAD_DIR'], '{}.part'.format(upload.id))
+
+def create(user_id, purpose, filename, size):
+    """Start an upload of `size` bytes, returning it. Requires a commit
+    afterwards. Uploads abandoned long enough ago are deleted first."""
+    expire()
+    upload = models.Upload(user_id, purpose, os.path.basename(filename), size)
+    app.db.session.add(upload)
+    app.db.session.flush()
+
+    os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+    open(_path(upload), 'wb').close()
+    return upload
+
+def write_chunk(upload, offset, stream, length):
+    """Write `length` bytes read from `stream` into the upload at `offset`,
+    which must be where the last chunk ended, and commit. Returns whether the
+    chunk was written. A chunk sent again after its reply was lost is written
+    over itself, so retrying is always safe."""
+    if offset != upload.received or offset + length > upload.size:
+        return False
+
+    # Copy a piece at a time, so that the chunk is never all in memory.
+    written = 0
+    with open(_path(upload), 'r+b') as part:
+        part.seek(offset)
+        while written < length:
+            data = stream.read(min(COPY_SIZE, length - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+    if written < length:
+        # The client went away part way through; it will send this again.
+        return False
+
+    # Another request may have written the same chunk meanwhile; either way,
+    # the data at this offset is the same.
+    table = models.Upload.__table__
+    app.db.session.execute(table.update()
+                           .where(table.c.id == upload.id)
+                           .where(table.c.received == offset)
+                           .values(received=offset + length,
+                                   updated_at=datetime.datetime.now()))
+    app.db.session.commit()
+    return True
+
+def find(upload_id, user_id, purpose=None):
+    """Return an upload of a user, for `purpose` if given, or None."""
+    query = models.Upload.query.filter_by(id=upload_id, user_id=user_id)
+    if purpose is not None:
+        query = query.filter_by(purpose=purpose)
+    return query.first()
+
+def claim(upload):
+    """Return the name and data of a complete upload, and delete it. Its file
+    is removed once the session commits."""
+    with open(_path(upload), 'rb') as part:
+        data = part.read()
+    discard(upload)
+    return upload.filename, data
+
+def discard(upload):
+    """Delete an upload, removing its file once the session commits."""
+    app.db.session.delete(upload)
+    app.db.session.info.setdefault('discarded_uploads', []).append(_path(upload))
+
+def expire():
+    """Delete uploads which haven't received a chunk within UPLOAD_EXPIRY
+    seconds."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=app.config['UPLOAD_EXPIRY'])
+    for upload in models.Upload.query.filter(models.Upload.updated_at < cutoff):
+        app.logger.info("Discarding abandoned %r", upload)
+        discard(upload)
+
+# Remove the files of deleted uploads only once the deletion is committed, so
+# a rolled back claim leaves the upload intact.
+@event.listens_for(app.db.session, 'after_commit')
+def _remove_discarded_uploads(session):
+    for path in session.info.pop('discarded_uploads', ()):
+        try:
+            os.remove(path)
+        except OSError:
+            pass # already gone
+
+@event.listens_for(app.db.session, 'after_soft_rollback')
+def _keep_discarded_uploads(session, previous_transaction): # pylint: disable=unused-argument
+    session.info.pop('discarded_uploads', None)
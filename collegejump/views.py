@@ -1,4 +1,8 @@
 import datetime
+import functools
+import hashlib
+import json
+import mimetypes
 import os
 import random
 import traceback
@@ -8,14 +12,69 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from werkzeug.exceptions import HTTPException, InternalServerError
-from collegejump import app, forms, models, database, admin_required
+from werkzeug.urls import url_quote
+from werkzeug.utils import secure_filename
+from collegejump import app, api, archive, assets, compression, events, forms, models, database, \
+    search, admin_required
+from collegejump.cache import cached_for_anonymous, conditional
+from collegejump.limits import describe_size, limit_body
+
+# Announcements listed per page, unless the request asks for another number, up
+# to the maximum.
+ANNOUNCEMENTS_PER_PAGE = 20
+MAX_ANNOUNCEMENTS_PER_PAGE = 100
+
+# Users listed per page of the account directory.
+USERS_PER_PAGE = 50
+
+# Submissions listed per page to give feedback on in a week.
+FEEDBACK_PER_PAGE = 20
 
 @app.route('/static/<path:path>')
 def send_static(path):
-    return flask.send_from_directory('static', path)
+    return assets.send_static_file(path)
+
+@app.route('/image/<int:size>/<path:path>')
+def send_image(path, size):
+    return assets.send_image(path, size)
+
+@app.url_defaults
+def static_fingerprint(endpoint, values):
+    # Add the fingerprint of the file to URLs for static files, so that they can
+    # be cached forever.
+    if endpoint in ('send_static', 'send_image') and 'v' not in values:
+        values['v'] = assets.fingerprint(values['path'])
+
+@app.before_request
+def reject_large_body():
+    # Refuse a body larger than the view accepts from its declared length,
+    # before reading any of it. Bodies without one are cut off at the limit.
+    request = flask.request
+    if request.content_length is not None and request.max_content_length is not None \
+            and request.content_length > request.max_content_length:
+        return flask.abort(413, "Requests here may be at most {}.".format(
+            describe_size(request.max_content_length)))
+
+@app.after_request
+def compress_response(response):
+    # Compress buffered responses of compressible types, if the client accepts
+    # any encoding we can produce. Files and streams are left alone.
+    if response.direct_passthrough or response.is_streamed \
+            or response.status_code in (204, 304) \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in compression.COMPRESSIBLE_MIMETYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encodings = compression.acceptable_encodings(flask.request.accept_encodings)
+    if encodings and response.content_length >= app.config['COMPRESS_MIN_SIZE']:
+        response.set_data(compression.compress(response.get_data(), encodings[0]))
+        response.headers['Content-Encoding'] = encodings[0]
+    return response
 
 
 @app.route('/', methods=["GET", "POST"])
+@cached_for_anonymous()
 def front_page():
     # If setup mode is happening, render a FirstSetupUserInfoForm.
     if 'SETUP_KEY' in app.config:
@@ -54,6 +113,7 @@ def front_page():
 
 
 @app.route('/calendar')
+@cached_for_anonymous()
 def calendar_page():
     return flask.render_template('calendar.html')
 
@@ -246,6 +306,7 @@ def edit_semester_page(semester_id):
     week_form = forms.WeekForm()
     del week_form.delete
     del week_form.new_document
+    del week_form.document_upload
     del week_form.assignment_name
     del week_form.assignment_instructions
 
@@ -255,6 +316,7 @@ def edit_semester_page(semester_id):
         app.logger.info("Deleting %r", semester)
         app.db.session.delete(semester)
         app.db.session.commit()
+        archive.delete_archive(semester)
         flask.flash("Deleted semester '{}'".format(semester.name), 'success')
         return flask.redirect(flask.url_for('syllabus_page'))
 
@@ -271,9 +333,9 @@ def edit_semester_page(semester_id):
         return flask.redirect(flask.url_for('edit_semester_page', semester_id=semester.id))
 
     # If POSTing a valid new week, create it and attach it to this semester as
-    # the last week.
-    if week_form.validate_on_submit():
-        week = models.Week(semester_id, len(semester.weeks) + 1,
+    # the last week. Archived semesters get no new weeks until restored.
+    if not semester.archive_path and week_form.validate_on_submit():
+        week = models.Week(semester_id, models.Week.next_week_num(semester_id),
                            week_form.header.data,
                            week_form.intro.data)
         app.logger.debug("Creating new week %r", week)
@@ -287,9 +349,67 @@ def edit_semester_page(semester_id):
     return flask.render_template("semester.html",
                                  semester=semester,
                                  semester_form=semester_form,
-                                 week_form=week_form)
+                                 week_form=week_form,
+                                 clone_form=forms.CloneSemesterForm(prefix='clone'))
+
+@app.route('/syllabus/semester/<int:semester_id>/clone', methods=["POST"])
+@admin_required
+def clone_semester_page(semester_id):
+    """Create a new semester with a copy of this semester's syllabus."""
+    semester = models.Semester.query.get(semester_id)
+    if semester is None:
+        return flask.abort(404)
+
+    form = forms.CloneSemesterForm(prefix='clone')
+    if not form.validate_on_submit():
+        for errors in form.errors.values():
+            for error in errors:
+                flask.flash(error, 'error')
+        return flask.redirect(flask.url_for('edit_semester_page', semester_id=semester_id))
+
+    # Weeks and assignments are copied in bulk, bypassing the ORM, so they
+    # are indexed for searching explicitly, in the same transaction.
+    clone = semester.clone(form.name.data, form.order.data)
+    search.index_semester(clone.id)
+    app.db.session.commit()
+
+    app.logger.info("Cloned %r as %r", semester, clone)
+    flask.flash("Created semester '{}' from '{}'".format(clone.name, semester.name), 'success')
+    return flask.redirect(flask.url_for('edit_semester_page', semester_id=clone.id))
+
+@app.route('/syllabus/semester/<int:semester_id>/archive', methods=["POST"])
+@admin_required
+def archive_semester_page(semester_id):
+    """Move a semester's content out of the database into an archive."""
+    semester = models.Semester.query.get(semester_id)
+    if semester is None:
+        return flask.abort(404)
+
+    if semester.archive_path:
+        flask.flash("Semester '{}' is already archived".format(semester.name), 'error')
+    else:
+        archive.archive_semester(semester)
+        flask.flash("Archived semester '{}'".format(semester.name), 'success')
+    return flask.redirect(flask.url_for('edit_semester_page', semester_id=semester_id))
+
+@app.route('/syllabus/semester/<int:semester_id>/restore', methods=["POST"])
+@admin_required
+def restore_semester_page(semester_id):
+    """Move an archived semester's content back into the database."""
+    semester = models.Semester.query.get(semester_id)
+    if semester is None:
+        return flask.abort(404)
+
+    try:
+        archive.restore_semester(semester)
+    except ValueError as error:
+        flask.flash(str(error), 'error')
+    else:
+        flask.flash("Restored semester '{}'".format(semester.name), 'success')
+    return flask.redirect(flask.url_for('edit_semester_page', semester_id=semester_id))
 
 @app.route('/syllabus/semester/<int:semester_id>/week/<int:week_num>', methods=["GET", "POST"])
+@limit_body('MAX_DOCUMENT_SIZE', 'MAX_FORM_MEMORY_SIZE')
 @admin_required
 def edit_week_page(semester_id, week_num):
     """Edit a particular week in a semester."""
@@ -312,15 +432,8 @@ def edit_week_page(semester_id, week_num):
 
     # If the delete button was pressed, delete the week.
     if flask.request.method == 'POST' and form.delete.data:
-        app.db.session.delete(week)
-
-        # Iterate through all of the other weeks in the semester, and change
-        # their week numbers to match.
-        for other_week in week.semester.weeks:
-            # If this week is after what we're deleting, shift it back.
-            if other_week.week_num > week.week_num:
-                other_week.week_num -= 1
-
+        # The later weeks are renumbered in the database, without loading them.
+        week.remove()
         app.db.session.commit()
         app.logger.info("Deleted week %r from the database", week)
         flask.flash("Deleted week '{}'".format(week.header), 'success')
@@ -352,13 +465,21 @@ def edit_week_page(semester_id, week_num):
         else:
             week.assignments = []
 
+        # The assignment is shown as part of the week, so the week changes with
+        # it.
+        week.updated_at = datetime.datetime.now()
+
         # If a file was uploaded, extract it into a Document, store that, and
-        # associate it with this week.
-        if form.new_document.has_file():
+        # associate it with this week. The file may have been uploaded in chunks
+        # beforehand, or with the form.
+        uploaded = form.document_upload.claim()
+        if uploaded is None and form.new_document.has_file():
+            uploaded = (os.path.basename(form.new_document.data.filename),
+                        form.new_document.data.stream.read())
+        if uploaded is not None:
             app.logger.debug("Adding document to week %r", week)
             # Create the Document object using the form data.
-            document = models.Document(os.path.basename(form.new_document.data.filename),
-                                       form.new_document.data.stream.read())
+            document = models.Document(*uploaded)
 
             # Add the Document to the current session.
             app.db.session.add(document)
@@ -381,19 +502,117 @@ def edit_week_page(semester_id, week_num):
                                  form=form,
                                  show_edit_options=True)
 
+@app.route('/syllabus/semester/<int:semester_id>/week/<int:week_num>/move', methods=["POST"])
+@admin_required
+def move_week_page(semester_id, week_num):
+    """Move a week to another position in its semester."""
+    try:
+        week = models.Week.query.filter_by(semester_id=semester_id,
+                                           week_num=week_num).one()
+    except NoResultFound:
+        return flask.abort(404)
+
+    form = forms.MoveWeekForm()
+    if form.validate_on_submit():
+        week.move_to(form.week_num.data)
+        app.db.session.commit()
+        app.logger.info("Moved %r from position %d", week, week_num)
+        flask.flash("Moved week '{}' to week {}".format(week.header, week.week_num), 'success')
+    else:
+        flask.flash("Couldn't move week '{}'".format(week.header), 'error')
+    return flask.redirect(flask.url_for('edit_semester_page', semester_id=semester_id))
+
 @app.route('/announcement/')
 @app.route('/announcement/<int:announcement_id>')
+@cached_for_anonymous('before', 'per_page')
 def announcement_page(announcement_id=None):
     if announcement_id is not None:
         announcement = models.Announcement.query.get(announcement_id)
         if announcement is None:
             return flask.abort(404)
-        return flask.render_template('announcement.html', announcement=announcement)
-
-    # Otherwise
-    announcements = models.Announcement.query\
-            .order_by(models.Announcement.timestamp.desc())
-    return flask.render_template('all_announcements.html', announcements=announcements)
+        return conditional(functools.partial(flask.render_template, 'announcement.html',
+                                             announcement=announcement),
+                           announcement.id, announcement.updated_at,
+                           _bylines([announcement]))
+
+    # Otherwise, list a page of announcements, continuing from `before` if it
+    # was given.
+    before = _parse_announcement_cursor(flask.request.args.get('before'))
+    per_page = _announcements_per_page()
+    announcements, more = models.Announcement.page(before, per_page)
+    older = _announcement_cursor(announcements[-1]) if more else None
+
+    return conditional(functools.partial(flask.render_template, 'all_announcements.html',
+                                         announcements=announcements,
+                                         newest=(before is None),
+                                         older=older,
+                                         per_page=per_page),
+                       models.version_of(models.Announcement.query, models.Announcement))
+
+@app.route('/announcement/feed.json')
+@cached_for_anonymous('before', 'per_page')
+def announcement_feed():
+    """Serve announcements as a JSON Feed (https://jsonfeed.org/version/1), a
+    page at a time in the same way as `announcement_page`."""
+    before = _parse_announcement_cursor(flask.request.args.get('before'))
+    per_page = _announcements_per_page()
+    announcements, more = models.Announcement.page(before, per_page)
+
+    def render():
+        feed = {
+            'version': 'https://jsonfeed.org/version/1',
+            'title': 'College JUMP Announcements',
+            'home_page_url': flask.url_for('announcement_page', _external=True),
+            'feed_url': flask.url_for('announcement_feed', _external=True),
+            'items': [{
+                'id': str(announcement.id),
+                'url': flask.url_for('announcement_page',
+                                     announcement_id=announcement.id,
+                                     _external=True),
+                'title': announcement.title,
+                'content_html': announcement.content_html,
+                'date_published': announcement.timestamp.astimezone().isoformat(),
+                'date_modified': announcement.updated_at.astimezone().isoformat()
+                                 if announcement.updated_at else None,
+                'author': {'name': announcement.author.name if announcement.author else None},
+            } for announcement in announcements],
+        }
+        if more:
+            feed['next_url'] = flask.url_for('announcement_feed',
+                                             before=_announcement_cursor(announcements[-1]),
+                                             per_page=per_page,
+                                             _external=True)
+        return app.response_class(json.dumps(feed), mimetype='application/feed+json')
+
+    return conditional(render,
+                       models.version_of(models.Announcement.query, models.Announcement),
+                       _bylines(announcements))
+
+def _bylines(announcements):
+    # The names of the authors shown with announcements, which change when an
+    # author is renamed, without any announcement changing.
+    return tuple(a.author.name if a.author else None for a in announcements)
+
+def _announcements_per_page():
+    # Read the page size requested, within reason.
+    per_page = flask.request.args.get('per_page', ANNOUNCEMENTS_PER_PAGE, type=int)
+    return min(max(per_page, 1), MAX_ANNOUNCEMENTS_PER_PAGE)
+
+def _announcement_cursor(announcement):
+    # Encode the position of an announcement in the newest-first listing.
+    return '{}_{}'.format(announcement.timestamp.strftime('%Y%m%d%H%M%S%f'),
+                          announcement.id)
+
+def _parse_announcement_cursor(cursor):
+    # Decode a position made by `_announcement_cursor`, if any was given.
+    if not cursor:
+        return None
+    try:
+        timestamp, announcement_id = cursor.split('_')
+        return (datetime.datetime.strptime(timestamp, '%Y%m%d%H%M%S%f'),
+                int(announcement_id))
+    except ValueError:
+        return flask.abort(400)
 
 
 @app.route('/account/all', methods=['GET', 'POST'])
@@ -403,7 +622,8 @@ def edit_accounts_page():
     # Generate a form for a new user. Since it is a new user, it does not need the delete field.
     form = forms.UserForm()
     del form.delete
-    form.populate_semesters()
+    semesters = forms.semester_choices()
+    form.populate_semesters(semesters)
 
     # The form validates all input, including uniqueness of the email, and
     # other database properties. If we encounter a database error at this
@@ -416,8 +636,28 @@ def edit_accounts_page():
         app.logger.info("Created user %r in the database", user)
         return flask.redirect(flask.url_for('edit_accounts_page'))
 
-    return flask.render_template('edit_accounts.html', form=form,
-                                 users=models.User.query.all())
+    # Filter the directory by whatever was searched for. Invalid filters, such
+    # as the email of a user who doesn't exist, are shown as errors and ignored.
+    search_form = forms.UserSearchForm(flask.request.args)
+    search_form.populate_semesters(semesters)
+    search_form.validate()
+    mentor = search_form.mentor.user()
+    users = models.User.directory(search=search_form.search.data,
+                                  role=search_form.role.data or None,
+                                  semester_id=search_form.semester.data or None,
+                                  mentor_id=mentor.id if mentor else None)
+
+    # Only fetch the page of users being shown.
+    page = max(flask.request.args.get('page', 1, type=int), 1)
+    total = users.order_by(None).count()
+    users = users.limit(USERS_PER_PAGE).offset((page - 1) * USERS_PER_PAGE).all()
+
+    # Carry the search over to links to other pages.
+    search_args = {k: v for k, v in flask.request.args.items() if k != 'page' and v}
+    return flask.render_template('edit_accounts.html', form=form, search_form=search_form,
+                                 users=users, total=total, page=page,
+                                 pages=max((total - 1) // USERS_PER_PAGE + 1, 1),
+                                 search_args=search_args)
 
 @app.route('/document/<int:document_id>')
 @login_required
@@ -425,9 +665,28 @@ def document_page(document_id):
     document = models.Document.query.get(document_id)
     if document is None:
         return flask.abort(404)
-    return flask.send_file(document.file_like(),
-                           attachment_filename=document.name,
-                           as_attachment=True)
+    return _send_stored(models.Document.__table__.c.data, document.id, document.name)
+
+def _send_stored(column, row_id, filename):
+    # Send the data of a compressed column as an attachment, decompressing it
+    # as it is sent, rather than all at once. Its length is counted first, so
+    # that browsers can show progress and resume interrupted downloads.
+    stored = models.stored_binary(column, row_id) or b''
+    size = compression.unpacked_size(stored)
+    response = flask.Response(compression.unpack_stream(stored),
+                              mimetype=mimetypes.guess_type(filename)[0]
+                              or 'application/octet-stream',
+                              direct_passthrough=True)
+    response.headers['Content-Length'] = size
+    response.set_etag(hashlib.sha1(stored).hexdigest())
+    # Names which can't be sent as they are are sent encoded, as Flask does.
+    try:
+        filename.encode('latin-1')
+        options = {'filename': filename}
+    except UnicodeEncodeError:
+        options = {'filename*': "UTF-8''" + url_quote(filename)}
+    response.headers.set('Content-Disposition', 'attachment', **options)
+    return response.make_conditional(flask.request, accept_ranges=True, complete_length=size)
 
 @app.route('/document/<int:document_id>/remove', methods=["POST"])
 @admin_required
@@ -439,7 +698,10 @@ def remove_document(document_id):
 
     redirectform = forms.RedirectForm(returnto=returnto)
 
-    # Delete the document. We don't know if it exists when this happens.
+    # Mark the weeks showing the document as changed, then delete the document.
+    # We don't know if it exists when this happens.
+    models.Week.query.filter(models.Week.documents.any(id=document_id)) \
+            .update({'updated_at': datetime.datetime.now()}, synchronize_session=False)
     models.Document.query.filter_by(id=document_id).delete()
     app.db.session.commit()
 
@@ -447,6 +709,7 @@ def remove_document(document_id):
     return redirectform.redirect()
 
 @app.route('/database/', methods=['GET', 'POST'])
+@limit_body('MAX_DATABASE_SIZE')
 @admin_required
 def database_page():
     form = forms.DatabaseUploadForm()
@@ -471,13 +734,17 @@ def database_export_endpoint():
 
 
 @app.route('/semester/<int:semester_id>/week/<int:week_num>', methods=["GET", "POST"])
+@limit_body('MAX_ATTACHMENT_SIZE', 'MAX_FORM_MEMORY_SIZE')
 @login_required
 def week_page(semester_id, week_num):
     # We aren't given the week ID, just the semester ID and week number, so we
     # look it up by those. The database guarantees that the pair is unique.
+    # The assignments and documents shown are loaded along with it.
     try:
-        week = models.Week.query.filter_by(semester_id=semester_id,
-                                           week_num=week_num).one()
+        week = models.Week.query.filter_by(semester_id=semester_id, week_num=week_num) \
+                                .options(joinedload(models.Week.assignments),
+                                         joinedload(models.Week.documents)) \
+                                .one()
     except NoResultFound:
         return flask.abort(404)
 
@@ -487,7 +754,7 @@ def week_page(semester_id, week_num):
     # The user must be 'interested' in this semester to view it: either they are
     # an admin, have a mentee enrolled in the semester, or are enrolled
     # themselves.
-    if week.semester_id not in [s.id for s in current_user.interested_semesters()]:
+    if not current_user.is_interested_in(week.semester_id):
         return flask.abort(403)
 
     # If there is an assignment, prepare a form to receive submissions.
@@ -495,26 +762,59 @@ def week_page(semester_id, week_num):
 
     if answer_form and answer_form.validate_on_submit():
         # This is an answer submission, so create a Submission.
-        submission = answer_form.to_submission_model(assignment, current_user)
+        answer_form.to_submission_model(assignment, current_user.model)
         app.db.session.commit()
         return flask.redirect(flask.url_for("week_page",
                                             semester_id=semester_id,
                                             week_num=week_num))
 
-    submissions = models.Submission.query \
-            .filter_by(author=current_user, assignment=assignment) \
-            .order_by('timestamp desc')
+    # Besides the week itself, the page shows the user's own submissions and
+    # those they may give feedback on, along with any feedback on them.
+    if assignment is not None:
+        shown = models.Submission.query.filter_by(assignment_id=assignment.id)
+        if not current_user.admin:
+            shown = shown.filter(models.Submission.author_id.in_(
+                [current_user.id] + list(current_user.mentee_ids)))
+        feedback = models.Feedback.query.filter(
+            models.Feedback.submission_id.in_(shown.with_entities(models.Submission.id)))
+        shown_versions = (models.version_of(shown, models.Submission),
+                          models.version_of(feedback, models.Feedback))
+    else:
+        shown_versions = ()
 
-    submissions_to_grade = models.Submission.query \
-            .filter(models.Submission.author_id.in_([m.id for m in current_user.mentees]),
-                    models.Submission.assignment == assignment) \
-            .order_by('timestamp desc')
+    # Submissions to give feedback on are shown a page at a time.
+    page = max(flask.request.args.get('page', 1, type=int), 1)
 
-    return flask.render_template('week.html',
-                                 week=week,
-                                 submissions=submissions,
-                                 submissions_to_grade=submissions_to_grade,
-                                 answer_form=answer_form)
+    def render():
+        contents = models.week_contents(week, current_user, page, FEEDBACK_PER_PAGE)
+        return flask.render_template('week.html',
+                                     week=week,
+                                     contents=contents,
+                                     page=page,
+                                     answer_form=answer_form)
+
+    return conditional(render, week.id, week.updated_at, page, *shown_versions)
+
+@app.route('/events')
+@login_required
+def events_page():
+    """Stream new feedback, submissions and announcements for the user as
+    Server-Sent Events, catching up from `Last-Event-ID` on reconnecting."""
+    # Each stream holds its connection open, which only gevent does cheaply.
+    if not app.config['EVENT_STREAMS']:
+        return flask.abort(404)
+
+    try:
+        last_event_id = int(flask.request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+
+    response = flask.Response(events.stream(current_user.id, last_event_id),
+                              mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let proxies hold events back to buffer the response.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/submission/<int:submission_id>/attachment')
 @login_required
@@ -524,14 +824,49 @@ def submission_attachment_page(submission_id):
         return flask.abort(404)
 
     # Only let the author, the admins, and the author's mentors download the file.
-    if (not current_user == submission.author) \
+    if (current_user.id != submission.author_id) \
             and (not current_user.admin) \
-            and (current_user not in submission.author.mentors):
+            and (submission.author_id not in current_user.mentee_ids):
         return flask.abort(403)
 
-    return flask.send_file(submission.attachment_file_like(),
-                           attachment_filename=submission.filename,
-                           as_attachment=True)
+    return _send_stored(models.Submission.__table__.c.filedata, submission.id,
+                        submission.filename)
+
+@app.route('/assignment/<int:assignment_id>/submissions.zip')
+@login_required
+def submissions_archive(assignment_id):
+    """Stream a ZIP of every submission to an assignment which the user may
+    give feedback on, each as a folder holding the response and attachment."""
+    assignment = models.Assignment.query.get(assignment_id)
+    if assignment is None:
+        return flask.abort(404)
+    if not current_user.admin and not current_user.mentee_ids:
+        return flask.abort(403)
+
+    submissions = current_user.gradeable_submissions() \
+            .filter(models.Submission.assignment_id == assignment.id) \
+            .outerjoin(models.User, models.User.id == models.Submission.author_id) \
+            .with_entities(models.Submission.id, models.User.name, models.Submission.timestamp,
+                           models.Submission.text, models.Submission.filename) \
+            .order_by(models.Submission.timestamp.desc())
+
+    def members():
+        # Attachments are read one at a time, as each is reached.
+        for submission_id, author, timestamp, text, filename in submissions.yield_per(100):
+            folder = '{}-{}/'.format(secure_filename(author or '') or 'unknown', submission_id)
+            date_time = timestamp.timetuple()[:6] if timestamp else (1980, 1, 1, 0, 0, 0)
+            yield folder + 'response.txt', date_time, (text or '').encode('utf-8')
+            if filename:
+                filedata = models.stream_binary(models.Submission.__table__.c.filedata,
+                                                submission_id)
+                yield folder + (secure_filename(filename) or 'attachment'), date_time, \
+                        filedata or b''
+
+    response = flask.Response(flask.stream_with_context(compression.stream_zip(members())),
+                              mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename="{}.zip"'.format(
+        secure_filename(assignment.name or '') or 'submissions')
+    return response
 
 @app.route('/submission/<submission_id>', methods=["GET", "POST"])
 @login_required
@@ -546,7 +881,7 @@ def feedback_page(submission_id):
     if submission is None:
         return flask.abort(404)
 
-    if (not current_user.admin) and (current_user not in submission.author.mentors):
+    if (not current_user.admin) and (submission.author_id not in current_user.mentee_ids):
         return flask.abort(403)
 
     feedback_form = forms.FeedbackForm(returnto=returnto)
@@ -556,19 +891,24 @@ def feedback_page(submission_id):
         feedback.submission = submission
         feedback.text = feedback_form.feedback.data
         feedback.timestamp = datetime.datetime.now()
-        feedback.author = current_user
+        feedback.author = current_user.model
 
         app.db.session.add(feedback)
         app.db.session.commit()
         return feedback_form.redirect()
 
-    return flask.render_template("feedback.html",
-                                 submission=submission,
-                                 feedback_form=feedback_form)
+    all_feedback = models.Feedback.query.filter_by(submission_id=submission.id)
+    return conditional(functools.partial(flask.render_template, "feedback.html",
+                                         submission=submission,
+                                         feedback_form=feedback_form),
+                       submission.id, submission.updated_at,
+                       models.version_of(all_feedback, models.Feedback))
 
+@app.errorhandler(400)
 @app.errorhandler(401)
 @app.errorhandler(403)
 @app.errorhandler(404)
+@app.errorhandler(413)
 @app.errorhandler(SQLAlchemyError)
 def http_error_page(error):
     # If we are catching some non-http exception it is an application error.
@@ -587,4 +927,8 @@ def http_error_page(error):
         app.logger.error("Incident %d; please submit the following code to\n%s\n%s",
                          error.incident_number, app.config['REPOSITORY_ISSUES'], error.traceback)
 
+    # API clients get errors they can read, too.
+    if flask.request.path.startswith(api.PREFIX + '/'):
+        return api.error(error.description, error.code)
+
     return flask.render_template('error.html', error=error), error.code
@@ -2,8 +2,9 @@
 
 import sys
 import collegejump
+import collegejump.database
 
-collegejump.init_app()
+collegejump.init_app(web=False)
 with collegejump.app.app_context():
     collegejump.database.import_db(sys.argv[1])
     for table in collegejump.app.db.metadata.sorted_tables:
@@ -2,6 +2,7 @@
 
 import argparse
 import collegejump
+import collegejump.models
 import os
 import sys
 
@@ -9,7 +10,7 @@ def main(args):
     collegejump.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
         os.path.join(os.getcwd(), args.db))
 
-    collegejump.init_app()
+    collegejump.init_app(web=False)
     with collegejump.app.app_context():
         collegejump.app.db.create_all()
 
@@ -1,23 +1,65 @@
 #!/usr/bin/env python3
 import os
-import setuptools, setuptools.command.sdist, setuptools.command.test
+import setuptools, setuptools.command.build_py, setuptools.command.develop, \
+    setuptools.command.sdist, setuptools.command.test
 import sys
 
 # Load scmtools from inside the package, so that the code to get the version is
 # always the same.
 sys.path.append(os.path.abspath("collegejump"))
 import scmtools
+import compression
 
-# Override sdist to include a _version.py file with the Git version
+# Write gzip (and, if available, brotli) variants of the static files, which the
+# application serves to clients that accept them.
+class precompress_static(setuptools.Command):
+    description = "precompress static files"
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        for path in compression.precompress_directory('collegejump/static'):
+            self.announce('wrote {}'.format(path), level=2)
+
+def write_version(directory):
+    """Write a _version.py file with the Git version into a package directory,
+    so the installed package never needs to run git to find it."""
+    path = os.path.join(directory, '_version.py')
+    with open(path, 'w') as f:
+        f.write('__version__ = \'{}\''.format(scmtools.get_scm_version()))
+    return path
+
+# Override build_py and develop to write the version into built and editable
+# packages, respectively. Builds from an sdist already have a _version.py, and
+# no git repository to take the version from.
+class build_py_burn_version(setuptools.command.build_py.build_py):
+    def run(self):
+        super().run()
+        if not self.dry_run and os.path.isdir('.git'):
+            write_version(os.path.join(self.build_lib, 'collegejump'))
+
+class develop_burn_version(setuptools.command.develop.develop):
+    def run(self):
+        write_version('collegejump')
+        super().run()
+
+# Override sdist to include a _version.py file with the Git version, and
+# precompressed static files
 class sdist_burn_version(setuptools.command.sdist.sdist):
     def run(self):
-        version = scmtools.get_scm_version()
-        with open('collegejump/_version.py', 'w') as f:
-            f.write('__version__ = \'{}\''.format(version))
+        write_version('collegejump')
+        precompressed = compression.precompress_directory('collegejump/static')
 
         super().run()
 
         os.remove('collegejump/_version.py')
+        for path in precompressed:
+            os.remove(path)
 
 # PyTest runner borrowed from
 # https://docs.pytest.org/en/latest/goodpractices.html#manual-integration
@@ -41,6 +83,8 @@ setuptools.setup(
     packages=['collegejump'],
     include_package_data=True,
     zip_safe=False,
+    # The package's module-level __getattr__ needs Python 3.7.
+    python_requires='>=3.7',
     tests_require=[
         'pytest',
         'pytest-pylint',
@@ -50,6 +94,8 @@ setuptools.setup(
         'setuptools',
         'Flask >= 0.12',
         'Flask-SQLAlchemy >= 2.2',
+        # The version the database code is tested against.
+        'SQLAlchemy >= 1.1, < 1.2',
         'Flask-Bootstrap >= 3.3.7, < 3.3.8',
         'SQLAlchemy-Utils',
         'Flask-Bcrypt',
@@ -57,8 +103,16 @@ setuptools.setup(
         'Flask-Login',
         'markdown',
     ],
+    extras_require={
+        'brotli': ['Brotli'],
+        'images': ['Pillow'],
+        'events': ['gevent'],
+    },
     cmdclass={ # Override certain commands
+        'build_py': build_py_burn_version,
+        'develop': develop_burn_version,
         'sdist': sdist_burn_version,
         'test': PyTest,
+        'precompress': precompress_static,
     },
 )